@@ -7,3 +7,4 @@ class AnacreonConfig(AppConfig):
 
     def ready(self):
         import gluon.anacreon.signals
+        import gluon.anacreon.jobs
@@ -0,0 +1,83 @@
+import logging
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Callable, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentJobError(Exception):
+    """
+    Raised by a task when it has failed in a way that retrying won't fix
+    """
+
+
+@dataclass(frozen=True)
+class TaskSpec:
+    name: str
+    func: Callable
+    max_attempts: int
+    every: Optional[timedelta] = None
+
+
+_tasks = {}
+
+
+def task(name, max_attempts=5, every=None):
+    """
+    Registers the decorated function as a task which can be queued with Job.enqueue(name, payload). The payload is
+    passed to the function as keyword arguments and whatever it returns is stored as the job's result, so both
+    need to be JSON serializable. Tasks given an interval with every are periodic: workers make sure one is always
+    queued and each run queues the next.
+    """
+
+    def wrapper(func):
+        if name in _tasks:
+            raise ValueError(f"Task {name} is already registered")
+
+        _tasks[name] = TaskSpec(name=name, func=func, max_attempts=max_attempts, every=every)
+        return func
+
+    return wrapper
+
+
+def get_task(name):
+    try:
+        return _tasks[name]
+    except KeyError:
+        raise ValueError(f"No such task: {name}")
+
+
+def get_periodic_tasks():
+    return [spec for spec in _tasks.values() if spec.every]
+
+
+@task("process_order")
+def process_order(order_id):
+    from .models import Order
+
+    order = Order.objects.filter(id=order_id).first()
+    if order is None:
+        raise PermanentJobError(f"No such order: {order_id}")
+
+    outcome = order.process_order()
+    if not outcome["success"]:
+        raise PermanentJobError(outcome["error"])
+
+    return outcome
+
+
+@task("maintain_audit_log_partitions", every=timedelta(days=1))
+def maintain_audit_log_partitions():
+    from .partitions import ensure_audit_log_partitions
+
+    return {"created": ensure_audit_log_partitions(settings.AUDIT_LOG_PARTITIONS_AHEAD)}
+
+
+@task("refresh_item_sales", every=timedelta(minutes=settings.ITEM_SALES_REFRESH_MINUTES))
+def refresh_item_sales():
+    from .models import ItemSales
+
+    ItemSales.refresh()
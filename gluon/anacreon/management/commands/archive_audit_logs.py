@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from gluon.anacreon.partitions import (
+    add_months,
+    archive_audit_log_partition,
+    ensure_audit_log_partitions,
+    get_audit_log_partitions,
+)
+
+
+class Command(BaseCommand):
+    help = "Exports audit log partitions older than the retention period as gzipped NDJSON and drops them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retain-months",
+            type=int,
+            default=settings.AUDIT_LOG_RETAIN_MONTHS,
+            help="Number of whole months before the current one to keep in the database",
+        )
+        parser.add_argument(
+            "--directory",
+            default=str(settings.AUDIT_LOG_ARCHIVE_DIR),
+            help="Directory to write the exported partitions to",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only list the partitions which would be archived"
+        )
+
+    def handle(self, *args, **options):
+        created = ensure_audit_log_partitions(settings.AUDIT_LOG_PARTITIONS_AHEAD)
+        if created:
+            self.stdout.write(f"Created {created} future partition(s)")
+
+        cutoff = add_months(timezone.now().date().replace(day=1), -options["retain_months"])
+
+        for name, month, attached in get_audit_log_partitions():
+            if month >= cutoff:
+                break
+
+            if options["dry_run"]:
+                self.stdout.write(f"Would archive {name}")
+                continue
+
+            path, rows = archive_audit_log_partition(name, attached, options["directory"])
+            self.stdout.write(f"Archived {name} ({rows} rows) to {path}")
@@ -0,0 +1,48 @@
+import base64
+import binascii
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from gluon.anacreon.models import ItemImage
+
+
+class Command(BaseCommand):
+    help = "Moves item images stored as base64 in the database to content-addressed files with thumbnails"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="Number of images to move per transaction")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the images which would be moved")
+
+    def handle(self, *args, **options):
+        pending = ItemImage.objects.filter(file="").exclude(image="")
+
+        if options["dry_run"]:
+            self.stdout.write(f"Would move {pending.count()} image(s)")
+            return
+
+        moved, last_id = 0, 0
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    pending.filter(id__gt=last_id).select_for_update().order_by("id")[: options["batch_size"]]
+                )
+                if not batch:
+                    break
+
+                for image in batch:
+                    try:
+                        content = base64.b64decode(image.image)
+                    except (binascii.Error, ValueError):
+                        self.stderr.write(f"Skipping image #{image.id} which isn't valid base64")
+                        continue
+
+                    for field, value in ItemImage.store_content(content, image.mimetype).items():
+                        setattr(image, field, value)
+                    image.image = ""
+
+                ItemImage.objects.bulk_update(batch, ["file", "thumbnail", "checksum", "image"])
+
+            moved += sum(1 for image in batch if image.file)
+            last_id = batch[-1].id
+            self.stdout.write(f"Moved {moved} image(s)")
@@ -0,0 +1,27 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from gluon.anacreon.models import Business, DailyExpenditure, DailySales
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the daily sales and expenditure rollups from orders and expenditures, e.g. to backfill history"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--business", type=int, action="append", help="Id of a business to rebuild, can be repeated (default all)"
+        )
+        parser.add_argument("--start", type=date.fromisoformat, help="First day to rebuild, as YYYY-MM-DD")
+        parser.add_argument("--end", type=date.fromisoformat, help="Last day to rebuild, as YYYY-MM-DD")
+
+    def handle(self, *args, **options):
+        business_ids = options["business"] or Business.objects.order_by("id").values_list("id", flat=True)
+        start, end = options["start"], options["end"]
+
+        for business_id in business_ids:
+            sales = DailySales.rebuild(business_id, start, end)
+            expenditures = DailyExpenditure.rebuild(business_id, start, end)
+            self.stdout.write(
+                f"Business #{business_id}: {sales} day(s) of sales, {expenditures} day and category expenditure(s)"
+            )
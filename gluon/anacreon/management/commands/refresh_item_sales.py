@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from gluon.anacreon.models import ItemSales
+
+
+class Command(BaseCommand):
+    help = "Refreshes the per item sales over the last 7, 30 and 90 days which top sellers are read from"
+
+    def handle(self, *args, **options):
+        ItemSales.refresh()
+        self.stdout.write(f"Refreshed sales of {ItemSales.objects.count()} item window(s)")
@@ -0,0 +1,32 @@
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from gluon.anacreon.models import Business
+from gluon.anacreon.valuation import value_inventory
+
+
+class Command(BaseCommand):
+    help = "Values the stock on hand of businesses first-in first-out and at weighted average cost"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--business", type=int, action="append", help="Id of a business to value, can be repeated (default all)"
+        )
+        parser.add_argument("--csv", help="File to write the valuation of every item to, with a business column")
+
+    def handle(self, *args, **options):
+        business_ids = options["business"] or Business.objects.order_by("id").values_list("id", flat=True)
+
+        valuations = []
+        for business_id in business_ids:
+            valuation = value_inventory(business_id)
+            self.stdout.write(
+                f"Business #{business_id}: {len(valuation)} item(s), {int(valuation.on_hand.sum())} unit(s) on hand, "
+                f"FIFO value {valuation.fifo_value.sum():.2f}, average cost value {valuation.average_value.sum():.2f}"
+            )
+            valuations.append(valuation.assign(business=business_id))
+
+        if options["csv"] and valuations:
+            frame = pd.concat(valuations)
+            frame.round(2).to_csv(options["csv"])
+            self.stdout.write(f"Wrote {len(frame)} item(s) to {options['csv']}")
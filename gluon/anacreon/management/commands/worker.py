@@ -0,0 +1,94 @@
+import logging
+import os
+import signal
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from gluon.anacreon.models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Runs background jobs from the database job queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=settings.JOB_WORKER_CONCURRENCY,
+            help="Number of jobs to run at the same time",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.JOB_WORKER_POLL_INTERVAL,
+            help="Seconds to wait before polling again when the queue is empty",
+        )
+        parser.add_argument(
+            "--stale-after",
+            type=int,
+            default=settings.JOB_STALE_AFTER_SECONDS,
+            help="Seconds after which a running job is assumed to have lost its worker and is claimed again",
+        )
+        parser.add_argument(
+            "--burst", action="store_true", help="Exit once there are no more jobs due instead of waiting for more"
+        )
+
+    def handle(self, *args, **options):
+        self.stopping = threading.Event()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        concurrency = max(1, options["concurrency"])
+        stale_after = timedelta(seconds=options["stale_after"])
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+        for job in Job.schedule_periodic():
+            self.stdout.write(f"Scheduled periodic task {job.task}")
+
+        threads = [
+            threading.Thread(
+                target=self.work,
+                args=(f"{prefix}:{n}", options["poll_interval"], stale_after, options["burst"]),
+                name=f"worker-{n}",
+            )
+            for n in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+
+        self.stdout.write(f"Started {concurrency} worker(s)")
+
+        # wait with a timeout so the main thread stays responsive to signals
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+
+        self.stdout.write("Stopped")
+
+    def stop(self, signum, frame):
+        self.stdout.write("Stopping after current jobs...")
+        self.stopping.set()
+
+    def work(self, worker, poll_interval, stale_after, burst):
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+
+                job = Job.claim(worker, stale_after)
+                if job is None:
+                    if burst:
+                        return
+                    self.stopping.wait(poll_interval)
+                    continue
+
+                logger.info("%s running job #%d (%s), attempt %d", worker, job.id, job.task, job.attempts)
+                job.run()
+        finally:
+            connection.close()
@@ -1,5 +1,10 @@
+from django.conf import settings
+
+from gluon.anacreon.routers import REPLICA_PIN_COOKIE, pin_to_primary, replica_reads
 from gluon.utils.utils import set_current_user
 
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
 
 class CurrentUserMiddleware:
     def __init__(self, get_response):
@@ -9,3 +14,25 @@ class CurrentUserMiddleware:
         set_current_user(request.user)
         response = self.get_response(request)
         return response
+
+
+class ReplicaReadsMiddleware:
+    """
+    Lets safe requests read from replicas, except for clients who have written recently. Those are pinned to the
+    primary for REPLICA_PIN_SECONDS by cookie, and by user for clients which don't keep cookies.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        is_write = request.method not in SAFE_METHODS
+
+        with replica_reads(primary=is_write or REPLICA_PIN_COOKIE in request.COOKIES):
+            response = self.get_response(request)
+
+        if is_write and response.status_code < 400:
+            response.set_cookie(REPLICA_PIN_COOKIE, "1", max_age=settings.REPLICA_PIN_SECONDS, httponly=True)
+            pin_to_primary(getattr(request, "user", None))
+
+        return response
@@ -0,0 +1,115 @@
+from django.db import migrations
+
+CREATE_PARTITIONS_FUNCTION = """
+CREATE OR REPLACE FUNCTION anacreon_auditlog_create_partitions(from_month date, to_month date) RETURNS integer AS $$
+DECLARE
+    month date := date_trunc('month', from_month)::date;
+    partition_name text;
+    created integer := 0;
+BEGIN
+    WHILE month <= to_month LOOP
+        partition_name := 'anacreon_auditlog_' || to_char(month, '"y"YYYY"m"MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF anacreon_auditlog FOR VALUES FROM (%L) TO (%L)',
+                partition_name,
+                month::timestamp AT TIME ZONE 'UTC',
+                (month + interval '1 month')::timestamp AT TIME ZONE 'UTC'
+            );
+            created := created + 1;
+        END IF;
+        month := (month + interval '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+PARTITION_SQL = """
+ALTER TABLE anacreon_auditlog RENAME TO anacreon_auditlog_unpartitioned;
+
+CREATE TABLE anacreon_auditlog (
+    id bigint NOT NULL,
+    action varchar(10) NOT NULL,
+    model varchar(50) NOT NULL,
+    object_id integer NOT NULL CHECK (object_id >= 0),
+    details jsonb NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    business_id bigint NOT NULL REFERENCES anacreon_business (id) DEFERRABLE INITIALLY DEFERRED,
+    user_id integer NULL REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED,
+    PRIMARY KEY (id, "timestamp")
+) PARTITION BY RANGE ("timestamp");
+
+CREATE TABLE anacreon_auditlog_default PARTITION OF anacreon_auditlog DEFAULT;
+
+%(function)s
+
+SELECT anacreon_auditlog_create_partitions(
+    COALESCE((SELECT min("timestamp") FROM anacreon_auditlog_unpartitioned), now())::date,
+    (now() + interval '3 months')::date
+);
+
+INSERT INTO anacreon_auditlog (id, action, model, object_id, details, "timestamp", business_id, user_id)
+SELECT id, action, model, object_id, details, "timestamp", business_id, user_id FROM anacreon_auditlog_unpartitioned;
+
+DROP TABLE anacreon_auditlog_unpartitioned;
+
+CREATE SEQUENCE anacreon_auditlog_id_seq OWNED BY anacreon_auditlog.id;
+ALTER TABLE anacreon_auditlog ALTER COLUMN id SET DEFAULT nextval('anacreon_auditlog_id_seq');
+SELECT setval('anacreon_auditlog_id_seq', COALESCE((SELECT max(id) FROM anacreon_auditlog), 0) + 1, false);
+
+CREATE INDEX anacreon_auditlog_business_id_idx ON anacreon_auditlog (business_id);
+CREATE INDEX anacreon_auditlog_user_id_idx ON anacreon_auditlog (user_id);
+""" % {"function": CREATE_PARTITIONS_FUNCTION}
+
+UNPARTITION_SQL = """
+ALTER TABLE anacreon_auditlog RENAME TO anacreon_auditlog_partitioned;
+ALTER SEQUENCE anacreon_auditlog_id_seq RENAME TO anacreon_auditlog_partitioned_id_seq;
+
+CREATE TABLE anacreon_auditlog (
+    id bigint NOT NULL PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
+    action varchar(10) NOT NULL,
+    model varchar(50) NOT NULL,
+    object_id integer NOT NULL CHECK (object_id >= 0),
+    details jsonb NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    business_id bigint NOT NULL REFERENCES anacreon_business (id) DEFERRABLE INITIALLY DEFERRED,
+    user_id integer NULL REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED
+);
+
+INSERT INTO anacreon_auditlog (id, action, model, object_id, details, "timestamp", business_id, user_id)
+SELECT id, action, model, object_id, details, "timestamp", business_id, user_id FROM anacreon_auditlog_partitioned;
+
+SELECT setval(pg_get_serial_sequence('anacreon_auditlog', 'id'), COALESCE((SELECT max(id) FROM anacreon_auditlog), 0) + 1, false);
+
+DROP TABLE anacreon_auditlog_partitioned;
+DROP FUNCTION anacreon_auditlog_create_partitions(date, date);
+
+CREATE INDEX anacreon_auditlog_business_id_idx ON anacreon_auditlog (business_id);
+CREATE INDEX anacreon_auditlog_user_id_idx ON anacreon_auditlog (user_id);
+"""
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(PARTITION_SQL, params=None)
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(UNPARTITION_SQL, params=None)
+
+
+class Migration(migrations.Migration):
+    """
+    Converts the audit log into a table partitioned by month on timestamp. Postgres requires the partition key in the
+    primary key, so the table's key becomes (id, timestamp) with ids still coming from a sequence.
+    """
+
+    dependencies = [
+        ("anacreon", "0002_job"),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
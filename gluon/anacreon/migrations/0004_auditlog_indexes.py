@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anacreon', '0003_partition_auditlog'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['business', 'model', 'object_id', '-timestamp'], name='auditlog_object_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['business', '-timestamp'], name='auditlog_business_time_idx'),
+        ),
+        # covered by the two indexes above
+        migrations.RunSQL(
+            "DROP INDEX IF EXISTS anacreon_auditlog_business_id_idx",
+            "CREATE INDEX IF NOT EXISTS anacreon_auditlog_business_id_idx ON anacreon_auditlog (business_id)",
+        ),
+    ]
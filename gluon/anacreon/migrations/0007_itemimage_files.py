@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anacreon', '0006_modified_on_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='itemimage',
+            name='checksum',
+            field=models.CharField(blank=True, help_text='The SHA-256 of the image content', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='itemimage',
+            name='file',
+            field=models.FileField(blank=True, help_text='The content of images stored as files', max_length=255, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='itemimage',
+            name='thumbnail',
+            field=models.FileField(blank=True, max_length=255, upload_to=''),
+        ),
+        migrations.AlterField(
+            model_name='itemimage',
+            name='image',
+            field=models.TextField(blank=True, help_text='The base64 content of images stored in the database'),
+        ),
+    ]
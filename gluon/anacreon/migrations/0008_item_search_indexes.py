@@ -0,0 +1,40 @@
+from django.db import migrations
+
+CREATE_INDEXES_SQL = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX item_name_trgm_idx ON anacreon_item USING gin (name gin_trgm_ops);
+CREATE INDEX item_sku_trgm_idx ON anacreon_item USING gin (sku gin_trgm_ops);
+CREATE INDEX item_search_vector_idx ON anacreon_item USING gin ((to_tsvector('simple', name || ' ' || sku || ' ' || description)));
+"""
+
+DROP_INDEXES_SQL = """
+DROP INDEX IF EXISTS item_name_trgm_idx;
+DROP INDEX IF EXISTS item_sku_trgm_idx;
+DROP INDEX IF EXISTS item_search_vector_idx;
+"""
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(CREATE_INDEXES_SQL, params=None)
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(DROP_INDEXES_SQL, params=None)
+
+
+class Migration(migrations.Migration):
+    """
+    Adds the trigram indexes on item name and sku, and the full-text index over name, sku and description, which item
+    search matches against. The pg_trgm extension is created if needed, which requires a role allowed to do so.
+    """
+
+    dependencies = [
+        ("anacreon", "0007_itemimage_files"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
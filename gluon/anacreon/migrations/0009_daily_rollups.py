@@ -0,0 +1,44 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anacreon', '0008_item_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyExpenditure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('category', models.CharField(max_length=255)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('count', models.IntegerField(default=0)),
+                ('business', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_expenditures', to='anacreon.business')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('business', 'day', 'category'), name='daily_expend_business_day_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('units_sold', models.BigIntegerField(default=0)),
+                ('cost_of_goods', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('orders', models.IntegerField(default=0)),
+                ('cancelled_orders', models.IntegerField(default=0)),
+                ('business', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='anacreon.business')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('business', 'day'), name='daily_sales_business_day_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:59
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anacreon', '0010_stock_latest_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expenditure',
+            index=models.Index(fields=['business', 'spent_at'], include=('category', 'amount'), name='expend_business_spent_idx'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+from django.db import migrations, models
+
+CREATE_VIEW_SQL = """
+CREATE MATERIALIZED VIEW anacreon_itemsales AS
+SELECT
+    oi.item_id,
+    o.business_id,
+    w.days AS window_days,
+    sum(oi.quantity)::bigint AS units_sold,
+    sum(oi.quantity * oi.selling_price)::numeric(16, 2) AS revenue,
+    count(DISTINCT o.id)::integer AS orders,
+    sum(oi.quantity)::double precision / w.days AS velocity,
+    now() AS refreshed_at
+FROM (VALUES (7), (30), (90)) AS w (days)
+JOIN anacreon_order o ON o.status = 'completed' AND o.completed_at >= now() - w.days * interval '1 day'
+JOIN anacreon_orderitem oi ON oi.order_id = o.id
+GROUP BY oi.item_id, o.business_id, w.days;
+
+CREATE UNIQUE INDEX itemsales_item_window_uniq ON anacreon_itemsales (item_id, window_days);
+CREATE INDEX itemsales_business_window_idx ON anacreon_itemsales (business_id, window_days);
+"""
+
+DROP_VIEW_SQL = "DROP MATERIALIZED VIEW IF EXISTS anacreon_itemsales"
+
+
+def create_view(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(CREATE_VIEW_SQL, params=None)
+    else:
+        schema_editor.create_model(apps.get_model("anacreon", "ItemSales"))
+
+
+def drop_view(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(DROP_VIEW_SQL, params=None)
+    else:
+        schema_editor.delete_model(apps.get_model("anacreon", "ItemSales"))
+
+
+class Migration(migrations.Migration):
+    """
+    Adds the per item sales over the last 7, 30 and 90 days that top sellers are read from. On PostgreSQL this is a
+    materialized view, which needs the unique index to be refreshed concurrently, and elsewhere a plain table.
+    """
+
+    dependencies = [
+        ("anacreon", "0011_expenditure_spent_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ItemSales",
+            fields=[
+                ("pk", models.CompositePrimaryKey("item", "window_days", blank=True, editable=False, primary_key=True,
+                                                  serialize=False)),
+                ("item", models.ForeignKey(db_constraint=False, on_delete=models.deletion.DO_NOTHING,
+                                           related_name="+", to="anacreon.item")),
+                ("business", models.ForeignKey(db_constraint=False, on_delete=models.deletion.DO_NOTHING,
+                                               related_name="+", to="anacreon.business")),
+                ("window_days", models.IntegerField()),
+                ("units_sold", models.BigIntegerField()),
+                ("revenue", models.DecimalField(decimal_places=2, max_digits=16)),
+                ("orders", models.IntegerField()),
+                ("velocity", models.FloatField()),
+                ("refreshed_at", models.DateTimeField()),
+            ],
+            options={
+                "db_table": "anacreon_itemsales",
+                "managed": False,
+            },
+        ),
+        migrations.RunPython(create_view, drop_view),
+    ]
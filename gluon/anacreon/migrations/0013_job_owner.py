@@ -0,0 +1,44 @@
+# Generated by Django 5.2.5 on 2026-10-18 09:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_order_job_businesses(apps, schema_editor):
+    """
+    Gives existing order processing jobs the business of their order, so they stay visible to its users
+    """
+    Job = apps.get_model("anacreon", "Job")
+    Order = apps.get_model("anacreon", "Order")
+
+    jobs = list(Job.objects.filter(task="process_order", business=None))
+    orders = Order.objects.in_bulk({job.payload.get("order_id") for job in jobs} - {None})
+    for job in jobs:
+        order = orders.get(job.payload.get("order_id"))
+        if order:
+            job.business_id = order.business_id
+
+    Job.objects.bulk_update([job for job in jobs if job.business_id], ["business"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('anacreon', '0012_itemsales'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='business',
+            field=models.ForeignKey(blank=True, help_text='The business this job works on, if any', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='anacreon.business'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='created_by',
+            field=models.ForeignKey(blank=True, help_text='The user who queued this job, if any', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(set_order_job_businesses, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.db import migrations
+
+# as installed by 0003, but rows of the month which are in the default partition are moved into the new partition, as
+# Postgres won't create a partition over rows the default partition holds
+CREATE_PARTITIONS_FUNCTION = """
+CREATE OR REPLACE FUNCTION anacreon_auditlog_create_partitions(from_month date, to_month date) RETURNS integer AS $$
+DECLARE
+    month date := date_trunc('month', from_month)::date;
+    month_start timestamptz;
+    month_end timestamptz;
+    partition_name text;
+    created integer := 0;
+BEGIN
+    WHILE month <= to_month LOOP
+        partition_name := 'anacreon_auditlog_' || to_char(month, '"y"YYYY"m"MM');
+        month_start := month::timestamp AT TIME ZONE 'UTC';
+        month_end := (month + interval '1 month')::timestamp AT TIME ZONE 'UTC';
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I (LIKE anacreon_auditlog INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name
+            );
+            EXECUTE format(
+                'WITH moved AS ('
+                '    DELETE FROM anacreon_auditlog_default WHERE "timestamp" >= %L AND "timestamp" < %L RETURNING *'
+                ') INSERT INTO %I SELECT * FROM moved',
+                month_start,
+                month_end,
+                partition_name
+            );
+            EXECUTE format(
+                'ALTER TABLE anacreon_auditlog ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                partition_name,
+                month_start,
+                month_end
+            );
+            created := created + 1;
+        END IF;
+        month := (month + interval '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# 0003 created partitions up to three months ahead whatever AUDIT_LOG_PARTITIONS_AHEAD was, so create the ones the
+# setting asks for, along with partitions for the months of any rows which have ended up in the default partition
+CREATE_PARTITIONS_SQL = """
+SELECT anacreon_auditlog_create_partitions(
+    LEAST(now(), (SELECT min("timestamp") FROM anacreon_auditlog_default))::date,
+    GREATEST(
+        date_trunc('month', now()) + make_interval(months => %s),
+        (SELECT max("timestamp") FROM anacreon_auditlog_default)
+    )::date
+)
+"""
+
+
+def create_partitions(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(CREATE_PARTITIONS_FUNCTION, params=None)
+        schema_editor.execute(CREATE_PARTITIONS_SQL, params=[settings.AUDIT_LOG_PARTITIONS_AHEAD])
+
+
+class Migration(migrations.Migration):
+    """
+    Lets anacreon_auditlog_create_partitions create partitions for months which already have rows in the default
+    partition, by moving those rows into the new partition as it is created, and then creates the partitions
+    AUDIT_LOG_PARTITIONS_AHEAD asks for, draining the default partition on the way. Reversing keeps the partitions and
+    this definition, which has the same signature and only behaves differently when the default partition has rows.
+    """
+
+    dependencies = [
+        ("anacreon", "0013_job_owner"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_partitions, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,13 @@
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDate, TruncMonth, TruncYear
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
 from django.utils import timezone
+from PIL import Image as PILImage, UnidentifiedImageError
 
 try:
     from django.db.models import JSONField  # Django 3.1+
@@ -11,6 +17,66 @@ except ImportError:
 from gluon.utils.utils import get_current_user
 from gluon.anacreon.base import SmartModel
 import base64
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+import tempfile
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+
+def _case_by_id(values, output_field):
+    """
+    Builds a CASE expression mapping row ids to values so that many rows can be given different values in a single
+    UPDATE statement
+    """
+    return Case(*[When(id=key, then=Value(value)) for key, value in values.items()], output_field=output_field)
+
+
+def _add_to_rows(model, keys, rows):
+    """
+    Adds the values of rows, dicts of key and value columns, to the existing rows of the model with the same keys and
+    inserts the rest, all in a single INSERT .. ON CONFLICT statement so concurrent additions to a row can't be lost
+    """
+    if not rows:
+        return
+
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    columns = list(rows[0])
+    values = [column for column in columns if column not in keys]
+
+    placeholders = ", ".join(["(%s)" % ", ".join(["%s"] * len(columns))] * len(rows))
+    sql = "INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s) DO UPDATE SET %s" % (
+        table,
+        ", ".join(quote(column) for column in columns),
+        placeholders,
+        ", ".join(quote(column) for column in keys),
+        ", ".join(f"{quote(column)} = {table}.{quote(column)} + EXCLUDED.{quote(column)}" for column in values),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [row[column] for row in rows for column in columns])
+
+
+def rollup_time_zone():
+    return ZoneInfo(settings.USER_TIME_ZONE)
+
+
+def rollup_day(moment):
+    """
+    Gets the day the given time falls on for daily rollups, which follow USER_TIME_ZONE
+    """
+    return timezone.localtime(moment, rollup_time_zone()).date()
+
+
+def rollup_day_start(day):
+    return datetime.combine(day, time.min, tzinfo=rollup_time_zone())
 
 
 class Business(SmartModel):
@@ -19,6 +85,11 @@ class Business(SmartModel):
 
     # created_at, updated_at, created_by, modified_by, etc. are inherited
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["modified_on"], name="business_modified_idx"),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -81,16 +152,22 @@ class Item(SmartModel):
 
     # created_by, modified_by, etc. are inherited
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["business", "created_on", "id"], name="item_business_created_idx"),
+            models.Index(fields=["business", "modified_on"], name="item_business_modified_idx"),
+        ]
+
     def __str__(self):
         return self.name
 
     def set_property(self, key, value):
         self.properties[key] = value
-        self.save(update_fields=['properties'])
+        self.save(update_fields=['properties', 'modified_on'])
 
     def update_properties(self, **kwargs):
         self.properties.update(kwargs)
-        self.save(update_fields=['properties'])
+        self.save(update_fields=['properties', 'modified_on'])
 
     def get_property(self, key, default=None):
         return self.properties.get(key, default)
@@ -99,44 +176,228 @@ class Item(SmartModel):
     def filter_by_property(cls, key, value):
         return cls.objects.filter(properties__has_key=key, properties__contains={key: value})
 
+    @classmethod
+    def restock(cls, quantities):
+        """
+        Puts the given quantities, a dict of item id to quantity, back on the shelf with a single UPDATE
+        """
+        if not quantities:
+            return
+
+        from .signals import invalidate_catalog_cache
+
+        with transaction.atomic():
+            # take the row locks in id order, same as Order.process_order, so the two can't deadlock
+            business_ids = set(
+                cls.objects.select_for_update().filter(id__in=quantities).order_by("id").values_list(
+                    "business_id", flat=True
+                )
+            )
+            invalidate_catalog_cache(business_ids)
+            cls.objects.filter(id__in=quantities).update(
+                quantity=F("quantity") + _case_by_id(quantities, models.PositiveIntegerField()),
+                modified_on=timezone.now(),
+            )
+
+
+class InvalidImageError(Exception):
+    pass
+
+
+# offset, signature and mimetype of the image formats we can recognise from their first bytes
+IMAGE_SIGNATURES = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (4, b"ftypheic", "image/heic"),
+    (4, b"ftypheix", "image/heic"),
+    (4, b"ftypmif1", "image/heic"),
+)
+IMAGE_SIGNATURE_BYTES = 12
+
 
 class ItemImage(models.Model):
+    """
+    An image of an item. Depending on ITEM_IMAGE_STORAGE images are saved as files under MEDIA_ROOT named by their
+    SHA-256, so identical images share a file and a file never changes, or as base64 in the database.
+    """
+
     item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='images')
-    image = models.TextField()
+    image = models.TextField(blank=True, help_text="The base64 content of images stored in the database")
+    file = models.FileField(max_length=255, blank=True, help_text="The content of images stored as files")
+    thumbnail = models.FileField(max_length=255, blank=True)
+    checksum = models.CharField(max_length=64, blank=True, help_text="The SHA-256 of the image content")
     mimetype = models.CharField(max_length=20)
     color = models.CharField(max_length=100, blank=True)
 
     def __str__(self):
         return f"Image for {self.item.name} ({self.color})"
 
+    @staticmethod
+    def get_content_path(checksum, extension) -> str:
+        return f"{settings.ITEM_IMAGE_DIR}/{checksum[:2]}/{checksum}{extension}"
+
+    @classmethod
+    def store_content(cls, content: bytes, mimetype) -> dict:
+        """
+        Saves image content as a file named by its checksum, along with a thumbnail, returning the fields to create the
+        image with. Content that is already stored isn't written again.
+        """
+        checksum = hashlib.sha256(content).hexdigest()
+        path = cls.get_content_path(checksum, mimetypes.guess_extension(mimetype) or "")
+        if not default_storage.exists(path):
+            path = default_storage.save(path, ContentFile(content))
+
+        return {"file": path, "thumbnail": cls.store_thumbnail(checksum, io.BytesIO(content)), "checksum": checksum}
+
+    @classmethod
+    def store_thumbnail(cls, checksum, source) -> str:
+        """
+        Saves a thumbnail no bigger than ITEM_IMAGE_THUMBNAIL_SIZE of the image in the given path or file, returning its
+        path, or an empty string if the source can't be read as an image
+        """
+        path = cls.get_content_path(checksum, ".thumb.webp")
+        if default_storage.exists(path):
+            return path
+
+        try:
+            with PILImage.open(source) as image:
+                # let JPEGs decode straight to about the thumbnail size rather than to full size
+                image.draft("RGB", settings.ITEM_IMAGE_THUMBNAIL_SIZE)
+                image.thumbnail(settings.ITEM_IMAGE_THUMBNAIL_SIZE)
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA")
+
+                out = io.BytesIO()
+                image.save(out, "WEBP", quality=80)
+        except (UnidentifiedImageError, PILImage.DecompressionBombError, OSError, ValueError) as e:
+            logger.warning("Unable to make thumbnail of image %s: %s", checksum, e)
+            return ""
+
+        return default_storage.save(path, ContentFile(out.getvalue()))
+
+    @staticmethod
+    def check_type(head: bytes) -> str:
+        """
+        Gets the mimetype of an image from its first bytes, raising InvalidImageError if it isn't one we accept
+        """
+        for offset, signature, mimetype in IMAGE_SIGNATURES:
+            if head[offset:offset + len(signature)] == signature and mimetype in settings.ITEM_IMAGE_TYPES:
+                return mimetype
+
+        raise InvalidImageError(f"Images must be one of {', '.join(settings.ITEM_IMAGE_TYPES)}")
+
+    @classmethod
+    def stream_upload(cls, f, out) -> tuple[str, str]:
+        """
+        Copies an upload to the given file object a chunk at a time, hashing it and checking its size and type as it
+        goes, and returns its checksum and mimetype
+        """
+        chunk_size = settings.ITEM_IMAGE_CHUNK_BYTES
+        chunks = f.chunks(chunk_size) if hasattr(f, "chunks") else iter(lambda: f.read(chunk_size), b"")
+
+        digest, size, head, mimetype = hashlib.sha256(), 0, b"", None
+        for chunk in chunks:
+            size += len(chunk)
+            if size > settings.ITEM_IMAGE_MAX_BYTES:
+                raise InvalidImageError(f"Images can't be larger than {settings.ITEM_IMAGE_MAX_BYTES} bytes")
+
+            if mimetype is None and len(head) < IMAGE_SIGNATURE_BYTES:
+                head += chunk[:IMAGE_SIGNATURE_BYTES - len(head)]
+                if len(head) == IMAGE_SIGNATURE_BYTES:
+                    mimetype = cls.check_type(head)
+
+            digest.update(chunk)
+            out.write(chunk)
+
+        return digest.hexdigest(), mimetype or cls.check_type(head)
+
+    @classmethod
+    def store_upload(cls, f) -> dict:
+        """
+        Streams an upload to a temporary file in MEDIA_ROOT and then renames it to the path named by its checksum,
+        returning the fields to create the image with
+        """
+        incoming = os.path.join(settings.MEDIA_ROOT, settings.ITEM_IMAGE_DIR, "incoming")
+        os.makedirs(incoming, exist_ok=True)
+
+        out = tempfile.NamedTemporaryFile(dir=incoming, delete=False)
+        try:
+            with out:
+                checksum, mimetype = cls.stream_upload(f, out)
+        except BaseException:
+            os.unlink(out.name)
+            raise
+
+        path = cls.get_content_path(checksum, mimetypes.guess_extension(mimetype) or "")
+        destination = default_storage.path(path)
+        if default_storage.exists(path):
+            os.unlink(out.name)
+        else:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(out.name, destination)
+            if default_storage.file_permissions_mode is not None:
+                os.chmod(destination, default_storage.file_permissions_mode)
+
+        return {
+            "file": path,
+            "thumbnail": cls.store_thumbnail(checksum, destination),
+            "checksum": checksum,
+            "mimetype": mimetype,
+        }
+
+    @classmethod
+    def encode_upload(cls, f) -> dict:
+        """
+        Reads an upload as base64 to store in the database, which needs the whole image in memory
+        """
+        out = io.BytesIO()
+        checksum, mimetype = cls.stream_upload(f, out)
+
+        return {"image": base64.b64encode(out.getbuffer()).decode('utf-8'), "checksum": checksum, "mimetype": mimetype}
+
     @classmethod
     def process_files(cls, files, color=None):
         """
-        Accepts a file or list of files (Django UploadedFile or file-like objects),
-        returns a list of dicts: {image: base64, mimetype: ..., color: ..., description: ...}
+        Accepts a file or list of files (Django UploadedFile or file-like objects) and stores them one at a time,
+        reading each in chunks so memory use doesn't grow with the size or number of files. Returns a list of dicts of
+        the fields to create each image with: {file: ..., mimetype: ..., color: ...}. Raises InvalidImageError if a
+        file is too big or isn't an image type we accept.
         """
         if not isinstance(files, (list, tuple)):
             files = [files]
         results = []
         for f in files:
-            # Read file content and encode to base64
-            content = f.read()
-            if hasattr(f, 'content_type'):
-                mimetype = f.content_type
+            if settings.ITEM_IMAGE_STORAGE == "file":
+                result = cls.store_upload(f)
             else:
-                mimetype = 'application/octet-stream'
-            b64 = base64.b64encode(content).decode('utf-8')
-            result = {
-                'image': b64,
-                'mimetype': mimetype,
-            }
+                result = cls.encode_upload(f)
             if color:
                 result['color'] = color
             results.append(result)
         return results
 
+    def get_url(self) -> str:
+        """
+        Gets the URL of this image's content. Files never change so they can be cached forever.
+        """
+        if self.file:
+            return self.file.url
+
+        return reverse("anacreon.item_image", args=[self.id])
+
+    def get_thumbnail_url(self) -> str | None:
+        return self.thumbnail.url if self.thumbnail else None
+
 
 class AuditLog(models.Model):
+    """
+    Partitioned by month on timestamp in the database (see migration 0003 and gluon.anacreon.partitions), so queries
+    should bound timestamp where they can to only touch the recent partitions.
+    """
+
     ACTION_CHOICES = [
         ("read", "Read"),
         ("create", "Create"),
@@ -151,6 +412,14 @@ class AuditLog(models.Model):
     details = models.JSONField(default=dict, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # history of a single object
+            models.Index(fields=["business", "model", "object_id", "-timestamp"], name="auditlog_object_idx"),
+            # recent activity across a business
+            models.Index(fields=["business", "-timestamp"], name="auditlog_business_time_idx"),
+        ]
+
     def __str__(self):
         return f"{self.timestamp} {self.action} {self.model} {self.object_id}"
 
@@ -167,6 +436,13 @@ class Stock(SmartModel):
 
     # created_by, modified_by, etc. are inherited
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_on", "id"], name="stock_created_idx"),
+            models.Index(fields=["item", "modified_on"], name="stock_item_modified_idx"),
+            models.Index(fields=["item", "-recorded_at", "-id"], name="stock_item_recorded_idx"),
+        ]
+
     def __str__(self):
         return f"{self.item.name} - {self.quantity} units"
 
@@ -195,6 +471,34 @@ class Stock(SmartModel):
         stock = cls.objects.filter(item=item).order_by('-recorded_at').first()
         return stock
 
+    @classmethod
+    def read_latest_stock(cls, items=None, business=None):
+        """
+        Gets the latest stock entry of each of the given items, or of every item of the given business, as a dict of
+        item id to entry, with a single query however many items there are
+        """
+        queryset = cls.objects.all()
+        if items is not None:
+            queryset = queryset.filter(item__in=items)
+        if business is not None:
+            queryset = queryset.filter(item__business=business)
+
+        return {stock.item_id: stock for stock in cls.latest(queryset)}
+
+    @classmethod
+    def latest(cls, queryset):
+        """
+        Narrows a queryset of stock entries to the latest entry of each item. On PostgreSQL this is a DISTINCT ON query
+        which walks the stock_item_recorded_idx index, so the result can't be reordered.
+        """
+        if connections[queryset.db].vendor == "postgresql":
+            return queryset.order_by("item_id", "-recorded_at", "-id").distinct("item_id")
+
+        newer = cls.objects.filter(item_id=OuterRef("item_id")).filter(
+            Q(recorded_at__gt=OuterRef("recorded_at")) | Q(recorded_at=OuterRef("recorded_at"), id__gt=OuterRef("id"))
+        )
+        return queryset.exclude(Exists(newer))
+
 
 class Expenditure(SmartModel):
     business = models.ForeignKey(Business, on_delete=models.CASCADE, related_name='expenditures')
@@ -206,6 +510,16 @@ class Expenditure(SmartModel):
 
     # created_by, modified_by, etc. are inherited
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["business", "created_on", "id"], name="expend_business_created_idx"),
+            models.Index(fields=["business", "modified_on"], name="expend_business_modified_idx"),
+            # covers expenditure analytics, which PostgreSQL can then aggregate from the index alone
+            models.Index(
+                fields=["business", "spent_at"], include=["category", "amount"], name="expend_business_spent_idx"
+            ),
+        ]
+
     def __str__(self):
         return f"{self.category}: {self.amount} for {self.business.name}"
 
@@ -251,54 +565,223 @@ class Order(SmartModel):
     notes = models.TextField(blank=True)
     total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
 
+    # lines to record in the audit log when this order is next saved, saves the audit signal from loading them
+    audit_lines = None
+
     # created_by, modified_by, etc. are inherited
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["business", "created_on", "id"], name="order_business_created_idx"),
+            models.Index(fields=["business", "modified_on"], name="order_business_modified_idx"),
+        ]
+
     def __str__(self):
         return f"Order #{self.id} for {self.business.name} ({self.status})"
 
+    @classmethod
+    def place_order(cls, business, lines, customer=None, notes="", user=None):
+        """
+        Creates an order with all its lines, lines being dicts of item, quantity and selling_price. The total is worked
+        out from the lines themselves so the order is written once and the lines are inserted together.
+        """
+        user = user or get_current_user()
+        total = sum((line["quantity"] * line["selling_price"] for line in lines), Decimal(0))
+        order = cls(
+            business=business,
+            customer=customer,
+            notes=notes,
+            total=total,
+            placed_by=user,
+            created_by=user,
+            modified_by=user,
+        )
+        order.audit_lines = [
+            {
+                "item": line["item"].name,
+                "quantity": line["quantity"],
+                "selling_price": str(line["selling_price"]),
+            } for line in lines
+        ]
+        order.save(force_insert=True)
+        order.audit_lines = None
+
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                item=line["item"],
+                quantity=line["quantity"],
+                selling_price=line["selling_price"]
+            ) for line in lines
+        ])
+        return order
+
     def calculate_total(self):
         total = sum([oi.quantity * oi.selling_price for oi in self.items.all()])
         self.total = total
-        self.save(update_fields=['total'])
+        self.save(update_fields=['total', 'modified_on'])
         return total
 
     def complete(self):
-        self.status = OrderStatus.COMPLETED
-        self.completed_at = timezone.now()
-        self.save(update_fields=['status', 'completed_at'])
+        with transaction.atomic():
+            # as when cancelling, the sales rollups go by the status of the locked row rather than of this instance
+            status, completed_at, cancelled_at = Order.objects.select_for_update().filter(id=self.id).values_list(
+                "status", "completed_at", "cancelled_at").get()
+            if status == OrderStatus.COMPLETED:
+                self.status, self.completed_at = status, completed_at
+                return
+
+            self.status = OrderStatus.COMPLETED
+            self.completed_at = timezone.now()
+            self.cancelled_at = cancelled_at
+            self.save(update_fields=['status', 'completed_at', 'modified_on'])
+            DailySales.record_completed([self], uncancelled=[self] if status == OrderStatus.CANCELLED else [])
 
     def cancel(self):
-        if self.status == OrderStatus.CANCELLED:
-            return
-        self.status = OrderStatus.CANCELLED
-        self.cancelled_at = timezone.now()
-        self.save(update_fields=['status', 'cancelled_at'])
-        # Restock items
-        for order_item in self.items.all():
-            item = order_item.item
-            item.quantity += order_item.quantity
-            item.save(update_fields=['quantity'])
+        with transaction.atomic():
+            # lock our own row and go by its current status, so the lines are only restocked by one cancellation even
+            # when this instance is stale or the order is being cancelled elsewhere at the same time
+            status, completed_at, cancelled_at = Order.objects.select_for_update().filter(id=self.id).values_list(
+                "status", "completed_at", "cancelled_at").get()
+            if status == OrderStatus.CANCELLED:
+                self.status, self.cancelled_at = status, cancelled_at
+                return
+
+            was_completed = status == OrderStatus.COMPLETED
+            self.status = OrderStatus.CANCELLED
+            self.completed_at = completed_at  # the sales of its day are the ones taken back out
+            self.cancelled_at = timezone.now()
+            self.save(update_fields=['status', 'cancelled_at', 'modified_on'])
+            DailySales.record_cancelled([self], [self] if was_completed else [])
+            # Restock items
+            Item.restock(dict(self.items.order_by().values_list("item_id").annotate(quantity=Sum("quantity"))))
+
+    @classmethod
+    def bulk_complete(cls, order_ids):
+        """
+        Completes all the given orders which are still pending, returning the ids of the orders that were completed
+        """
+        return cls._bulk_transition(order_ids, OrderStatus.COMPLETED, "completed_at", [OrderStatus.PENDING])
+
+    @classmethod
+    def bulk_cancel(cls, order_ids):
+        """
+        Cancels all the given orders which aren't already cancelled and restocks their lines, returning the ids of the
+        orders that were cancelled
+        """
+        return cls._bulk_transition(
+            order_ids, OrderStatus.CANCELLED, "cancelled_at", [OrderStatus.PENDING, OrderStatus.COMPLETED], restock=True
+        )
+
+    @classmethod
+    def _bulk_transition(cls, order_ids, status, timestamp_field, from_statuses, restock=False):
+        from .signals import get_audit_details, queue_audit_logs
+
+        now = timezone.now()
+
+        with transaction.atomic():
+            orders = list(
+                cls.objects.select_for_update(of=("self",))
+                .select_related("customer")
+                .filter(id__in=order_ids, status__in=from_statuses)
+                .order_by("id")
+            )
+            if not orders:
+                return []
+
+            ids = [order.id for order in orders]
+            cls.objects.filter(id__in=ids).update(status=status, modified_on=now, **{timestamp_field: now})
+
+            lines_by_order = {order_id: [] for order_id in ids}
+            quantities = {}
+            for order_id, item_id, name, quantity, selling_price in (
+                OrderItem.objects.filter(order_id__in=ids)
+                .order_by("id")
+                .values_list("order_id", "item_id", "item__name", "quantity", "selling_price")
+            ):
+                lines_by_order[order_id].append(
+                    {"item": name, "quantity": quantity, "selling_price": str(selling_price)}
+                )
+                quantities[item_id] = quantities.get(item_id, 0) + quantity
+
+            if restock:
+                Item.restock(quantities)
+
+            if status == OrderStatus.COMPLETED:
+                DailySales.record_completed(orders, now)
+            elif status == OrderStatus.CANCELLED:
+                completed = [order for order in orders if order.status == OrderStatus.COMPLETED]
+                DailySales.record_cancelled(orders, completed, now)
+
+            # queryset updates don't fire post_save, so write the audit entries for the whole set ourselves
+            entries = []
+            for order in orders:
+                order.status = status
+                setattr(order, timestamp_field, now)
+                entries.append(
+                    AuditLog(
+                        business_id=order.business_id,
+                        user_id=order.placed_by_id,
+                        action="update",
+                        model="Order",
+                        object_id=order.id,
+                        details=get_audit_details(order, "update", lines=lines_by_order[order.id]),
+                    )
+                )
+            queue_audit_logs(entries)
+
+        return ids
 
     def process_order(self):
-        # Check stock for all items
-        for order_item in self.items.all():
-            if order_item.item.quantity < order_item.quantity:
-                return {
-                    'success': False,
-                    'error': f"Item '{order_item.item.name}' is out of stock or insufficient quantity."
-                }
-        # All items in stock, process order
-        for order_item in self.items.all():
-            item = order_item.item
-            item.quantity -= order_item.quantity
-            item.weight += order_item.quantity  # Increase weight for popularity
-            item.last_selling_price = order_item.selling_price
-            item.save(
-                update_fields=['quantity', 'weight', 'last_selling_price'])
-        self.status = OrderStatus.COMPLETED
-        self.completed_at = timezone.now()
-        self.save(
-            update_fields=['status', 'completed_at'])
+        """
+        Deducts the order's lines from stock and marks it completed. The affected items are locked, checked and
+        updated as a set so that the number of queries doesn't depend on the number of lines and concurrent orders
+        can't both sell the last unit of an item.
+        """
+        from .signals import invalidate_catalog_cache
+
+        with transaction.atomic():
+            # lock our own row so the same order can't be processed twice at once
+            status = Order.objects.select_for_update().filter(id=self.id).values_list("status", flat=True).first()
+            if status != OrderStatus.PENDING:
+                return {'success': False, 'error': f"Order #{self.id} is {status} and can't be processed."}
+
+            demand, prices = {}, {}
+            for item_id, quantity, selling_price in self.items.order_by("id").values_list(
+                    "item_id", "quantity", "selling_price"):
+                demand[item_id] = demand.get(item_id, 0) + quantity
+                prices[item_id] = selling_price  # last line wins, as when lines were saved one by one
+
+            # lock in id order so that orders sharing items can't deadlock each other
+            items = Item.objects.select_for_update().filter(id__in=demand).order_by("id").only("id", "name",
+                                                                                             "quantity")
+            stock = {item.id: item for item in items}
+
+            # Check stock for all items
+            for item_id, quantity in demand.items():
+                item = stock.get(item_id)
+                if item is None or item.quantity < quantity:
+                    name = item.name if item else item_id
+                    return {
+                        'success': False,
+                        'error': f"Item '{name}' is out of stock or insufficient quantity."
+                    }
+
+            # All items in stock, process order
+            if demand:
+                invalidate_catalog_cache([self.business_id])
+                quantities = _case_by_id(demand, models.PositiveIntegerField())
+                Item.objects.filter(id__in=demand).update(
+                    quantity=F("quantity") - quantities,
+                    weight=F("weight") + quantities,  # Increase weight for popularity
+                    last_selling_price=_case_by_id(prices, models.DecimalField(max_digits=12, decimal_places=2)),
+                    modified_on=timezone.now(),
+                )
+
+            self.status = OrderStatus.COMPLETED
+            self.completed_at = timezone.now()
+            self.save(update_fields=['status', 'completed_at', 'modified_on'])
+            DailySales.record_completed([self])
         return {'success': True}
 
 
@@ -315,3 +798,458 @@ class OrderItem(models.Model):
 
     def __str__(self):
         return f"{self.quantity} x {self.item.name} in Order #{self.order.id}"
+
+
+def _filter_days(queryset, field, start, end):
+    """
+    Filters the queryset to rows whose time field falls on the rollup days from start to end inclusive, either of which
+    can be None for no bound
+    """
+    if start:
+        queryset = queryset.filter(**{field + "__gte": rollup_day_start(start)})
+    if end:
+        queryset = queryset.filter(**{field + "__lt": rollup_day_start(end + timedelta(days=1))})
+    return queryset
+
+
+def _filter_rollup_days(queryset, start, end):
+    if start:
+        queryset = queryset.filter(day__gte=start)
+    if end:
+        queryset = queryset.filter(day__lte=end)
+    return queryset
+
+
+class DailySales(models.Model):
+    """
+    The sales of a business on a day in USER_TIME_ZONE, kept up to date as orders are completed and cancelled so that
+    reports never have to scan orders. Orders count on the day they were completed, and cost of goods uses the cost
+    price of items at the time, or their current cost price for days which have been rebuilt.
+    """
+
+    business = models.ForeignKey(Business, on_delete=models.CASCADE, related_name='daily_sales')
+    day = models.DateField()
+    revenue = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    units_sold = models.BigIntegerField(default=0)
+    cost_of_goods = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    orders = models.IntegerField(default=0)
+    cancelled_orders = models.IntegerField(default=0)
+
+    TOTALS = ("revenue", "units_sold", "cost_of_goods", "orders", "cancelled_orders")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["business", "day"], name="daily_sales_business_day_uniq"),
+        ]
+
+    def __str__(self):
+        return f"Sales of {self.business_id} on {self.day}"
+
+    @classmethod
+    def _add(cls, changes):
+        rows = [
+            {"business_id": business_id, "day": day, **{field: values.get(field, 0) for field in cls.TOTALS}}
+            for (business_id, day), values in changes.items()
+        ]
+        _add_to_rows(cls, ("business_id", "day"), rows)
+
+    @classmethod
+    def _add_orders(cls, changes, orders, sign, completed_at=None):
+        totals = {
+            row.pop("order_id"): row
+            for row in OrderItem.objects.filter(order_id__in=[order.id for order in orders])
+            .order_by()
+            .values("order_id")
+            .annotate(
+                revenue=Sum(F("quantity") * F("selling_price")),
+                units_sold=Sum("quantity"),
+                cost_of_goods=Sum(F("quantity") * F("item__cost_price")),
+            )
+        }
+        for order in orders:
+            day = rollup_day(completed_at or order.completed_at or order.placed_at)
+            values = changes.setdefault((order.business_id, day), {})
+            for field, value in totals.get(order.id, {}).items():
+                values[field] = values.get(field, 0) + sign * (value or 0)
+            values["orders"] = values.get("orders", 0) + sign
+
+    @classmethod
+    def record_completed(cls, orders, completed_at=None, uncancelled=()):
+        """
+        Adds newly completed orders to the rollups, on the day of completed_at if given or else their own completed_at.
+        Those of them in uncancelled had been cancelled, so are taken back out of the cancellations of that day.
+        """
+        changes = {}
+        cls._add_orders(changes, orders, 1, completed_at)
+        for order in uncancelled:
+            values = changes.setdefault((order.business_id, rollup_day(order.cancelled_at)), {})
+            values["cancelled_orders"] = values.get("cancelled_orders", 0) - 1
+        cls._add(changes)
+
+    @classmethod
+    def record_cancelled(cls, orders, completed, cancelled_at=None):
+        """
+        Counts newly cancelled orders on the day they were cancelled, and takes those of them which had been completed
+        back out of the sales of the day they were completed
+        """
+        changes = {}
+        cls._add_orders(changes, completed, -1)
+        for order in orders:
+            values = changes.setdefault((order.business_id, rollup_day(cancelled_at or order.cancelled_at)), {})
+            values["cancelled_orders"] = values.get("cancelled_orders", 0) + 1
+        cls._add(changes)
+
+    @classmethod
+    def rebuild(cls, business_id, start=None, end=None):
+        """
+        Recalculates the rollups of a business from its orders, for the days from start to end inclusive or for all
+        days if they're not given. Returns the number of days with sales.
+        """
+        zone = rollup_time_zone()
+        completed_on = Coalesce("completed_at", "placed_at")
+        orders = Order.objects.filter(business_id=business_id).order_by()
+        completed = _filter_days(
+            orders.filter(status=OrderStatus.COMPLETED).alias(completed_on=completed_on), "completed_on", start, end
+        )
+        cancelled = _filter_days(orders.filter(status=OrderStatus.CANCELLED), "cancelled_at", start, end)
+
+        days = {}
+        for row in completed.annotate(day=TruncDate("completed_on", tzinfo=zone)).values("day").annotate(
+                orders=Count("id")):
+            days.setdefault(row.pop("day"), {}).update(row)
+        for row in OrderItem.objects.filter(order__in=completed).order_by().annotate(
+                day=TruncDate(Coalesce("order__completed_at", "order__placed_at"), tzinfo=zone)).values("day").annotate(
+                revenue=Sum(F("quantity") * F("selling_price")),
+                units_sold=Sum("quantity"),
+                cost_of_goods=Sum(F("quantity") * F("item__cost_price"))):
+            days.setdefault(row.pop("day"), {}).update(row)
+        for row in cancelled.annotate(day=TruncDate("cancelled_at", tzinfo=zone)).values("day").annotate(
+                cancelled_orders=Count("id")):
+            days.setdefault(row.pop("day"), {}).update(row)
+
+        rollups = _filter_rollup_days(cls.objects.filter(business_id=business_id), start, end)
+
+        with transaction.atomic():
+            rollups.delete()
+            cls.objects.bulk_create(
+                [cls(business_id=business_id, day=day, **values) for day, values in sorted(days.items())],
+                batch_size=1000,
+            )
+        return len(days)
+
+    @classmethod
+    def get_summary(cls, business_id, period, start=None, end=None):
+        """
+        Totals the sales and expenditures of a business by day, month or year from the rollups alone, for the days from
+        start to end inclusive. Returns a list of periods, oldest first.
+        """
+        truncate = {"day": F, "month": TruncMonth, "year": TruncYear}[period]
+
+        def by_period(model):
+            queryset = _filter_rollup_days(model.objects.filter(business_id=business_id), start, end)
+            return queryset.annotate(period=truncate("day"))
+
+        summary = {}
+        for row in by_period(cls).values("period").annotate(**{field: Sum(field) for field in cls.TOTALS}).order_by():
+            summary[row["period"]] = row
+
+        # money totals of periods with only expenditures are still decimals, like those of periods with sales
+        empty = {
+            field: Decimal("0.00") if isinstance(cls._meta.get_field(field), models.DecimalField) else 0
+            for field in cls.TOTALS
+        }
+        for period_start, category, amount in by_period(DailyExpenditure).values("period", "category").annotate(
+                amount=Sum("amount")).values_list("period", "category", "amount").order_by("category"):
+            totals = summary.setdefault(period_start, {"period": period_start, **empty})
+            totals.setdefault("expenditures_by_category", {})[category] = amount
+
+        results = []
+        for period_start in sorted(summary):
+            totals = summary[period_start]
+            by_category = totals.pop("expenditures_by_category", {})
+            expenditures = sum(by_category.values(), Decimal("0.00"))
+            gross_profit = totals["revenue"] - totals["cost_of_goods"]
+            results.append({
+                **totals,
+                "gross_profit": gross_profit,
+                "expenditures": expenditures,
+                "expenditures_by_category": by_category,
+                "net_profit": gross_profit - expenditures,
+            })
+        return results
+
+
+class DailyExpenditure(models.Model):
+    """
+    The expenditures of a business in a category on a day in USER_TIME_ZONE, kept up to date as expenditures are
+    recorded, changed and deleted (see signals)
+    """
+
+    business = models.ForeignKey(Business, on_delete=models.CASCADE, related_name='daily_expenditures')
+    day = models.DateField()
+    category = models.CharField(max_length=255)
+    amount = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["business", "day", "category"], name="daily_expend_business_day_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.category} expenditures of {self.business_id} on {self.day}"
+
+    @classmethod
+    def record(cls, expenditure):
+        _add_to_rows(cls, ("business_id", "day", "category"), [{
+            "business_id": expenditure.business_id,
+            "day": rollup_day(expenditure.spent_at),
+            "category": expenditure.category,
+            "amount": expenditure.amount,
+            "count": 1,
+        }])
+
+    @classmethod
+    def rebuild(cls, business_id, start=None, end=None):
+        """
+        Recalculates the rollups of a business from its expenditures, for the days from start to end inclusive or for
+        all days if they're not given. Returns the number of rows written.
+        """
+        expenditures = _filter_days(Expenditure.objects.filter(business_id=business_id), "spent_at", start, end)
+        rows = [
+            cls(business_id=business_id, **row)
+            for row in expenditures.annotate(day=TruncDate("spent_at", tzinfo=rollup_time_zone()))
+            .values("day", "category")
+            .annotate(amount=Sum("amount"), count=Count("id"))
+            .order_by("day", "category")
+        ]
+
+        rollups = _filter_rollup_days(cls.objects.filter(business_id=business_id), start, end)
+
+        with transaction.atomic():
+            rollups.delete()
+            cls.objects.bulk_create(rows, batch_size=1000)
+        return len(rows)
+
+
+# days of sales ItemSales has rows for, which must match the view created by migration 0012
+ITEM_SALES_WINDOWS = (7, 30, 90)
+
+
+class ItemSales(models.Model):
+    """
+    The sales of an item by completed orders over the last 7, 30 and 90 days. On PostgreSQL this is a materialized view
+    refreshed concurrently, so reads never wait on a refresh, elsewhere it's a table refilled by refresh(). Velocity is
+    the average number of units sold per day.
+    """
+
+    pk = models.CompositePrimaryKey("item", "window_days")
+    item = models.ForeignKey(Item, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+")
+    business = models.ForeignKey(Business, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+")
+    window_days = models.IntegerField()
+    units_sold = models.BigIntegerField()
+    revenue = models.DecimalField(max_digits=16, decimal_places=2)
+    orders = models.IntegerField()
+    velocity = models.FloatField()
+    refreshed_at = models.DateTimeField()
+
+    ORDERINGS = {"revenue": "-revenue", "units": "-units_sold", "velocity": "-velocity"}
+
+    class Meta:
+        managed = False
+        db_table = "anacreon_itemsales"
+
+    def __str__(self):
+        return f"Sales of {self.item_id} over {self.window_days} days"
+
+    @classmethod
+    def refresh(cls):
+        connection = connections[router.db_for_write(cls)]
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {cls._meta.db_table}")
+            return
+
+        now = timezone.now()
+        rows = []
+        for days in ITEM_SALES_WINDOWS:
+            for row in OrderItem.objects.filter(
+                    order__status=OrderStatus.COMPLETED, order__completed_at__gte=now - timedelta(days=days)
+            ).order_by().values("item_id", business_id=F("order__business_id")).annotate(
+                    units_sold=Sum("quantity"),
+                    revenue=Sum(F("quantity") * F("selling_price")),
+                    orders=Count("order_id", distinct=True)):
+                rows.append(cls(window_days=days, velocity=row["units_sold"] / days, refreshed_at=now, **row))
+
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(rows, batch_size=1000)
+
+    @classmethod
+    def top_sellers(cls, business_id, window_days, by="revenue", limit=10):
+        """
+        Gets the best selling items of a business over one of the ITEM_SALES_WINDOWS, ordered by revenue, units or
+        velocity
+        """
+        return list(
+            cls.objects.filter(business_id=business_id, window_days=window_days)
+            .order_by(cls.ORDERINGS[by], "item_id")
+            .values("item_id", "item__name", "units_sold", "revenue", "orders", "velocity", "refreshed_at")[:limit]
+        )
+
+
+
+class JobStatus:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+
+class Job(models.Model):
+    """
+    A unit of background work, stored in the database so that it survives restarts and can be claimed by any number
+    of workers (see the worker management command). Tasks are looked up by name in gluon.anacreon.jobs.
+    """
+
+    task = models.CharField(max_length=100)
+    business = models.ForeignKey(Business, on_delete=models.CASCADE, null=True, blank=True, related_name='jobs',
+                                 help_text="The business this job works on, if any")
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs',
+                                   help_text="The user who queued this job, if any")
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=JobStatus.CHOICES, default=JobStatus.QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now, help_text="When this job becomes eligible to run")
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=255, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_on = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["run_at", "id"],
+                condition=Q(status__in=[JobStatus.QUEUED, JobStatus.RUNNING]),
+                name="job_claimable_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Job #{self.id} {self.task} ({self.status})"
+
+    @classmethod
+    def enqueue(cls, task, payload=None, run_at=None, max_attempts=None, business=None, user=None):
+        from .jobs import get_task
+
+        spec = get_task(task)  # fail at enqueue time rather than in the worker if the task doesn't exist
+        return cls.objects.create(
+            task=task,
+            payload=payload or {},
+            business=business,
+            created_by=user,
+            run_at=run_at or timezone.now(),
+            max_attempts=max_attempts or spec.max_attempts,
+        )
+
+    @classmethod
+    def schedule_periodic(cls):
+        """
+        Queues a run of every periodic task which doesn't already have one queued or running
+        """
+        from .jobs import get_periodic_tasks
+
+        pending = set(
+            cls.objects.filter(status__in=[JobStatus.QUEUED, JobStatus.RUNNING]).values_list("task", flat=True)
+        )
+        return [cls.enqueue(spec.name) for spec in get_periodic_tasks() if spec.name not in pending]
+
+    @classmethod
+    def claim(cls, worker, stale_after):
+        """
+        Claims the next job which is due, or whose worker has gone away, using SKIP LOCKED so that concurrent workers
+        never block on or double claim the same job. Returns None if there is nothing to do.
+        """
+        while True:
+            now = timezone.now()
+            with transaction.atomic():
+                job = (
+                    cls.objects.select_for_update(skip_locked=True)
+                    .filter(
+                        Q(status=JobStatus.QUEUED, run_at__lte=now)
+                        | Q(status=JobStatus.RUNNING, locked_at__lt=now - stale_after)
+                    )
+                    .order_by("run_at", "id")
+                    .first()
+                )
+                if job is None:
+                    return None
+
+                if job.attempts >= job.max_attempts:
+                    # a worker died running this job on its last attempt
+                    job.finish(JobStatus.FAILED, error=job.last_error or "Worker stopped while running job")
+                    continue
+
+                job.status = JobStatus.RUNNING
+                job.attempts += 1
+                job.locked_at = now
+                job.locked_by = worker
+                job.save(update_fields=["status", "attempts", "locked_at", "locked_by"])
+                return job
+
+    def run(self):
+        from .jobs import PermanentJobError, get_task
+
+        try:
+            result = get_task(self.task).func(**self.payload)
+        except PermanentJobError as e:
+            self.finish(JobStatus.FAILED, error=str(e))
+        except Exception as e:
+            logger.exception("Job #%d (%s) failed on attempt %d", self.id, self.task, self.attempts)
+            self.retry_or_fail(f"{type(e).__name__}: {e}")
+        else:
+            self.finish(JobStatus.SUCCEEDED, result=result)
+
+    def retry_or_fail(self, error):
+        if self.attempts >= self.max_attempts:
+            self.finish(JobStatus.FAILED, error=error)
+            return
+
+        delay = min(settings.JOB_RETRY_BASE_SECONDS * 2 ** (self.attempts - 1), settings.JOB_RETRY_MAX_SECONDS)
+        self.status = JobStatus.QUEUED
+        self.run_at = timezone.now() + timedelta(seconds=delay)
+        self.last_error = error
+        self.locked_at = None
+        self.locked_by = ""
+        self.save(update_fields=["status", "run_at", "last_error", "locked_at", "locked_by"])
+
+    def finish(self, status, result=None, error=""):
+        from .jobs import get_task
+
+        self.status = status
+        self.result = result
+        self.last_error = error
+        self.finished_at = timezone.now()
+        self.locked_at = None
+        self.locked_by = ""
+        self.save(update_fields=["status", "result", "last_error", "finished_at", "locked_at", "locked_by"])
+
+        # periodic tasks queue their next run whichever way this one went
+        spec = get_task(self.task)
+        if spec.every:
+            Job.enqueue(
+                self.task,
+                self.payload,
+                run_at=self.finished_at + spec.every,
+                business=self.business,
+                user=self.created_by,
+            )
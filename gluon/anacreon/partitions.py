@@ -0,0 +1,123 @@
+"""
+Maintenance of the monthly partitions of the audit log table. The table itself is converted to a partitioned table by
+migration 0003, which also installs the anacreon_auditlog_create_partitions function used here (replaced by 0014).
+"""
+import gzip
+import logging
+import os
+import re
+from datetime import date
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+AUDIT_LOG_TABLE = "anacreon_auditlog"
+AUDIT_LOG_DEFAULT_PARTITION = "anacreon_auditlog_default"
+PARTITION_REGEX = re.compile(r"^anacreon_auditlog_y(\d{4})m(\d{2})$")
+EXPORT_CHUNK_SIZE = 5000
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def ensure_audit_log_partitions(months_ahead):
+    """
+    Creates the partitions for the current month and the given number of months after it, so that inserts never end
+    up in the default partition. Rows which did end up there, e.g. while this wasn't run, are moved into partitions
+    for their months so they can be archived. Returns the number of partitions created.
+    """
+    this_month = timezone.now().date().replace(day=1)
+    from_month, to_month = this_month, add_months(this_month, months_ahead)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT count(*), min("timestamp"), max("timestamp") FROM {AUDIT_LOG_DEFAULT_PARTITION}')
+        stray, oldest, newest = cursor.fetchone()
+        if stray:
+            logger.warning("Moving %d audit log entries out of the default partition", stray)
+            from_month = min(from_month, oldest.date().replace(day=1))
+            to_month = max(to_month, newest.date().replace(day=1))
+
+        cursor.execute("SELECT anacreon_auditlog_create_partitions(%s, %s)", [from_month, to_month])
+        created = cursor.fetchone()[0]
+
+        # the month of every stray row should now have its partition, anything left means that wasn't possible
+        cursor.execute(f"SELECT count(*) FROM {AUDIT_LOG_DEFAULT_PARTITION}")
+        stray = cursor.fetchone()[0]
+        if stray:
+            raise RuntimeError(f"{stray} audit log entries are still in the default partition")
+
+    return created
+
+
+def get_audit_log_partitions():
+    """
+    Gets the monthly partition tables as (name, month, attached) tuples, oldest first. Tables left detached by an
+    interrupted archive are included so that they are picked up again.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname, p.relname IS NOT NULL
+            FROM pg_class c
+            LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+            LEFT JOIN pg_class p ON p.oid = i.inhparent AND p.relname = %s
+            WHERE c.relkind = 'r' AND c.relname LIKE 'anacreon\\_auditlog\\_y%%'
+            """,
+            [AUDIT_LOG_TABLE],
+        )
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, attached in rows:
+        match = PARTITION_REGEX.match(name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1), attached))
+
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def archive_audit_log_partition(name, attached, directory):
+    """
+    Detaches a partition, exports its rows as gzipped NDJSON into the given directory and then drops it. The detach is
+    committed before the export starts so that writers to the audit log are only blocked for a moment.
+    """
+    quoted = connection.ops.quote_name(name)
+
+    if attached:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {connection.ops.quote_name(AUDIT_LOG_TABLE)} DETACH PARTITION {quoted}")
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}.ndjson.gz")
+    partial_path = path + ".partial"
+
+    rows = 0
+    with gzip.open(partial_path, "wt", encoding="utf-8") as out, connection.cursor() as cursor:
+        last_id = 0
+        while True:
+            cursor.execute(
+                f"SELECT t.id, row_to_json(t)::text FROM {quoted} t WHERE t.id > %s ORDER BY t.id LIMIT %s",
+                [last_id, EXPORT_CHUNK_SIZE],
+            )
+            chunk = cursor.fetchall()
+            if not chunk:
+                break
+
+            for _, line in chunk:
+                out.write(line)
+                out.write("\n")
+
+            rows += len(chunk)
+            last_id = chunk[-1][0]
+
+    os.replace(partial_path, path)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE {quoted}")
+
+    logger.info("Archived %d audit log entries from %s to %s", rows, name, path)
+    return path, rows
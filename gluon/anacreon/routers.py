@@ -0,0 +1,127 @@
+import contextlib
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+# seconds behind the primary a replica is, zero when it has replayed everything it has received
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+REPLICA_PIN_COOKIE = "read_primary"
+
+_local = threading.local()
+
+# replica alias -> (time it was last checked, whether it can take reads)
+_replica_health = {}
+
+
+@contextlib.contextmanager
+def replica_reads(primary=False):
+    """
+    Allows reads made inside this block to go to a replica, unless primary is set. Reads made outside of any such block,
+    e.g. by workers and management commands, always go to the primary.
+    """
+    previous = getattr(_local, "read_primary", None)
+    _local.read_primary = primary
+    try:
+        yield
+    finally:
+        _local.read_primary = previous
+
+
+def use_primary():
+    """
+    Sends the remaining reads of the current replica_reads block to the primary
+    """
+    if getattr(_local, "read_primary", None) is not None:
+        _local.read_primary = True
+
+
+def reads_from_primary() -> bool:
+    read_primary = getattr(_local, "read_primary", None)
+    return read_primary is None or read_primary or connections[DEFAULT_DB_ALIAS].in_atomic_block
+
+
+def _pin_key(user) -> str:
+    return f"replica:pin:{user.pk}"
+
+
+def pin_to_primary(user):
+    """
+    Keeps the reads of the given user on the primary for REPLICA_PIN_SECONDS so they see their own writes
+    """
+    if user is not None and user.is_authenticated:
+        cache.set(_pin_key(user), True, timeout=settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned_to_primary(user) -> bool:
+    return user is not None and user.is_authenticated and bool(cache.get(_pin_key(user)))
+
+
+def get_replica_lag(alias) -> float:
+    conn = connections[alias]
+    if conn.vendor != "postgresql":
+        conn.ensure_connection()
+        return 0
+
+    with conn.cursor() as cursor:
+        cursor.execute(REPLICA_LAG_SQL)
+        return float(cursor.fetchone()[0])
+
+
+def is_replica_healthy(alias) -> bool:
+    """
+    Whether the given replica is reachable and not too far behind, checked at most every REPLICA_CHECK_SECONDS
+    """
+    checked_on, healthy = _replica_health.get(alias, (None, False))
+    now = time.monotonic()
+    if checked_on is not None and now - checked_on < settings.REPLICA_CHECK_SECONDS:
+        return healthy
+
+    try:
+        lag = get_replica_lag(alias)
+        healthy = lag <= settings.REPLICA_MAX_LAG_SECONDS
+        if not healthy:
+            logger.warning("Replica %s is %.1f seconds behind, reading from primary", alias, lag)
+    except DatabaseError as e:
+        logger.warning("Replica %s is unavailable, reading from primary: %s", alias, e)
+        connections[alias].close()
+        healthy = False
+
+    _replica_health[alias] = (now, healthy)
+    return healthy
+
+
+class ReplicaRouter:
+    """
+    Sends writes and migrations to the primary and spreads reads over the healthy replicas in DATABASE_REPLICAS
+    """
+
+    def db_for_read(self, model, **hints):
+        if reads_from_primary():
+            return DEFAULT_DB_ALIAS
+
+        replicas = [alias for alias in settings.DATABASE_REPLICAS if is_replica_healthy(alias)]
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
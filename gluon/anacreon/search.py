@@ -0,0 +1,124 @@
+"""
+Ranked search of a business's items. On PostgreSQL items are matched through the trigram and full-text indexes added
+by migration 0008, otherwise, or when those find nothing, names are matched in process with rapidfuzz which tolerates
+worse typos.
+"""
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from django.db import connections, router
+from rapidfuzz import fuzz, process, utils
+
+from gluon.anacreon.models import Item
+from gluon.utils.cache import business_scope, get_generation
+
+# must match the expression of the item_search_vector_idx index exactly for the index to be used
+ITEM_SEARCH_VECTOR = "to_tsvector('simple', name || ' ' || sku || ' ' || description)"
+
+ITEM_SEARCH_SQL = f"""
+SELECT *, GREATEST(
+    word_similarity(%(query)s, name),
+    word_similarity(%(query)s, sku),
+    ts_rank({ITEM_SEARCH_VECTOR}, plainto_tsquery('simple', %(query)s))
+) * (1 + ln(1 + weight) * %(weight_factor)s) AS score
+FROM anacreon_item
+WHERE business_id = %(business)s AND is_active AND (
+    %(query)s <%% name OR %(query)s <%% sku OR {ITEM_SEARCH_VECTOR} @@ plainto_tsquery('simple', %(query)s)
+)
+ORDER BY score DESC, id
+LIMIT %(limit)s
+"""
+
+# business id -> (generation, item ids, weights, processed "name sku" strings) of the most recently searched businesses
+_item_choices = OrderedDict()
+_item_choices_lock = threading.Lock()
+
+
+def search_items(business_id, query, limit) -> list:
+    """
+    Finds the active items of a business whose name, sku or description match the query, best matches first. Match
+    quality is scaled up by the log of each item's popularity weight.
+    """
+    if connections[router.db_for_read(Item)].vendor == "postgresql":
+        params = {
+            "business": business_id,
+            "query": query,
+            "limit": limit,
+            "weight_factor": settings.ITEM_SEARCH_WEIGHT_FACTOR,
+        }
+        items = list(Item.objects.raw(ITEM_SEARCH_SQL, params))
+        if items:
+            return items
+
+    return fuzzy_search_items(business_id, query, limit)
+
+
+def get_item_choices(business_id):
+    """
+    Gets the names of a business's active items prepared for matching. These are kept in memory until the business's
+    catalog changes, which the cache generation of the business tells us even when it changed in another process.
+    """
+    generation = get_generation(business_scope(business_id))
+
+    with _item_choices_lock:
+        cached = _item_choices.get(business_id)
+        if cached and cached[0] == generation:
+            _item_choices.move_to_end(business_id)
+            return cached[1:]
+
+    rows = Item.objects.filter(business_id=business_id, is_active=True).order_by("id").values_list(
+        "id", "weight", "name", "sku"
+    )
+    ids, weights, choices = [], [], []
+    for item_id, weight, name, sku in rows:
+        ids.append(item_id)
+        weights.append(weight)
+        choices.append(utils.default_process(f"{name} {sku}"))
+
+    with _item_choices_lock:
+        _item_choices[business_id] = (generation, ids, weights, choices)
+        _item_choices.move_to_end(business_id)
+        while len(_item_choices) > settings.ITEM_SEARCH_CACHED_BUSINESSES:
+            _item_choices.popitem(last=False)
+
+    return ids, weights, choices
+
+
+def fuzzy_search_items(business_id, query, limit) -> list:
+    """
+    Finds the active items of a business whose name or sku are close to the query, best matches first. Names are
+    scored in memory, spread over ITEM_SEARCH_FUZZY_WORKERS threads, so the only query made is for the matching items.
+    """
+    ids, weights, choices = get_item_choices(business_id)
+    if not choices:
+        return []
+
+    ratios = process.cdist(
+        [utils.default_process(query)],
+        choices,
+        scorer=fuzz.WRatio,
+        processor=None,
+        score_cutoff=settings.ITEM_SEARCH_FUZZY_CUTOFF,
+        dtype=np.uint8,
+        workers=settings.ITEM_SEARCH_FUZZY_WORKERS,
+    )[0]
+
+    # weighting can reorder matches so take more candidates than we need before applying it
+    candidates = np.flatnonzero(ratios)
+    if len(candidates) > limit * 5:
+        candidates = candidates[np.argpartition(ratios[candidates], -limit * 5)[-limit * 5:]]
+
+    factor = settings.ITEM_SEARCH_WEIGHT_FACTOR
+    scores = {ids[i]: (int(ratios[i]) / 100) * (1 + math.log1p(weights[i]) * factor) for i in candidates.tolist()}
+    best = sorted(scores, key=lambda item_id: (-scores[item_id], item_id))[:limit]
+
+    # the choices may be from before an item was deactivated or moved, so scope the fetch as they were built
+    items = Item.objects.filter(business_id=business_id, is_active=True).in_bulk(best)
+    results = [items[item_id] for item_id in best if item_id in items]
+    for item in results:
+        item.score = scores[item.id]
+
+    return results
@@ -1,9 +1,108 @@
+import threading
+
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import Stock, Expenditure, AuditLog, Order
+from gluon.utils.cache import bump_generation, business_scope
+from .models import Stock, Expenditure, AuditLog, Order, OrderItem, OrderStatus, Item, Business, Category, SubCategory, \
+    DailySales, DailyExpenditure, rollup_day
+
+_pending_audit = threading.local()
+_pending_rebuilds = threading.local()
+
+
+class AuditBatch:
+    """
+    Audit entries waiting for a transaction (or savepoint) to commit. The batch registers itself as the on_commit
+    callback of the scope it was created in, so if that scope is rolled back Django drops it and nothing is written.
+    """
+
+    def __init__(self, using, scope):
+        self.using = using
+        self.scope = scope
+        self.entries = []
+
+    def is_pending(self, connection):
+        return any(func is self for _, func, _ in connection.run_on_commit)
+
+    def __call__(self):
+        batches = getattr(_pending_audit, self.using, {})
+        if batches.get(self.scope) is self:
+            del batches[self.scope]
+
+        if self.entries:
+            AuditLog.objects.using(self.using).bulk_create(self.entries)
+
+
+def queue_audit_logs(entries, using="default"):
+    """
+    Queues audit entries to be written when the current transaction commits. Everything queued in the same
+    transaction or savepoint is written with a single INSERT, and entries queued in a transaction that is rolled
+    back are never written. Outside of a transaction entries are written straight away.
+    """
+    if not entries:
+        return
+
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        AuditLog.objects.using(using).bulk_create(entries)
+        return
+
+    batches = _pending_audit.__dict__.setdefault(using, {})
+    scope = tuple(connection.savepoint_ids)
+    batch = batches.get(scope)
+
+    if batch is None or not batch.is_pending(connection):
+        # forget any batches whose transaction or savepoint was rolled back
+        for key, other in list(batches.items()):
+            if not other.is_pending(connection):
+                del batches[key]
 
+        batch = batches[scope] = AuditBatch(using, scope)
+        transaction.on_commit(batch, using=using)
 
-def get_audit_details(instance, action):
+    batch.entries.extend(entries)
+
+
+# order fields which can be saved without the order's lines changing
+ORDER_LINE_INDEPENDENT_FIELDS = frozenset({"status", "total", "completed_at", "cancelled_at", "modified_on"})
+
+
+def get_order_lines(order):
+    """
+    Gets the audit snapshot of an order's lines. Uses lines the caller has already attached to the order or prefetched
+    onto it if there are any, and otherwise loads them with a single joined query.
+    """
+    if order.audit_lines is not None:
+        return order.audit_lines
+
+    prefetched = getattr(order, "_prefetched_objects_cache", {}).get("items")
+    if prefetched is not None:
+        uncached = {oi.item_id for oi in prefetched if not OrderItem.item.is_cached(oi)}
+        names = dict(Item.objects.filter(id__in=uncached).values_list("id", "name")) if uncached else {}
+        return [
+            {
+                "item": oi.item.name if oi.item_id not in uncached else names.get(oi.item_id),
+                "quantity": oi.quantity,
+                "selling_price": str(oi.selling_price),
+            } for oi in prefetched
+        ]
+
+    return [
+        {
+            "item": name,
+            "quantity": quantity,
+            "selling_price": str(selling_price),
+        } for name, quantity, selling_price in order.items.order_by("id").values_list(
+            "item__name", "quantity", "selling_price")
+    ]
+
+
+def get_audit_details(instance, action, lines=None, update_fields=None):
+    """
+    Builds the details recorded in an audit entry. For orders, lines can be passed in if the caller already has them,
+    and they're left out entirely when update_fields shows only fields which don't affect the lines were saved.
+    """
     if isinstance(instance, Stock):
         return {
             "item": instance.item.name,
@@ -12,18 +111,16 @@ def get_audit_details(instance, action):
             "selling_price": str(instance.selling_price),
         }
     elif isinstance(instance, Order):
-        return {
+        details = {
             "status": instance.status,
             "total": str(instance.total),
-            "items": [
-                {
-                    "item": oi.item.name,
-                    "quantity": oi.quantity,
-                    "selling_price": str(oi.selling_price),
-                } for oi in instance.items.all()
-            ],
-            "customer": getattr(instance.customer, 'username', None),
         }
+        if lines is None and not (update_fields and ORDER_LINE_INDEPENDENT_FIELDS.issuperset(update_fields)):
+            lines = get_order_lines(instance)
+        if lines is not None:
+            details["items"] = lines
+        details["customer"] = getattr(instance.customer, 'username', None)
+        return details
 
     elif isinstance(instance, Expenditure):
         return {
@@ -35,75 +132,181 @@ def get_audit_details(instance, action):
 
 
 @receiver(post_save, sender=Stock)
-def log_stock_save(sender, instance, created, **kwargs):
+def log_stock_save(sender, instance, created, using, **kwargs):
     action = "create" if created else "update"
-    AuditLog.objects.create(
-        business=instance.item.business,
-        user=instance.recorded_by,
+    queue_audit_logs([AuditLog(
+        business_id=instance.item.business_id,
+        user_id=instance.recorded_by_id,
         action=action,
         model="Stock",
         object_id=instance.id,
         details=get_audit_details(instance, action),
-    )
+    )], using=using)
 
 
 @receiver(post_delete, sender=Stock)
-def log_stock_delete(sender, instance, **kwargs):
-    AuditLog.objects.create(
-        business=instance.item.business,
-        user=instance.recorded_by,
+def log_stock_delete(sender, instance, using, **kwargs):
+    queue_audit_logs([AuditLog(
+        business_id=instance.item.business_id,
+        user_id=instance.recorded_by_id,
         action="delete",
         model="Stock",
         object_id=instance.id,
         details=get_audit_details(instance, "delete"),
-    )
+    )], using=using)
 
 
 @receiver(post_save, sender=Expenditure)
-def log_expenditure_save(sender, instance, created, **kwargs):
+def log_expenditure_save(sender, instance, created, using, **kwargs):
     action = "create" if created else "update"
-    AuditLog.objects.create(
-        business=instance.business,
-        user=instance.spent_by,
+    queue_audit_logs([AuditLog(
+        business_id=instance.business_id,
+        user_id=instance.spent_by_id,
         action=action,
         model="Expenditure",
         object_id=instance.id,
         details=get_audit_details(instance, action),
-    )
+    )], using=using)
 
 
 @receiver(post_delete, sender=Expenditure)
-def log_expenditure_delete(sender, instance, **kwargs):
-    AuditLog.objects.create(
-        business=instance.business,
-        user=instance.spent_by,
+def log_expenditure_delete(sender, instance, using, **kwargs):
+    queue_audit_logs([AuditLog(
+        business_id=instance.business_id,
+        user_id=instance.spent_by_id,
         action="delete",
         model="Expenditure",
         object_id=instance.id,
         details=get_audit_details(instance, "delete"),
-    )
+    )], using=using)
 
 
 @receiver(post_save, sender=Order)
-def log_order_save(sender, instance, created, **kwargs):
+def log_order_save(sender, instance, created, using, update_fields, **kwargs):
     action = "create" if created else "update"
-    AuditLog.objects.create(
-        business=instance.business,
-        user=instance.placed_by,
+    queue_audit_logs([AuditLog(
+        business_id=instance.business_id,
+        user_id=instance.placed_by_id,
         action=action,
         model="Order",
         object_id=instance.id,
-        details=get_audit_details(instance, action),
-    )
+        details=get_audit_details(instance, action, update_fields=update_fields),
+    )], using=using)
 
 
 @receiver(post_delete, sender=Order)
-def log_order_delete(sender, instance, **kwargs):
-    AuditLog.objects.create(
-        business=instance.business,
-        user=instance.placed_by,
+def log_order_delete(sender, instance, using, **kwargs):
+    queue_audit_logs([AuditLog(
+        business_id=instance.business_id,
+        user_id=instance.placed_by_id,
         action="delete",
         model="Order",
         object_id=instance.id,
         details=get_audit_details(instance, "delete"),
-    )
+    )], using=using)
+
+
+def invalidate_catalog_cache(business_ids, using="default"):
+    """
+    Invalidates the cached catalog lists of the given businesses, and those across all businesses, once the current
+    transaction commits
+    """
+    scopes = [business_scope(business_id) for business_id in business_ids] + [business_scope()]
+    transaction.on_commit(lambda: bump_generation(*scopes), using=using)
+
+
+@receiver(post_save, sender=Business)
+@receiver(post_delete, sender=Business)
+def invalidate_business(sender, instance, using, **kwargs):
+    invalidate_catalog_cache([instance.id], using=using)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def invalidate_business_catalog(sender, instance, using, **kwargs):
+    invalidate_catalog_cache([instance.business_id], using=using)
+
+
+@receiver(post_save, sender=SubCategory)
+@receiver(post_delete, sender=SubCategory)
+def invalidate_subcategory(sender, instance, using, **kwargs):
+    if SubCategory.category.is_cached(instance):
+        business_ids = [instance.category.business_id]
+    else:
+        business_ids = Category.objects.using(using).filter(id=instance.category_id).values_list("business_id", flat=True)
+
+    invalidate_catalog_cache(list(business_ids), using=using)
+
+
+class RollupRebuild:
+    """
+    Days of daily rollups to rebuild when a transaction commits. However many rows of a business change in the
+    transaction, e.g. when deleting the business cascades to all its expenditures, each of its rollups is rebuilt once
+    and the rollups of businesses which no longer exist aren't.
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self.days = {}
+
+    def is_pending(self, connection):
+        return any(func is self for _, func, _ in connection.run_on_commit)
+
+    def __call__(self):
+        if getattr(_pending_rebuilds, self.using, None) is self:
+            delattr(_pending_rebuilds, self.using)
+
+        existing = set(
+            Business.objects.using(self.using)
+            .filter(id__in={business_id for _, business_id in self.days})
+            .values_list("id", flat=True)
+        )
+        for (model, business_id), days in self.days.items():
+            if business_id in existing:
+                model.rebuild(business_id, min(days), max(days))
+
+
+def queue_rollup_rebuild(model, business_id, day, using="default"):
+    """
+    Queues the rebuild of a business's rollup of the given model for a day, for when the current transaction commits
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        model.rebuild(business_id, day, day)
+        return
+
+    rebuild = getattr(_pending_rebuilds, using, None)
+    if rebuild is None or not rebuild.is_pending(connection):
+        rebuild = RollupRebuild(using)
+        setattr(_pending_rebuilds, using, rebuild)
+        transaction.on_commit(rebuild, using=using)
+
+    rebuild.days.setdefault((model, business_id), set()).add(day)
+
+
+@receiver(post_save, sender=Expenditure)
+def update_expenditure_rollup(sender, instance, created, using, **kwargs):
+    if created:
+        DailyExpenditure.record(instance)
+    else:
+        # the amount or category may have changed
+        queue_rollup_rebuild(DailyExpenditure, instance.business_id, rollup_day(instance.spent_at), using=using)
+
+
+@receiver(post_delete, sender=Expenditure)
+def remove_expenditure_rollup(sender, instance, using, **kwargs):
+    queue_rollup_rebuild(DailyExpenditure, instance.business_id, rollup_day(instance.spent_at), using=using)
+
+
+@receiver(post_delete, sender=Order)
+def remove_order_rollup(sender, instance, using, **kwargs):
+    if instance.status == OrderStatus.COMPLETED:
+        day = rollup_day(instance.completed_at or instance.placed_at)
+    elif instance.status == OrderStatus.CANCELLED and instance.cancelled_at:
+        day = rollup_day(instance.cancelled_at)
+    else:
+        return
+
+    queue_rollup_rebuild(DailySales, instance.business_id, day, using=using)
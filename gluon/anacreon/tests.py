@@ -1,3 +1,697 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+from unittest.mock import patch
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, connections, transaction
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework.throttling import ScopedRateThrottle
+
+from gluon.anacreon import routers, search
+from gluon.anacreon.valuation import to_results, value_inventory
+from gluon.anacreon.models import (
+    AuditLog,
+    Business,
+    BusinessUser,
+    DailyExpenditure,
+    DailySales,
+    Expenditure,
+    Item,
+    Order,
+    OrderStatus,
+    Stock,
+    rollup_day,
+)
+
+
+class AnacreonTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("manager", password="secret")
+        self.business = Business.objects.create(name="Corner Shop", created_by=self.user, modified_by=self.user)
+
+    def create_item(self, name, sku, business=None, **kwargs):
+        return Item.objects.create(
+            business=business or self.business,
+            name=name,
+            sku=sku,
+            created_by=self.user,
+            modified_by=self.user,
+            **kwargs,
+        )
+
+    def create_items(self, count, quantity=10):
+        start = Item.objects.count()
+        return [self.create_item(f"Item {i}", f"SKU-{i}", quantity=quantity) for i in range(start, start + count)]
+
+    def place_order(self, *lines, price="2.50"):
+        return Order.place_order(
+            self.business,
+            [{"item": item, "quantity": quantity, "selling_price": Decimal(price)} for item, quantity in lines],
+            user=self.user,
+        )
+
+
+class FuzzySearchTest(AnacreonTest):
+    def setUp(self):
+        super().setUp()
+        search._item_choices.clear()
+
+        self.bread = self.create_item("Brown Bread", "BRD-1")
+        self.butter = self.create_item("Butter", "BTR-1", weight=10)
+
+    def test_search(self):
+        results = search.fuzzy_search_items(self.business.id, "brwn bread", 10)
+        self.assertEqual([self.bread], results)
+        self.assertGreater(results[0].score, 0)
+
+    def test_stale_choices(self):
+        # cache the choices then change items behind the back of the cache generation
+        search.get_item_choices(self.business.id)
+
+        other = Business.objects.create(name="Other Shop", created_by=self.user, modified_by=self.user)
+        Item.objects.filter(id=self.bread.id).update(is_active=False)
+        Item.objects.filter(id=self.butter.id).update(business=other)
+        self.assertEqual([], search.fuzzy_search_items(self.business.id, "brown bread", 10))
+        self.assertEqual([], search.fuzzy_search_items(self.business.id, "butter", 10))
+
+        # and delete one outright
+        search._item_choices.clear()
+        search.get_item_choices(other.id)
+        Item.objects.filter(id=self.butter.id).delete()
+        self.assertEqual([], search.fuzzy_search_items(other.id, "butter", 10))
+
+
+class PlaceOrderTest(AnacreonTest):
+    def test_place_order(self):
+        bread, milk = self.create_items(2)
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            order = self.place_order((bread, 2), (milk, 1), price="4.00")
+
+        # the order is written once with its total, and its lines are inserted together
+        inserts = [query["sql"] for query in queries if query["sql"].startswith("INSERT")]
+        self.assertEqual(1, len([sql for sql in inserts if sql.startswith('INSERT INTO "anacreon_order" ')]))
+        self.assertEqual(1, len([sql for sql in inserts if sql.startswith('INSERT INTO "anacreon_orderitem" ')]))
+        self.assertFalse(any(query["sql"].startswith('UPDATE "anacreon_order"') for query in queries))
+
+        order.refresh_from_db()
+        self.assertEqual((OrderStatus.PENDING, Decimal("12.00")), (order.status, order.total))
+        self.assertEqual(
+            [(bread.id, 2, Decimal("4.00")), (milk.id, 1, Decimal("4.00"))],
+            list(order.items.order_by("id").values_list("item", "quantity", "selling_price")),
+        )
+        self.assertEqual(
+            [
+                {"item": bread.name, "quantity": 2, "selling_price": "4.00"},
+                {"item": milk.name, "quantity": 1, "selling_price": "4.00"},
+            ],
+            AuditLog.objects.get(model="Order", object_id=order.id).details["items"],
+        )
+
+    def test_queries_independent_of_lines(self):
+        small, large = self.create_items(3), self.create_items(30)
+        with CaptureQueriesContext(connection) as queries:
+            self.place_order(*[(item, 1) for item in small])
+
+        with self.assertNumQueries(len(queries)):
+            self.place_order(*[(item, 1) for item in large])
+
+
+class ProcessOrderTest(AnacreonTest):
+    def test_process(self):
+        bread, milk = self.create_items(2)
+        order = self.place_order((bread, 2), (milk, 1), (bread, 3), price="4.00")
+
+        self.assertEqual({"success": True}, order.process_order())
+
+        order.refresh_from_db()
+        self.assertEqual(OrderStatus.COMPLETED, order.status)
+        self.assertIsNotNone(order.completed_at)
+
+        bread.refresh_from_db()
+        milk.refresh_from_db()
+        self.assertEqual((5, 5, Decimal("4.00")), (bread.quantity, bread.weight, bread.last_selling_price))
+        self.assertEqual((9, 1, Decimal("4.00")), (milk.quantity, milk.weight, milk.last_selling_price))
+
+        # an order can only be processed once
+        self.assertFalse(order.process_order()["success"])
+        bread.refresh_from_db()
+        self.assertEqual(5, bread.quantity)
+
+    def test_insufficient_stock(self):
+        bread, milk = self.create_items(2, quantity=1)
+        order = self.place_order((bread, 1), (milk, 1), (milk, 1))
+
+        error = "Item 'Item 1' is out of stock or insufficient quantity."
+        self.assertEqual({"success": False, "error": error}, order.process_order())
+
+        # nothing is taken from stock, even for the lines that could have been sold
+        self.assertEqual([1, 1], list(Item.objects.order_by("id").values_list("quantity", flat=True)))
+        order.refresh_from_db()
+        self.assertEqual(OrderStatus.PENDING, order.status)
+
+    def test_queries_independent_of_lines(self):
+        small = self.place_order(*[(item, 1) for item in self.create_items(3)])
+        with CaptureQueriesContext(connection) as queries:
+            small.process_order()
+
+        large = self.place_order(*[(item, 1) for item in self.create_items(30)])
+        with self.assertNumQueries(len(queries)):
+            self.assertTrue(large.process_order()["success"])
+
+    @skipUnlessDBFeature("has_select_for_update")
+    def test_items_locked(self):
+        items = self.create_items(3)
+        order = self.place_order(*[(item, 1) for item in reversed(items)])
+
+        with CaptureQueriesContext(connection) as queries:
+            order.process_order()
+
+        # the order and then its items, in id order so concurrent orders can't deadlock
+        locks = [query["sql"] for query in queries if "FOR UPDATE" in query["sql"]]
+        self.assertEqual(2, len(locks))
+        self.assertIn('FROM "anacreon_order"', locks[0])
+        self.assertIn('FROM "anacreon_item"', locks[1])
+        self.assertIn('ORDER BY "anacreon_item"."id" ASC', locks[1])
+
+
+class OrderTransitionTest(AnacreonTest):
+    def test_cancel_restocks(self):
+        bread, milk = self.create_items(2)
+        order = self.place_order((bread, 2), (milk, 1), (bread, 3))
+        order.process_order()
+
+        order.cancel()
+
+        self.assertEqual([10, 10], list(Item.objects.order_by("id").values_list("quantity", flat=True)))
+        order.refresh_from_db()
+        self.assertEqual(OrderStatus.CANCELLED, order.status)
+
+        # cancelling again doesn't restock again
+        order.cancel()
+        self.assertEqual([10, 10], list(Item.objects.order_by("id").values_list("quantity", flat=True)))
+
+    def test_cancel_stale(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=10)
+        order = self.place_order((bread, 3))
+        order.process_order()
+        stale = Order.objects.get(id=order.id)
+
+        order.cancel()
+        stale.cancel()
+        Order.bulk_cancel([order.id])
+
+        bread.refresh_from_db()
+        self.assertEqual(10, bread.quantity)
+        self.assertEqual((OrderStatus.CANCELLED, order.cancelled_at), (stale.status, stale.cancelled_at))
+
+    def test_cancel_queries_independent_of_lines(self):
+        small = self.place_order(*[(item, 1) for item in self.create_items(3)])
+        with CaptureQueriesContext(connection) as queries:
+            small.cancel()
+
+        large = self.place_order(*[(item, 1) for item in self.create_items(30)])
+        with self.assertNumQueries(len(queries)):
+            large.cancel()
+
+    def test_bulk_complete(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=10)
+        pending = [self.place_order((bread, 1)) for _ in range(3)]
+        cancelled = self.place_order((bread, 1))
+        cancelled.cancel()
+
+        ids = Order.bulk_complete([order.id for order in pending] + [cancelled.id])
+
+        self.assertEqual(sorted(order.id for order in pending), ids)
+        self.assertEqual(
+            {OrderStatus.COMPLETED: 3, OrderStatus.CANCELLED: 1},
+            dict(Order.objects.order_by().values_list("status").annotate(count=Count("id"))),
+        )
+        self.assertFalse(Order.objects.filter(status=OrderStatus.COMPLETED, completed_at=None).exists())
+
+        # completed orders aren't completed again
+        self.assertEqual([], Order.bulk_complete(ids))
+
+    def test_bulk_cancel(self):
+        bread, milk = self.create_items(2)
+        processed = self.place_order((bread, 2), (milk, 1))
+        processed.process_order()
+        pending = self.place_order((bread, 4))
+
+        ids = Order.bulk_cancel([processed.id, pending.id])
+
+        self.assertEqual(sorted([processed.id, pending.id]), ids)
+        self.assertEqual({OrderStatus.CANCELLED}, set(Order.objects.values_list("status", flat=True)))
+
+        # every line is put back, same as cancelling the orders one by one
+        self.assertEqual([14, 10], list(Item.objects.order_by("id").values_list("quantity", flat=True)))
+        self.assertEqual([], Order.bulk_cancel(ids))
+
+    def test_bulk_queries_independent_of_orders(self):
+        items = self.create_items(3)
+
+        small = [self.place_order(*[(item, 1) for item in items]).id for _ in range(2)]
+        with CaptureQueriesContext(connection) as queries:
+            Order.bulk_cancel(small)
+
+        large = [self.place_order(*[(item, 1) for item in items]).id for _ in range(20)]
+        with self.assertNumQueries(len(queries)):
+            Order.bulk_cancel(large)
+
+
+class AuditLogTest(AnacreonTest):
+    def create_expenditure(self, amount):
+        return Expenditure.objects.create(
+            business=self.business,
+            amount=amount,
+            description="Rent",
+            category="Premises",
+            spent_by=self.user,
+            created_by=self.user,
+            modified_by=self.user,
+        )
+
+    def assertAuditInserts(self, count, queries):
+        inserts = [query for query in queries if query["sql"].startswith('INSERT INTO "anacreon_auditlog"')]
+        self.assertEqual(count, len(inserts))
+
+    def test_written_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            for amount in ("100.00", "200.00", "300.00"):
+                self.create_expenditure(Decimal(amount))
+
+        self.assertFalse(AuditLog.objects.exists())
+
+        with CaptureQueriesContext(connection) as queries:
+            for callback in callbacks:
+                callback()
+
+        self.assertAuditInserts(1, queries)
+        self.assertEqual(
+            ["100.00", "200.00", "300.00"],
+            [details["amount"] for details in AuditLog.objects.order_by("id").values_list("details", flat=True)],
+        )
+
+    def test_rolled_back(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            kept = self.create_expenditure(100)
+
+            with self.assertRaises(ValueError), transaction.atomic():
+                self.create_expenditure(200)
+                raise ValueError()
+
+            # entries queued after the rollback are still written
+            also_kept = self.create_expenditure(300)
+
+        self.assertEqual(
+            [kept.id, also_kept.id], list(AuditLog.objects.order_by("id").values_list("object_id", flat=True))
+        )
+
+    def test_bulk_transition(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            ids = [self.place_order((bread, 1)).id for _ in range(5)]
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            Order.bulk_complete(ids)
+
+        self.assertAuditInserts(1, queries)
+        entries = AuditLog.objects.filter(action="update", model="Order").order_by("object_id")
+        self.assertEqual(ids, [entry.object_id for entry in entries])
+        self.assertEqual(
+            {
+                "status": OrderStatus.COMPLETED,
+                "total": "2.50",
+                "items": [{"item": "Bread", "quantity": 1, "selling_price": "2.50"}],
+                "customer": None,
+            },
+            entries[0].details,
+        )
+
+
+    def assertLineQueries(self, count, queries):
+        self.assertEqual(count, len([query for query in queries if '"anacreon_orderitem"' in query["sql"]]))
+
+    def get_order_details(self, order):
+        return AuditLog.objects.filter(model="Order", object_id=order.id).latest("id").details
+
+    def test_status_only_save(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.place_order((bread, 1))
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            order.status = OrderStatus.COMPLETED
+            order.save(update_fields=["status", "modified_on"])
+
+        # the lines can't have changed, so they're neither loaded nor recorded
+        self.assertLineQueries(0, queries)
+        self.assertEqual(
+            {"status": OrderStatus.COMPLETED, "total": "2.50", "customer": None}, self.get_order_details(order)
+        )
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            order.save()
+
+        self.assertLineQueries(1, queries)
+        self.assertEqual(
+            [{"item": "Bread", "quantity": 1, "selling_price": "2.50"}], self.get_order_details(order)["items"]
+        )
+
+    def test_prefetched_lines(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=10)
+        milk = self.create_item("Milk", "MLK-1", quantity=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            placed = self.place_order((bread, 1), (milk, 2))
+        lines = [
+            {"item": "Bread", "quantity": 1, "selling_price": "2.50"},
+            {"item": "Milk", "quantity": 2, "selling_price": "2.50"},
+        ]
+
+        order = Order.objects.prefetch_related("items__item").get(id=placed.id)
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            order.save()
+
+        self.assertLineQueries(0, queries)
+        self.assertFalse(any('"anacreon_item"' in query["sql"] for query in queries))
+        self.assertEqual(lines, self.get_order_details(order)["items"])
+
+        # lines prefetched without their items only need the item names
+        order = Order.objects.prefetch_related("items").get(id=placed.id)
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            order.save()
+
+        self.assertLineQueries(0, queries)
+        self.assertEqual(1, len([query for query in queries if query["sql"].startswith('SELECT "anacreon_item"')]))
+        self.assertEqual(lines, self.get_order_details(order)["items"])
+
+class RollupTest(AnacreonTest):
+    def get_rollups(self, model, *fields):
+        return list(model.objects.filter(business=self.business).order_by(*fields).values_list(*fields))
+
+    def assertMatchesRebuild(self, model, *fields):
+        rollups = self.get_rollups(model, *fields)
+        model.rebuild(self.business.id)
+        self.assertEqual(self.get_rollups(model, *fields), rollups)
+
+    def assertSales(self, revenue, units_sold, cost_of_goods, orders, cancelled_orders):
+        self.assertEqual(
+            [(Decimal(revenue), units_sold, Decimal(cost_of_goods), orders, cancelled_orders)],
+            self.get_rollups(DailySales, *DailySales.TOTALS),
+        )
+        self.assertMatchesRebuild(DailySales, "day", *DailySales.TOTALS)
+
+    def test_order_transitions(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=100, cost_price=Decimal("1.20"))
+        milk = self.create_item("Milk", "MLK-1", quantity=100, cost_price=Decimal("0.80"))
+
+        self.place_order((bread, 2), (milk, 1), price="2.50").process_order()
+        self.assertSales("7.50", 3, "3.20", 1, 0)
+
+        # cancelling a completed order takes it back out of the sales
+        completed = self.place_order((bread, 4))
+        completed.process_order()
+        self.assertSales("17.50", 7, "8.00", 2, 0)
+        completed.cancel()
+        self.assertSales("7.50", 3, "3.20", 1, 1)
+
+        # cancelling a pending one only counts the cancellation
+        self.place_order((milk, 5)).cancel()
+        self.assertSales("7.50", 3, "3.20", 1, 2)
+
+        pending = [self.place_order((bread, 1), (milk, 1), price="1.00").id for _ in range(3)]
+        Order.bulk_complete(pending[:2])
+        self.assertSales("11.50", 7, "7.20", 3, 2)
+
+        Order.bulk_cancel(pending)
+        self.assertSales("7.50", 3, "3.20", 1, 5)
+
+    def test_stale_orders(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=100, cost_price=Decimal("1.20"))
+        order = self.place_order((bread, 2), price="2.50")
+        first, second = Order.objects.get(id=order.id), Order.objects.get(id=order.id)
+
+        # completing copies which don't know the order was completed only counts it once
+        order.complete()
+        first.complete()
+        self.assertSales("5.00", 2, "2.40", 1, 0)
+        self.assertEqual(order.completed_at, first.completed_at)
+
+        # a copy which thinks the order is pending still takes its sales back out when cancelling
+        second.cancel()
+        self.assertSales("0.00", 0, "0.00", 0, 1)
+        first.cancel()
+        self.assertSales("0.00", 0, "0.00", 0, 1)
+
+        # and completing a cancelled order takes it back out of the cancellations
+        order.complete()
+        self.assertSales("5.00", 2, "2.40", 1, 0)
+
+    def test_expenditures(self):
+        def create_expenditure(amount, category):
+            return Expenditure.objects.create(
+                business=self.business,
+                amount=Decimal(amount),
+                description="",
+                category=category,
+                spent_by=self.user,
+                created_by=self.user,
+                modified_by=self.user,
+            )
+
+        rent = create_expenditure("500.00", "Premises")
+        create_expenditure("25.00", "Premises")
+        wages = create_expenditure("300.00", "Staff")
+        day = rollup_day(rent.spent_at)
+
+        fields = ("day", "category", "amount", "count")
+        self.assertEqual(
+            [(day, "Premises", Decimal("525.00"), 2), (day, "Staff", Decimal("300.00"), 1)],
+            self.get_rollups(DailyExpenditure, *fields),
+        )
+
+        # changes are rebuilt once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            rent.amount = Decimal("450.00")
+            rent.save()
+            wages.delete()
+
+            self.assertEqual(2, DailyExpenditure.objects.count())
+
+        self.assertEqual([(day, "Premises", Decimal("475.00"), 2)], self.get_rollups(DailyExpenditure, *fields))
+        self.assertMatchesRebuild(DailyExpenditure, *fields)
+
+    def test_summary(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=100, cost_price=Decimal("1.20"))
+        self.place_order((bread, 10), price="2.00").process_order()
+        expenditure = Expenditure.objects.create(
+            business=self.business,
+            amount=Decimal("5.00"),
+            description="",
+            category="Premises",
+            spent_by=self.user,
+            created_by=self.user,
+            modified_by=self.user,
+        )
+
+        summary = DailySales.get_summary(self.business.id, "month")
+
+        self.assertEqual(1, len(summary))
+        self.assertEqual(rollup_day(expenditure.spent_at).replace(day=1), summary[0]["period"])
+        self.assertEqual(Decimal("20.00"), summary[0]["revenue"])
+        self.assertEqual(Decimal("8.00"), summary[0]["gross_profit"])
+        self.assertEqual({"Premises": Decimal("5.00")}, summary[0]["expenditures_by_category"])
+        self.assertEqual(Decimal("3.00"), summary[0]["net_profit"])
+
+
+class ValuationTest(AnacreonTest):
+    def setUp(self):
+        super().setUp()
+        self.bread, self.milk, self.eggs = self.create_items(3, quantity=100)
+
+        # two intakes of bread at different costs, then two units found damaged
+        self.record_stock(self.bread, 10, "2.00")
+        self.record_stock(self.bread, 10, "3.00")
+        self.record_stock(self.bread, -2, "2.00")
+        self.record_stock(self.milk, 4, "1.25")
+
+        # pending orders haven't sold anything yet
+        self.place_order((self.bread, 2), (self.milk, 1)).process_order()
+        self.place_order((self.bread, 3), (self.milk, 3)).process_order()
+        self.place_order((self.bread, 4))
+
+    def record_stock(self, item, quantity, cost_price):
+        return Stock.objects.create(
+            item=item,
+            quantity=quantity,
+            cost_price=Decimal(cost_price),
+            selling_price=Decimal("5.00"),
+            recorded_by=self.user,
+            created_by=self.user,
+            modified_by=self.user,
+        )
+
+    def test_value_inventory(self):
+        results, totals = to_results(value_inventory(self.business.id))
+
+        # 7 units of bread are gone, all from the first intake, leaving 3 at 2.00 and 10 at 3.00. Eggs have no intakes.
+        self.assertEqual(
+            [
+                {
+                    "item": self.bread.id,
+                    "received": 20,
+                    "on_hand": 13,
+                    "fifo_value": "36.00",
+                    "fifo_unit_cost": "2.77",
+                    "average_cost": "2.50",
+                    "average_value": "32.50",
+                },
+                {
+                    "item": self.milk.id,
+                    "received": 4,
+                    "on_hand": 0,
+                    "fifo_value": "0.00",
+                    "fifo_unit_cost": "0.00",
+                    "average_cost": "1.25",
+                    "average_value": "0.00",
+                },
+            ],
+            results,
+        )
+        self.assertEqual({"items": 2, "on_hand": 13, "fifo_value": "36.00", "average_value": "32.50"}, totals)
+
+        # selling more than was ever taken in leaves nothing rather than a negative amount
+        self.place_order((self.bread, 20)).process_order()
+        results, _ = to_results(value_inventory(self.business.id, [self.bread.id]))
+        self.assertEqual((0, "0.00"), (results[0]["on_hand"], results[0]["fifo_value"]))
+
+    def test_no_stock(self):
+        other = Business.objects.create(name="Other Shop", created_by=self.user, modified_by=self.user)
+
+        self.assertEqual(
+            ([], {"items": 0, "on_hand": 0, "fifo_value": "0.00", "average_value": "0.00"}),
+            to_results(value_inventory(other.id)),
+        )
+        self.assertEqual([], to_results(value_inventory(self.business.id, [self.eggs.id]))[0])
+
+    def test_command(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "valuation.csv")
+
+        out = io.StringIO()
+        call_command("value_inventory", business=[self.business.id], csv=path, stdout=out)
+
+        self.assertEqual(
+            f"Business #{self.business.id}: 2 item(s), 13 unit(s) on hand, FIFO value 36.00, average cost value "
+            f"32.50\nWrote 2 item(s) to {path}\n",
+            out.getvalue(),
+        )
+        with open(path) as f:
+            self.assertEqual(
+                [
+                    "item_id,received,on_hand,fifo_value,fifo_unit_cost,average_cost,average_value,business",
+                    f"{self.bread.id},20,13,36.0,2.77,2.5,32.5,{self.business.id}",
+                    f"{self.milk.id},4,0,0.0,0.0,1.25,0.0,{self.business.id}",
+                ],
+                f.read().splitlines(),
+            )
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class ReplicaRoutingTest(TransactionTestCase):
+    # which includes the replica once it's added, after the test databases have been created
+    databases = "__all__"
+
+    @classmethod
+    def setUpClass(cls):
+        # a second connection to the test database, set up as those of DATABASE_REPLICA_HOSTS are
+        default = connections[DEFAULT_DB_ALIAS].settings_dict
+        connections.settings["replica"] = {**default, "TEST": {**default["TEST"], "MIRROR": DEFAULT_DB_ALIAS}}
+        cls.addClassCleanup(cls.remove_replica)
+        super().setUpClass()
+
+    @classmethod
+    def remove_replica(cls):
+        connections["replica"].close()
+        del connections["replica"]
+        del connections.settings["replica"]
+
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        routers._replica_health.clear()
+        cache.clear()
+
+    def test_reads(self):
+        # reads outside of a request, e.g. by workers, always go to the primary
+        self.assertEqual(DEFAULT_DB_ALIAS, self.router.db_for_read(Item))
+
+        with routers.replica_reads():
+            self.assertEqual("replica", self.router.db_for_read(Item))
+            self.assertEqual(DEFAULT_DB_ALIAS, self.router.db_for_write(Item))
+
+            with transaction.atomic():
+                self.assertEqual(DEFAULT_DB_ALIAS, self.router.db_for_read(Item))
+
+            routers.use_primary()
+            self.assertEqual(DEFAULT_DB_ALIAS, self.router.db_for_read(Item))
+
+        with routers.replica_reads(primary=True):
+            self.assertEqual(DEFAULT_DB_ALIAS, self.router.db_for_read(Item))
+
+        self.assertFalse(self.router.allow_migrate("replica", "anacreon"))
+
+    def test_unhealthy_replica(self):
+        with routers.replica_reads(), patch("gluon.anacreon.routers.get_replica_lag", return_value=60) as get_lag:
+            self.assertEqual(DEFAULT_DB_ALIAS, self.router.db_for_read(Item))
+            self.assertEqual(DEFAULT_DB_ALIAS, self.router.db_for_read(Item))
+
+            # the lag is only checked every REPLICA_CHECK_SECONDS
+            self.assertEqual(1, get_lag.call_count)
+
+        routers._replica_health.clear()
+        with routers.replica_reads(), patch("gluon.anacreon.routers.get_replica_lag", side_effect=OperationalError):
+            self.assertEqual(DEFAULT_DB_ALIAS, self.router.db_for_read(Item))
+
+    def test_middleware(self):
+        user = User.objects.create_user("manager", password="secret")
+        business = Business.objects.create(name="Corner Shop", created_by=user, modified_by=user)
+        BusinessUser.objects.create(user=user, business=business, is_admin=True)
+
+        throttle_rates = patch.dict(ScopedRateThrottle.THROTTLE_RATES, {"v1": None})
+        throttle_rates.start()
+        self.addCleanup(throttle_rates.stop)
+
+        client = APIClient()
+        client.force_login(user)
+        url = f"/api/v1/expenditure.json?business={business.id}"
+
+        def replica_queries(request):
+            # of the endpoint's own tables, as the session and user are read before the client is known
+            with CaptureQueriesContext(connections["replica"]) as queries:
+                self.assertLess(request().status_code, 400)
+            return len([query for query in queries if '"anacreon_' in query["sql"]])
+
+        self.assertGreater(replica_queries(lambda: client.get(url)), 0)
+
+        # after a write the client reads from the primary, by cookie
+        bread = Item.objects.create(business=business, name="Bread", sku="BRD-1", created_by=user, modified_by=user)
+        data = {"business": business.id, "items": [{"item": bread.id, "quantity": 1, "selling_price": "2.50"}]}
+        self.assertEqual(0, replica_queries(lambda: client.post("/api/v1/order/", data, format="json")))
+        self.assertIn(routers.REPLICA_PIN_COOKIE, client.cookies)
+        self.assertEqual(0, replica_queries(lambda: client.get(url)))
+
+        # and by user, for clients which don't keep cookies
+        del client.cookies[routers.REPLICA_PIN_COOKIE]
+        self.assertEqual(0, replica_queries(lambda: client.get(url)))
+
+        cache.clear()
+        self.assertGreater(replica_queries(lambda: client.get(url)), 0)
@@ -0,0 +1,131 @@
+"""
+Valuation of the stock a business has on hand, worked out from its stock intake history and what it has sold. Stock is
+valued both first-in first-out, where units sold are taken from the oldest intakes, and at the weighted average cost of
+everything taken in. All items are valued together with array operations rather than item by item.
+"""
+import numpy as np
+import pandas as pd
+from django.db import connections, router
+from django.db.models import FloatField, Sum
+from django.db.models.functions import Cast
+
+from gluon.anacreon.models import OrderItem, OrderStatus, Stock
+
+VALUATION_FETCH_SIZE = 100_000
+
+VALUATION_COLUMNS = ("received", "on_hand", "fifo_value", "fifo_unit_cost", "average_cost", "average_value")
+
+
+def _read_frame(queryset, columns, dtypes) -> pd.DataFrame:
+    """
+    Reads the rows of a values_list queryset into a data frame in chunks, skipping the building of model instances and
+    of Python objects for every row
+    """
+    sql, params = queryset.query.sql_with_params()
+    frames = []
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        while rows := cursor.fetchmany(VALUATION_FETCH_SIZE):
+            frames.append(pd.DataFrame.from_records(rows, columns=columns))
+
+    if not frames:
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in zip(columns, dtypes)})
+    return pd.concat(frames, ignore_index=True).astype(dict(zip(columns, dtypes)))
+
+
+def load_stock_layers(business_id, item_ids=None, using=None) -> pd.DataFrame:
+    """
+    Loads the stock intakes of a business as item_id, quantity and cost_price columns, oldest first for each item
+    """
+    queryset = Stock.objects.using(using).filter(item__business_id=business_id)
+    if item_ids is not None:
+        queryset = queryset.filter(item_id__in=item_ids)
+
+    # floats for the array arithmetic, whose 15 significant digits keep values exact to the cent below a trillion
+    queryset = queryset.order_by("item_id", "recorded_at", "id").values_list(
+        "item_id", "quantity", Cast("cost_price", FloatField())
+    )
+    return _read_frame(queryset, ["item_id", "quantity", "cost_price"], ["int64", "int64", "float64"])
+
+
+def load_units_sold(business_id, item_ids=None, using=None) -> pd.Series:
+    """
+    Loads the number of units of each item of a business sold by completed orders, totalled by the database
+    """
+    queryset = OrderItem.objects.using(using).filter(
+        order__business_id=business_id, order__status=OrderStatus.COMPLETED
+    )
+    if item_ids is not None:
+        queryset = queryset.filter(item_id__in=item_ids)
+
+    queryset = queryset.order_by().values("item_id").annotate(sold=Sum("quantity")).values_list("item_id", "sold")
+    return _read_frame(queryset, ["item_id", "sold"], ["int64", "int64"]).set_index("item_id")["sold"]
+
+
+def value_stock(layers, sold) -> pd.DataFrame:
+    """
+    Values the stock left of each item given its intake layers, oldest first, and the units of it sold. Negative intakes
+    (corrections) are treated as units sold. Returns a frame indexed by item id with the columns of VALUATION_COLUMNS.
+    """
+    removed = -layers[layers.quantity < 0].groupby("item_id").quantity.sum()
+    layers = layers[layers.quantity > 0]
+    items = layers.item_id.to_numpy()
+    quantity = layers.quantity.to_numpy(dtype=np.float64)
+    cost = layers.cost_price.to_numpy()
+
+    # units taken out of each item, lined up with its layers
+    taken = sold.add(removed, fill_value=0).reindex(items, fill_value=0).to_numpy(dtype=np.float64)
+
+    # what is left of a layer is whatever of the item's intake up to and including it hasn't been taken, capped at the
+    # layer's own quantity, i.e. units are taken from the oldest layers first
+    received_to_date = layers.groupby("item_id", sort=False).quantity.cumsum().to_numpy(dtype=np.float64)
+    remaining = np.clip(received_to_date - taken, 0, quantity)
+
+    totals = pd.DataFrame({
+        "item_id": items,
+        "received": quantity,
+        "on_hand": remaining,
+        "fifo_value": remaining * cost,
+        "intake_cost": quantity * cost,
+    }).groupby("item_id", sort=True).sum()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        totals["fifo_unit_cost"] = np.where(totals.on_hand > 0, totals.fifo_value / totals.on_hand, 0.0)
+        totals["average_cost"] = totals.intake_cost / totals.received
+
+    totals["average_value"] = totals.on_hand * totals.average_cost
+    return totals.astype({"received": "int64", "on_hand": "int64"})[list(VALUATION_COLUMNS)]
+
+
+def value_inventory(business_id, item_ids=None) -> pd.DataFrame:
+    """
+    Values the stock on hand of a business's items, or the given ones, see value_stock. Items without any stock intake
+    are left out.
+    """
+    # read intakes and sales from the same database, replicas can be behind each other
+    using = router.db_for_read(Stock)
+    return value_stock(load_stock_layers(business_id, item_ids, using), load_units_sold(business_id, item_ids, using))
+
+
+def to_results(valuation) -> tuple[list, dict]:
+    """
+    Converts a valuation into a list of items and the totals across them, with amounts as strings of 2 decimal places
+    """
+    rounded = valuation.round(2)
+    money = ["fifo_value", "fifo_unit_cost", "average_cost", "average_value"]
+    results = [
+        {
+            "item": item_id,
+            "received": int(received),
+            "on_hand": int(on_hand),
+            **{field: f"{value:.2f}" for field, value in zip(money, values)},
+        }
+        for item_id, received, on_hand, *values in rounded[list(VALUATION_COLUMNS)].itertuples(name=None)
+    ]
+    totals = {
+        "items": len(valuation),
+        "on_hand": int(valuation.on_hand.sum()),
+        "fifo_value": f"{valuation.fifo_value.sum():.2f}",
+        "average_value": f"{valuation.average_value.sum():.2f}",
+    }
+    return results, totals
@@ -0,0 +1,42 @@
+import base64
+import hashlib
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_safe
+from django.views.static import serve
+
+from gluon.anacreon.models import ItemImage
+
+
+def cache_forever(response):
+    patch_cache_control(response, public=True, max_age=settings.ITEM_IMAGE_CACHE_SECONDS, immutable=True)
+    return response
+
+
+@require_safe
+def item_image_file(request, path):
+    """
+    Serves item image files and thumbnails, which are named by their content so never change. In production the web
+    server in front of us should serve MEDIA_ROOT with the same headers.
+    """
+    return cache_forever(serve(request, f"{settings.ITEM_IMAGE_DIR}/{path}", document_root=settings.MEDIA_ROOT))
+
+
+@require_safe
+def item_image(request, image_id):
+    """
+    Serves an item image which is still stored in the database. Its URL is by id rather than content so it can only be
+    cached for a while, after which clients revalidate it by its ETag.
+    """
+    image = get_object_or_404(ItemImage.objects.only("image", "mimetype"), id=image_id)
+    content = base64.b64decode(image.image)
+    etag = quote_etag(hashlib.sha256(content).hexdigest())
+
+    response = get_conditional_response(request, etag=etag) or HttpResponse(content, content_type=image.mimetype)
+    response["ETag"] = etag
+    patch_cache_control(response, public=True, max_age=settings.ITEM_IMAGE_DATABASE_CACHE_SECONDS)
+    return response
@@ -6,7 +6,8 @@ from django.http import HttpResponseServerError
 from rest_framework import status
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
 from rest_framework.exceptions import APIException, AuthenticationFailed
-from rest_framework.pagination import CursorPagination
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+from rest_framework.utils.urls import replace_query_param
 
 # from quark.workspace.models import User
 from gluon.utils.utils import str_to_bool
@@ -71,6 +72,11 @@ class CreatedOnCursorPagination(CursorPagination):
     offset_cutoff = 100000
 
 
+class IdCursorPagination(CursorPagination):
+    ordering = ("-id",)
+    offset_cutoff = 100000
+
+
 class ModifiedOnCursorPagination(CursorPagination):
     ordering = ("-modified_on", "-id")
     offset_cutoff = 100000
@@ -80,3 +86,85 @@ class ModifiedOnCursorPagination(CursorPagination):
             return "modified_on", "id"
         else:
             return self.ordering
+
+
+class ListPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination which switches to keyset pagination when the request has a cursor param (an empty one
+    for the first page), using the view's cursor_pagination_class. Deep offset pages can also skip counting every
+    matching row with count=false, in which case count is null and we only look one row ahead for the next link.
+    """
+
+    cursor_query_param = "cursor"
+    cursor_page_size = 100
+    cursor_max_page_size = 1000
+    count_query_param = "count"
+
+    cursor_paginator = None
+    has_next = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param in request.query_params:
+            self.cursor_paginator = self.get_cursor_paginator(view)
+            page = self.cursor_paginator.paginate_queryset(queryset, request, view)
+            self.display_page_controls = self.cursor_paginator.display_page_controls
+            return page
+
+        if str_to_bool(request.query_params.get(self.count_query_param, "true")):
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+
+        self.count = None
+        self.offset = self.get_offset(request)
+
+        page = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(page) > self.limit
+        self.display_page_controls = self.has_next or self.offset > 0
+        return page[:self.limit]
+
+    def get_cursor_paginator(self, view):
+        paginator = getattr(view, "cursor_pagination_class", IdCursorPagination)()
+        paginator.cursor_query_param = self.cursor_query_param
+        paginator.page_size = paginator.page_size or self.cursor_page_size
+        paginator.page_size_query_param = paginator.page_size_query_param or self.limit_query_param
+        paginator.max_page_size = paginator.max_page_size or self.cursor_max_page_size
+        return paginator
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_next_link(self):
+        if self.count is not None:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_html_context(self):
+        if self.cursor_paginator:
+            return self.cursor_paginator.get_html_context()
+        if self.count is None:
+            return {"previous_url": self.get_previous_link(), "next_url": self.get_next_link(), "page_links": []}
+        return super().get_html_context()
+
+    def to_html(self):
+        if self.cursor_paginator:
+            return self.cursor_paginator.to_html()
+        return super().to_html()
+
+
+class TimestampCursorPagination(CursorPagination):
+    ordering = ("-timestamp", "-id")
+    offset_cutoff = 100000
+    page_size = 100
+    page_size_query_param = "limit"
+    max_page_size = 1000
@@ -1,3 +1,1213 @@
-from django.test import TestCase
+import base64
+import csv
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest.mock import patch
+from xml.etree import ElementTree
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image as PILImage
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework.throttling import ScopedRateThrottle
+
+from gluon.anacreon.models import (
+    AuditLog,
+    Business,
+    BusinessUser,
+    Category,
+    DailySales,
+    Expenditure,
+    Item,
+    ItemImage,
+    ItemSales,
+    Job,
+    Order,
+    OrderItem,
+    OrderStatus,
+    Stock,
+)
+from gluon.anacreon.jobs import refresh_item_sales
+from gluon.api.v1.serializers import (
+    ExpenditureReadSerializer,
+    ItemReadSerializer,
+    OrderItemReadSerializer,
+    OrderWriteSerializer,
+    StockReadSerializer,
+)
+
+
+class APITest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("manager", password="secret", is_staff=True)
+        self.business = Business.objects.create(name="Corner Shop", created_by=self.user, modified_by=self.user)
+        BusinessUser.objects.create(user=self.user, business=self.business, is_admin=True)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        # no throttling of the v1 scope
+        throttle_rates = patch.dict(ScopedRateThrottle.THROTTLE_RATES, {"v1": None})
+        throttle_rates.start()
+        self.addCleanup(throttle_rates.stop)
+
+    def create_item(self, name, sku, business=None, **kwargs):
+        return Item.objects.create(
+            business=business or self.business,
+            name=name,
+            sku=sku,
+            created_by=self.user,
+            modified_by=self.user,
+            **kwargs,
+        )
+
+    def create_expenditure(self, amount, category="Premises", business=None):
+        return Expenditure.objects.create(
+            business=business or self.business,
+            amount=Decimal(amount),
+            description=category,
+            category=category,
+            spent_by=self.user,
+            created_by=self.user,
+            modified_by=self.user,
+        )
+
+    def order_data(self, *lines):
+        return {
+            "business": self.business.id,
+            "items": [{"item": item.id, "quantity": quantity, "selling_price": "2.50"} for item, quantity in lines],
+        }
+
+
+class OrderBatchTest(APITest):
+    def test_failed_order_rolled_back(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=5)
+        orders = [self.order_data((bread, 2)), self.order_data((bread, 10))]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/v1/order/?batch=true", {"orders": orders, "process": True}, format="json")
+
+        self.assertEqual(200, response.status_code)
+        placed, failed = response.data["results"]
+        self.assertTrue(placed["success"])
+        self.assertEqual(OrderStatus.COMPLETED, placed["status"])
+        self.assertFalse(failed["success"])
+        self.assertEqual(
+            {"non_field_errors": ["Item 'Bread' is out of stock or insufficient quantity."]}, failed["errors"]
+        )
+
+        # nothing of the failed order is left, not even its audit entry
+        self.assertEqual([placed["id"]], list(Order.objects.values_list("id", flat=True)))
+        self.assertEqual(
+            {placed["id"]}, set(AuditLog.objects.filter(model="Order").values_list("object_id", flat=True))
+        )
+        bread.refresh_from_db()
+        self.assertEqual(3, bread.quantity)
+
+    def test_all_orders_failed(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/api/v1/order/?batch=true",
+                {"orders": [self.order_data((bread, 2)), {"business": self.business.id, "items": []}], "process": True},
+                format="json",
+            )
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([False, False], [result["success"] for result in response.data["results"]])
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(AuditLog.objects.exists())
+        bread.refresh_from_db()
+        self.assertEqual(1, bread.quantity)
+
+
+    def test_related_preloaded(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=10)
+        customers = [User.objects.create_user(f"customer{i}") for i in range(3)]
+        orders = [dict(self.order_data((bread, 1)), customer=customer.id) for customer in customers]
+
+        # unknown businesses and customers are still reported per order
+        orders.append(dict(self.order_data((bread, 1)), business=self.business.id + 100))
+        orders.append(dict(self.order_data((bread, 1)), customer=customers[-1].id + 100))
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/v1/order/?batch=true", {"orders": orders}, format="json")
+
+        self.assertEqual(200, response.status_code)
+        results = response.data["results"]
+        self.assertEqual([True, True, True, False, False], [result["success"] for result in results])
+        self.assertIn("business", results[3]["errors"])
+        self.assertIn("customer", results[4]["errors"])
+        self.assertEqual(
+            [customer.id for customer in customers],
+            list(Order.objects.order_by("id").values_list("customer", flat=True)),
+        )
+
+        # one query each for the businesses and customers of the whole batch
+        selects = [query["sql"] for query in queries if query["sql"].startswith("SELECT")]
+        self.assertEqual(1, len([sql for sql in selects if 'FROM "anacreon_business" WHERE' in sql]))
+        self.assertEqual(1, len([sql for sql in selects if 'FROM "auth_user" WHERE "auth_user"."id" IN' in sql]))
+
+class OrderWriteTest(APITest):
+    def validate(self, data, **context):
+        serializer = OrderWriteSerializer(data=data, context=dict(context, user=self.user))
+        return serializer.is_valid(), serializer
+
+    def test_items_resolved_together(self):
+        items = [self.create_item(f"Item {i}", f"ITM-{i}", quantity=10) for i in range(5)]
+
+        with CaptureQueriesContext(connection) as queries:
+            valid, serializer = self.validate(self.order_data(*[(item, 1) for item in items]))
+
+        self.assertTrue(valid)
+        self.assertEqual(1, len([query for query in queries if 'FROM "anacreon_item"' in query["sql"]]))
+        self.assertEqual(items, [line["item"] for line in serializer.validated_data["items"]])
+
+    def test_unknown_items(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=10)
+        other = Business.objects.create(name="Other Shop", created_by=self.user, modified_by=self.user)
+        foreign = self.create_item("Milk", "MLK-1", business=other, quantity=10)
+
+        valid, serializer = self.validate(
+            {
+                "business": self.business.id,
+                "items": [
+                    {"item": item_id, "quantity": 1, "selling_price": "2.50"}
+                    for item_id in (bread.id, foreign.id, foreign.id + 100)
+                ],
+            }
+        )
+        self.assertFalse(valid)
+        self.assertEqual(
+            [f"No such item for this business: {foreign.id}, {foreign.id + 100}"],
+            serializer.errors["items"],
+        )
+
+        # items preloaded by a batch are checked against the business of the order too
+        valid, serializer = self.validate(self.order_data((foreign, 1)), items={foreign.id: foreign})
+        self.assertFalse(valid)
+        self.assertEqual([f"No such item for this business: {foreign.id}"], serializer.errors["items"])
+        self.assertFalse(Order.objects.exists())
+
+class JobTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.other_user = User.objects.create_user("rival", password="secret")
+        self.other_business = Business.objects.create(
+            name="Rival Shop", created_by=self.other_user, modified_by=self.other_user
+        )
+
+    def test_process_order_job(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=5)
+        order = Order.place_order(self.business, [{"item": bread, "quantity": 1, "selling_price": 2}], user=self.user)
+
+        response = self.client.post(f"/api/v1/order/process/?id={order.id}")
+        self.assertEqual(202, response.status_code)
+
+        job = Job.objects.get(id=response.data["job"])
+        self.assertEqual((self.business, self.user), (job.business, job.created_by))
+
+        response = self.client.get(f"/api/v1/job.json?id={job.id}")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([job.id], [result["id"] for result in response.data])
+
+    def test_scoped_to_user(self):
+        own = Job.enqueue("process_order", {"order_id": 1}, user=self.user)
+        business = Job.enqueue("process_order", {"order_id": 2}, business=self.business)
+        rival = Job.enqueue("process_order", {"order_id": 3}, business=self.other_business, user=self.other_user)
+        periodic = Job.enqueue("refresh_item_sales")
+
+        response = self.client.get("/api/v1/job.json")
+        self.assertEqual([business.id, own.id], [result["id"] for result in response.data])
+
+        for job in (rival, periodic):
+            self.assertEqual(404, self.client.get(f"/api/v1/job.json?id={job.id}").status_code)
+
+        # superusers see everything
+        self.client.force_authenticate(User.objects.create_superuser("admin", password="secret"))
+        response = self.client.get("/api/v1/job.json")
+        self.assertEqual(
+            [periodic.id, rival.id, business.id, own.id], [result["id"] for result in response.data]
+        )
+
+        self.client.force_authenticate(None)
+        self.assertEqual(404, self.client.get(f"/api/v1/job.json?id={own.id}").status_code)
+
+
+class ListValidationTest(APITest):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+        self.expenditures = [
+            Expenditure.objects.create(
+                business=self.business,
+                amount=amount,
+                description="Rent",
+                category="Premises",
+                spent_by=self.user,
+                created_by=self.user,
+                modified_by=self.user,
+            )
+            for amount in (100, 200, 300)
+        ]
+
+    def assertRevalidates(self, url):
+        """
+        Checks a list is a 304 until an object on it is changed or deleted, returning the queries of the 304 response
+        """
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("private, no-cache", response["Cache-Control"])
+        etag, page = response["ETag"], response.data["results"]
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response["ETag"])
+        queries = context.captured_queries  # before the next request resets the query log
+
+        expenditure = Expenditure.objects.get(id=page[0]["id"])
+        expenditure.amount = 350
+        expenditure.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response["ETag"])
+        etag = response["ETag"]
+
+        expenditure.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response["ETag"])
+
+        return queries
+
+    def test_counted(self):
+        queries = self.assertRevalidates(f"/api/v1/expenditure.json?business={self.business.id}&limit=2")
+        self.assertTrue(any("COUNT(" in query["sql"] for query in queries))
+
+    def test_uncounted(self):
+        queries = self.assertRevalidates(f"/api/v1/expenditure.json?business={self.business.id}&limit=2&count=false")
+        self.assertFalse(any("COUNT(" in query["sql"] for query in queries))
+
+    def test_cursor(self):
+        queries = self.assertRevalidates(f"/api/v1/expenditure.json?business={self.business.id}&limit=2&cursor=")
+        self.assertFalse(any("COUNT(" in query["sql"] for query in queries))
+
+        # only the newest two are on the first page, the oldest changing doesn't change it
+        response = self.client.get(f"/api/v1/expenditure.json?business={self.business.id}&limit=1&cursor=")
+        Expenditure.objects.filter(id=self.expenditures[0].id).update(amount=150)
+        response = self.client.get(
+            f"/api/v1/expenditure.json?business={self.business.id}&limit=1&cursor=", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(304, response.status_code)
+
+    def test_fields(self):
+        # modified_on isn't a field of expenditures but is still read to validate the page by
+        url = f"/api/v1/expenditure.json?business={self.business.id}&limit=2&count=false&fields=id,amount"
+        self.assertRevalidates(url)
+
+    def test_cached_list(self):
+        item = self.create_item("Bread", "BRD-1")
+        url = f"/api/v1/item.json?business={self.business.id}&count=false&limit=10"
+
+        response = self.client.get(url)
+        etag = response["ETag"]
+        with self.assertNumQueries(0):
+            self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        # writes invalidate the cached list once they commit
+        with self.captureOnCommitCallbacks(execute=True):
+            item.name = "Brown Bread"
+            item.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(["Brown Bread"], [result["name"] for result in response.data["results"]])
+
+
+class PaginationTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.expenditures = [
+            Expenditure.objects.create(
+                business=self.business,
+                amount=amount,
+                description="Stock",
+                category="Supplies",
+                spent_by=self.user,
+                created_by=self.user,
+                modified_by=self.user,
+            )
+            for amount in range(1, 8)
+        ]
+
+    def test_cursor(self):
+        url = f"/api/v1/expenditure.json?business={self.business.id}&limit=3&cursor="
+        seen = []
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            self.assertNotIn("count", response.data)
+            self.assertFalse(any("COUNT(" in query["sql"] for query in context.captured_queries))
+            self.assertLessEqual(len(response.data["results"]), 3)
+
+            seen += [result["id"] for result in response.data["results"]]
+            url = response.data["next"]
+
+        # newest first, each exactly once
+        self.assertEqual([expenditure.id for expenditure in reversed(self.expenditures)], seen)
+
+    def test_uncounted(self):
+        url = f"/api/v1/expenditure.json?business={self.business.id}&limit=3&count=false"
+
+        response = self.client.get(url)
+        self.assertIsNone(response.data["count"])
+        self.assertEqual(3, len(response.data["results"]))
+        self.assertIn("offset=3", response.data["next"])
+
+        response = self.client.get(url + "&offset=6")
+        self.assertEqual(1, len(response.data["results"]))
+        self.assertIsNone(response.data["next"])
+        self.assertIn("offset=3", response.data["previous"])
+
+    def test_counted(self):
+        response = self.client.get(f"/api/v1/expenditure.json?business={self.business.id}&limit=3&offset=3")
+        self.assertEqual(7, response.data["count"])
+        self.assertEqual(3, len(response.data["results"]))
+
+
+class ValuesSerializationTest(APITest):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(business=self.business, name="Bakery")
+        self.bread = self.create_item(
+            "Brown Bread",
+            "BRD-1",
+            category=category,
+            description="Sliced\n\"wholemeal\"",
+            properties={"colour": "brøwn", "sizes": [400, 800], "organic": True, "extra": None},
+            cost_price=Decimal("1234.5"),
+            last_selling_price=Decimal("0.1"),
+            quantity=12,
+        )
+        self.milk = self.create_item("Milk 🥛", "MLK-1", description="")
+
+        Stock.objects.create(
+            item=self.bread,
+            quantity=-3,
+            cost_price=Decimal("2.25"),
+            selling_price=Decimal("3"),
+            recorded_by=self.user,
+            created_by=self.user,
+            modified_by=self.user,
+        )
+        Stock.objects.create(
+            item=self.milk,
+            quantity=5,
+            cost_price=Decimal("0.99"),
+            selling_price=Decimal("1.5"),
+            recorded_by=None,
+            created_by=self.user,
+            modified_by=self.user,
+        )
+        Expenditure.objects.create(
+            business=self.business,
+            amount=Decimal("99999.99"),
+            description="Rent <for> October & November",
+            category="Premises",
+            spent_by=None,
+            created_by=self.user,
+            modified_by=self.user,
+        )
+        Order.place_order(
+            self.business,
+            [
+                {"item": self.bread, "quantity": 2, "selling_price": Decimal("3.333")},
+                {"item": self.milk, "quantity": 1, "selling_price": Decimal("1.50")},
+            ],
+            user=self.user,
+        )
+
+    def assertSameAsInstances(self, url, model, serializer_class, **params):
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+
+        ids = [row["id"] for row in response.data]
+        self.assertEqual(model.objects.count(), len(ids))
+        objects = model.objects.in_bulk(ids)
+        context = {"fields": set(params.get("fields", ())), "exclude": set()}
+        expected = serializer_class([objects[i] for i in ids], many=True, context=context).data
+
+        self.assertEqual(JSONRenderer().render(expected), response.content)
+
+    def test_parity(self):
+        business = self.business.id
+        self.assertSameAsInstances(f"/api/v1/item.json?business={business}", Item, ItemReadSerializer)
+        self.assertSameAsInstances(f"/api/v1/stock.json?business={business}", Stock, StockReadSerializer)
+        self.assertSameAsInstances(
+            f"/api/v1/expenditure.json?business={business}", Expenditure, ExpenditureReadSerializer
+        )
+        self.assertSameAsInstances(f"/api/v1/orderitem.json?business={business}", OrderItem, OrderItemReadSerializer)
+
+    def test_parity_with_fields(self):
+        self.assertSameAsInstances(
+            f"/api/v1/item.json?business={self.business.id}&fields=id,properties,cost_price",
+            Item,
+            ItemReadSerializer,
+            fields=("id", "properties", "cost_price"),
+        )
+
+    def test_rows_not_instances(self):
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(f"/api/v1/orderitem.json?business={self.business.id}")
+
+        # one query for the rows, none for the order and item of each
+        selects = [query["sql"] for query in context.captured_queries if query["sql"].startswith("SELECT")]
+        self.assertEqual(1, len(selects))
+
+
+class SparseFieldsetTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.bread = self.create_item(
+            "Brown Bread", "BRD-1", description="Sliced wholemeal", properties={"colour": "brown"}
+        )
+        self.image = ItemImage.objects.create(item=self.bread, image="aGVsbG8=", mimetype="image/png", color="brown")
+
+    def get_list(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+
+        self.assertEqual(200, response.status_code)
+        return response.data, "\n".join(query["sql"] for query in context.captured_queries)
+
+    def test_fields(self):
+        rows, sql = self.get_list(f"/api/v1/item.json?business={self.business.id}&fields=id,name")
+
+        self.assertEqual([{"id": self.bread.id, "name": "Brown Bread"}], rows)
+        self.assertIn('"anacreon_item"."name"', sql)
+        self.assertNotIn('"anacreon_item"."description"', sql)
+        self.assertNotIn('"anacreon_item"."properties"', sql)
+
+    def test_exclude(self):
+        rows, sql = self.get_list(f"/api/v1/item.json?business={self.business.id}&exclude=description,properties")
+
+        self.assertEqual("Brown Bread", rows[0]["name"])
+        self.assertNotIn("description", rows[0])
+        self.assertNotIn("properties", rows[0])
+        self.assertIn('"anacreon_item"."sku"', sql)
+        self.assertNotIn('"anacreon_item"."description"', sql)
+        self.assertNotIn('"anacreon_item"."properties"', sql)
+
+    def test_computed_fields(self):
+        rows, sql = self.get_list(f"/api/v1/itemimage.json?business={self.business.id}&fields=id,color")
+
+        self.assertEqual([{"id": self.image.id, "color": "brown"}], rows)
+        self.assertNotIn('"anacreon_itemimage"."file"', sql)
+        self.assertNotIn('"anacreon_itemimage"."thumbnail"', sql)
+
+        # the url is built from the file column, but the image content is never read for it
+        rows, sql = self.get_list(f"/api/v1/itemimage.json?business={self.business.id}&fields=id,url")
+
+        self.assertEqual({"id", "url"}, set(rows[0]))
+        self.assertIn('"anacreon_itemimage"."file"', sql)
+        self.assertNotIn('"anacreon_itemimage"."image"', sql)
+
+    def test_invalid(self):
+        response = self.client.get(f"/api/v1/item.json?business={self.business.id}&fields=id,colour")
+        self.assertEqual(400, response.status_code)
+
+        response = self.client.get(f"/api/v1/item.json?business={self.business.id}&fields=id&exclude=name")
+        self.assertEqual(400, response.status_code)
+
+
+class SalesSummaryTest(APITest):
+    def setUp(self):
+        super().setUp()
+        bread = self.create_item("Bread", "BRD-1", quantity=100, cost_price=Decimal("1.20"))
+        order = Order.place_order(
+            self.business, [{"item": bread, "quantity": 10, "selling_price": Decimal("2.00")}], user=self.user
+        )
+        order.process_order()
+        self.create_expenditure("5.00", "Premises")
+        self.create_expenditure("2.50", "Staff")
+        self.today = timezone.localdate()
+
+    def test_summary(self):
+        response = self.client.get(f"/api/v1/summary.json?business={self.business.id}&period=day")
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [
+                {
+                    "period": self.today.isoformat(),
+                    "revenue": "20.00",
+                    "units_sold": 10,
+                    "cost_of_goods": "12.00",
+                    "orders": 1,
+                    "cancelled_orders": 0,
+                    "gross_profit": "8.00",
+                    "expenditures": "7.50",
+                    "expenditures_by_category": {"Premises": "5.00", "Staff": "2.50"},
+                    "net_profit": "0.50",
+                }
+            ],
+            response.data["results"],
+        )
+
+        # days outside start to end are left out
+        response = self.client.get(
+            f"/api/v1/summary.json?business={self.business.id}&start=2001-01-01&end=2001-12-31"
+        )
+        self.assertEqual([], response.data["results"])
+
+    def test_expenditures_only(self):
+        other = Business.objects.create(name="Other Shop", created_by=self.user, modified_by=self.user)
+        self.create_expenditure("5.00", business=other)
+
+        response = self.client.get(f"/api/v1/summary.json?business={other.id}&period=year")
+
+        totals = response.data["results"][0]
+        self.assertEqual(self.today.replace(month=1, day=1).isoformat(), totals["period"])
+        self.assertEqual(("0.00", "0.00", "0.00"), (totals["revenue"], totals["cost_of_goods"], totals["gross_profit"]))
+        self.assertEqual((0, 0, 0), (totals["units_sold"], totals["orders"], totals["cancelled_orders"]))
+        self.assertEqual(("5.00", "-5.00"), (totals["expenditures"], totals["net_profit"]))
+
+    def test_invalid(self):
+        url = f"/api/v1/summary.json?business={self.business.id}"
+        self.assertEqual(400, self.client.get("/api/v1/summary.json").status_code)
+        self.assertEqual(400, self.client.get(url + "&period=week").status_code)
+        self.assertEqual(400, self.client.get(url + "&start=May").status_code)
+
+    def test_rebuild_command(self):
+        expected = list(DailySales.objects.values_list("day", *DailySales.TOTALS))
+        DailySales.objects.all().delete()
+
+        # days outside the range aren't rebuilt
+        call_command(
+            "rebuild_rollups",
+            business=[self.business.id],
+            start=self.today.replace(year=2001),
+            end=self.today.replace(year=2002),
+            stdout=io.StringIO(),
+        )
+        self.assertFalse(DailySales.objects.exists())
+
+        out = io.StringIO()
+        call_command("rebuild_rollups", business=[self.business.id], stdout=out)
+        self.assertEqual(expected, list(DailySales.objects.values_list("day", *DailySales.TOTALS)))
+        self.assertIn(
+            f"Business #{self.business.id}: 1 day(s) of sales, 2 day and category expenditure(s)", out.getvalue()
+        )
+
+
+class SalesExportTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.bread = self.create_item("Bread & <Butter>\x01", "BRD-1", quantity=100)
+        self.milk = self.create_item("Mjölk", "MLK-1", quantity=100)
+
+        self.orders = []
+        for day, lines in ((1, [(self.bread, 2), (self.milk, 1)]), (2, [(self.milk, 3)])):
+            order = Order.place_order(
+                self.business,
+                [{"item": item, "quantity": quantity, "selling_price": Decimal("1.25")} for item, quantity in lines],
+                user=self.user,
+            )
+            order.process_order()
+            Order.objects.filter(id=order.id).update(completed_at=datetime(2026, 3, day, 12, tzinfo=dt_timezone.utc))
+            self.orders.append(order)
+
+        # pending orders aren't sales
+        Order.place_order(
+            self.business, [{"item": self.bread, "quantity": 1, "selling_price": Decimal("1.25")}], user=self.user
+        )
+
+    def export(self, file_type, **data):
+        response = self.client.post(
+            "/api/v1/export/sales/", {"business": self.business.id, "file_type": file_type, **data}, format="json"
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        self.assertRegex(
+            response["Content-Disposition"], rf'^attachment; filename="sales-{self.business.id}-\d+\.{file_type}"$'
+        )
+        return b"".join(response.streaming_content)
+
+    def test_streamed(self):
+        with patch("gluon.utils.exports.EXPORT_CHUNK_ROWS", 1):
+            for file_type in ("csv", "xlsx"):
+                response = self.client.post(
+                    "/api/v1/export/sales/", {"business": self.business.id, "file_type": file_type}, format="json"
+                )
+                # the header, then each chunk of rows as it's read, and for xlsx the end of the archive
+                chunks = list(response.streaming_content)
+                self.assertEqual(5 if file_type == "xlsx" else 4, len(chunks))
+
+    def test_csv(self):
+        header, *rows = csv.reader(io.StringIO(self.export("csv").decode("utf-8")))
+
+        first, second = self.orders
+        self.assertEqual(["order", "completed_at", "item", "sku", "quantity", "selling_price", "total"], header)
+        self.assertEqual(
+            [
+                [str(first.id), "2026-03-01T12:00:00+00:00", "Bread & <Butter>\x01", "BRD-1", "2", "1.25"],
+                [str(first.id), "2026-03-01T12:00:00+00:00", "Mjölk", "MLK-1", "1", "1.25"],
+                [str(second.id), "2026-03-02T12:00:00+00:00", "Mjölk", "MLK-1", "3", "1.25"],
+            ],
+            [row[:-1] for row in rows],
+        )
+        # the scale of the total depends on the database
+        self.assertEqual([Decimal("2.50"), Decimal("1.25"), Decimal("3.75")], [Decimal(row[-1]) for row in rows])
+
+    def test_filtered(self):
+        rows = list(csv.reader(io.StringIO(self.export("csv", after="2026-03-02T00:00:00Z").decode("utf-8"))))
+        self.assertEqual([str(self.orders[1].id)], [row[0] for row in rows[1:]])
+
+        rows = list(csv.reader(io.StringIO(self.export("csv", before="2026-03-02T00:00:00Z").decode("utf-8"))))
+        self.assertEqual([str(self.orders[0].id)] * 2, [row[0] for row in rows[1:]])
+
+    def test_xlsx(self):
+        archive = zipfile.ZipFile(io.BytesIO(self.export("xlsx")))
+
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(
+            ["[Content_Types].xml", "_rels/.rels", "xl/workbook.xml", "xl/_rels/workbook.xml.rels",
+             "xl/worksheets/sheet1.xml"],
+            archive.namelist(),
+        )
+        content_types = ElementTree.fromstring(archive.read("[Content_Types].xml"))
+        self.assertIn(
+            "/xl/worksheets/sheet1.xml", [override.get("PartName") for override in content_types.iter()],
+        )
+
+        namespace = {"s": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+        sheet = ElementTree.fromstring(archive.read("xl/worksheets/sheet1.xml"))
+        rows = [
+            [
+                (cell.get("t"), cell.findtext("s:is/s:t", None, namespace) or cell.findtext("s:v", None, namespace))
+                for cell in row.findall("s:c", namespace)
+            ]
+            for row in sheet.findall("s:sheetData/s:row", namespace)
+        ]
+        self.assertEqual(4, len(rows))
+        self.assertEqual(("inlineStr", "order"), rows[0][0])
+        self.assertEqual(
+            [
+                (None, str(self.orders[0].id)),
+                ("inlineStr", "2026-03-01T12:00:00+00:00"),
+                ("inlineStr", "Bread & <Butter>"),  # without the character XML doesn't allow
+                ("inlineStr", "BRD-1"),
+                (None, "2"),
+                (None, "1.25"),
+            ],
+            rows[1][:-1],
+        )
+        self.assertEqual((None, Decimal("2.50")), (rows[1][-1][0], Decimal(rows[1][-1][1])))
+
+    def test_invalid_file_type(self):
+        response = self.client.post(
+            "/api/v1/export/sales/", {"business": self.business.id, "file_type": "pdf"}, format="json"
+        )
+        self.assertEqual(400, response.status_code)
+
+
+class ItemImageTest(APITest):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.bread = self.create_item("Bread", "BRD-1")
+
+    def image_content(self, color="red", image_format="PNG"):
+        out = io.BytesIO()
+        PILImage.new("RGB", (640, 480), color).save(out, image_format)
+        return out.getvalue()
+
+    def upload(self, content, as_file=True, **data):
+        if as_file:
+            data = {"item": self.bread.id, "file": SimpleUploadedFile("bread.png", content), **data}
+            return self.client.post("/api/v1/itemimage/", data, format="multipart")
+
+        data = {"item": self.bread.id, "image": base64.b64encode(content).decode(), **data}
+        return self.client.post("/api/v1/itemimage/", data, format="json")
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(path, name), settings.MEDIA_ROOT)
+            for path, _, names in os.walk(settings.MEDIA_ROOT)
+            for name in names
+        )
+
+
+class ItemImageUploadTest(ItemImageTest):
+    def test_file_storage(self):
+        content = self.image_content()
+        with patch("gluon.api.v1.views.TemporaryFileUploadHandler", wraps=TemporaryFileUploadHandler) as handler:
+            response = self.upload(content, color="red")
+
+        # multipart uploads are written to a temporary file as they arrive rather than held in memory
+        handler.assert_called_once()
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(("image/png", "red"), (response.data["mimetype"], response.data["color"]))
+
+        image = ItemImage.objects.get()
+        checksum = hashlib.sha256(content).hexdigest()
+        self.assertEqual(("", checksum), (image.image, image.checksum))
+        self.assertEqual(f"items/{checksum[:2]}/{checksum}.png", image.file.name)
+        with image.file.open("rb") as f:
+            self.assertEqual(content, f.read())
+
+        # the same content as base64 is stored in the same file
+        self.assertEqual(201, self.upload(content, as_file=False).status_code)
+        self.assertEqual([image.file.name], list(ItemImage.objects.values_list("file", flat=True).distinct()))
+        self.assertEqual(
+            [f"items/{checksum[:2]}/{checksum}.png", f"items/{checksum[:2]}/{checksum}.thumb.webp"],
+            [path for path in self.stored_files() if "incoming" not in path],
+        )
+        self.assertEqual([], os.listdir(os.path.join(settings.MEDIA_ROOT, "items", "incoming")))
+
+    @override_settings(ITEM_IMAGE_STORAGE="database")
+    def test_database_storage(self):
+        content = self.image_content(image_format="JPEG")
+
+        self.assertEqual(201, self.upload(content).status_code)
+        self.assertEqual(201, self.upload(content, as_file=False).status_code)
+
+        for image in ItemImage.objects.all():
+            self.assertEqual(("", "image/jpeg"), (image.file.name, image.mimetype))
+            self.assertEqual(content, base64.b64decode(image.image))
+        self.assertEqual([], self.stored_files())
+
+    @override_settings(ITEM_IMAGE_MAX_BYTES=1000, ITEM_IMAGE_CHUNK_BYTES=256)
+    def test_too_large(self):
+        for as_file in (True, False):
+            response = self.upload(self.image_content(color="blue") + bytes(1000), as_file=as_file)
+
+            self.assertEqual(400, response.status_code)
+            self.assertEqual({"file": ["Images can't be larger than 1000 bytes"]}, response.data)
+
+        # nothing is left of the partly written upload
+        self.assertFalse(ItemImage.objects.exists())
+        self.assertEqual([], self.stored_files())
+
+    def test_not_image(self):
+        for as_file in (True, False):
+            response = self.upload(b"%PDF-1.7\n" + bytes(100), as_file=as_file)
+
+            self.assertEqual(400, response.status_code)
+            self.assertIn("Images must be one of", response.data["file"][0])
+
+        data = {"item": self.bread.id, "image": "not base64!"}
+        response = self.client.post("/api/v1/itemimage/", data, format="json")
+        self.assertEqual({"image": ["Must be base64 encoded."]}, response.data)
+        self.assertFalse(ItemImage.objects.exists())
+
+
+class ItemImageStorageTest(ItemImageTest):
+    def get_image(self):
+        response = self.client.get(f"/api/v1/itemimage.json?business={self.business.id}")
+        self.assertEqual(200, response.status_code)
+        return response.data[0]
+
+    def test_thumbnail(self):
+        self.upload(self.image_content())
+        image = ItemImage.objects.get()
+
+        with PILImage.open(image.thumbnail) as thumbnail:
+            self.assertEqual(("WEBP", (320, 240)), (thumbnail.format, thumbnail.size))
+
+        # images which can't be decoded are kept without a thumbnail
+        self.assertEqual(201, self.upload(b"\x89PNG\r\n\x1a\n" + bytes(100)).status_code)
+        self.assertEqual("", ItemImage.objects.latest("id").thumbnail.name)
+
+    def test_file_urls(self):
+        self.upload(self.image_content())
+        image = ItemImage.objects.get()
+
+        data = self.get_image()
+        self.assertEqual(f"http://testserver/media/{image.file.name}", data["url"])
+        self.assertEqual(f"http://testserver/media/{image.thumbnail.name}", data["thumbnail_url"])
+
+        # files are named by their content so are cached forever
+        response = self.client.get(data["url"])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.image_content(), b"".join(response.streaming_content))
+        self.assertEqual("public, max-age=31536000, immutable", response["Cache-Control"])
+
+    @override_settings(ITEM_IMAGE_STORAGE="database")
+    def test_database_urls(self):
+        self.upload(self.image_content())
+        image = ItemImage.objects.get()
+
+        data = self.get_image()
+        self.assertEqual(f"http://testserver/itemimage/{image.id}/", data["url"])
+        self.assertIsNone(data["thumbnail_url"])
+
+        # the URL of the image stays the same if its content changes, so it's revalidated rather than cached forever
+        response = self.client.get(data["url"])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.image_content(), response.content)
+        self.assertEqual("public, max-age=300", response["Cache-Control"])
+
+        self.assertEqual(304, self.client.get(data["url"], HTTP_IF_NONE_MATCH=response["ETag"]).status_code)
+
+        image.image = base64.b64encode(self.image_content(color="blue")).decode()
+        image.save()
+        response = self.client.get(data["url"], HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual((200, self.image_content(color="blue")), (response.status_code, response.content))
+
+    def test_migrate_item_images(self):
+        with override_settings(ITEM_IMAGE_STORAGE="database"):
+            self.upload(self.image_content())
+            self.upload(self.image_content())
+            self.upload(self.image_content(color="blue"))
+        broken = ItemImage.objects.create(item=self.bread, image="not base64!", mimetype="image/png")
+
+        out = io.StringIO()
+        call_command("migrate_item_images", dry_run=True, stdout=out)
+        self.assertEqual("Would move 4 image(s)\n", out.getvalue())
+        self.assertEqual([], self.stored_files())
+
+        out, err = io.StringIO(), io.StringIO()
+        call_command("migrate_item_images", batch_size=2, stdout=out, stderr=err)
+        self.assertEqual("Moved 2 image(s)\nMoved 3 image(s)\n", out.getvalue())
+        self.assertEqual(f"Skipping image #{broken.id} which isn't valid base64\n", err.getvalue())
+
+        images = ItemImage.objects.exclude(id=broken.id).order_by("id")
+        self.assertEqual({""}, {image.image for image in images})
+        self.assertEqual(images[0].file.name, images[1].file.name)
+        for image in images:
+            with image.file.open("rb") as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), image.checksum)
+            self.assertTrue(image.thumbnail.name.endswith(".thumb.webp"))
+        self.assertEqual(4, len(self.stored_files()))
+
+        # the image which couldn't be moved is left as it was
+        broken.refresh_from_db()
+        self.assertEqual(("not base64!", ""), (broken.image, broken.file.name))
+
+
+class InventoryValuationTest(APITest):
+    def test_valuation(self):
+        bread = self.create_item("Bread", "BRD-1", quantity=100)
+        milk = self.create_item("Milk", "MLK-1", quantity=100)
+        for item, quantity, cost_price in ((bread, 10, "2.00"), (bread, 10, "3.00"), (milk, 4, "1.25")):
+            Stock.objects.create(
+                item=item,
+                quantity=quantity,
+                cost_price=Decimal(cost_price),
+                selling_price=Decimal("5.00"),
+                created_by=self.user,
+                modified_by=self.user,
+            )
+        order = Order.place_order(
+            self.business, [{"item": bread, "quantity": 12, "selling_price": Decimal("5.00")}], user=self.user
+        )
+        order.process_order()
+
+        response = self.client.get(f"/api/v1/valuation.json?business={self.business.id}")
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [(bread.id, 8, "24.00", "20.00"), (milk.id, 4, "5.00", "5.00")],
+            [(r["item"], r["on_hand"], r["fifo_value"], r["average_value"]) for r in response.data["results"]],
+        )
+        self.assertEqual(
+            {"items": 2, "on_hand": 12, "fifo_value": "29.00", "average_value": "25.00"}, response.data["totals"]
+        )
+
+        response = self.client.get(f"/api/v1/valuation.json?business={self.business.id}&item={milk.id}")
+        self.assertEqual([milk.id], [r["item"] for r in response.data["results"]])
+
+    def test_invalid(self):
+        self.assertEqual(400, self.client.get("/api/v1/valuation.json").status_code)
+
+
+class StockLatestTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.bread = self.create_item("Bread", "BRD-1")
+        self.milk = self.create_item("Milk", "MLK-1")
+        other = Business.objects.create(name="Other Shop", created_by=self.user, modified_by=self.user)
+        eggs = self.create_item("Eggs", "EGG-1", business=other)
+
+        # entries can be recorded out of order, and at the same time where the later one wins
+        self.bread_entries = [self.record_stock(self.bread, day) for day in (1, 3, 2)]
+        self.milk_entries = [self.record_stock(self.milk, day) for day in (1, 1)]
+        self.record_stock(eggs, 4)
+
+    def record_stock(self, item, day):
+        stock = Stock.objects.create(
+            item=item,
+            quantity=1,
+            cost_price=Decimal("1.00"),
+            selling_price=Decimal("2.00"),
+            created_by=self.user,
+            modified_by=self.user,
+        )
+        Stock.objects.filter(id=stock.id).update(recorded_at=datetime(2026, 3, day, tzinfo=dt_timezone.utc))
+        return stock
+
+    def get_ids(self, params):
+        url = f"/api/v1/stock.json?business={self.business.id}&{params}"
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            ids += [row["id"] for row in response.data["results"]]
+            url = response.data["next"]
+        return ids
+
+    def test_latest(self):
+        latest = [self.bread_entries[1].id, self.milk_entries[1].id]
+
+        self.assertEqual(sorted(latest), sorted(self.get_ids("latest=true&limit=1")))
+        self.assertEqual(sorted(latest), sorted(self.get_ids("latest=true&limit=1&cursor=")))
+
+        response = self.client.get(f"/api/v1/stock.json?business={self.business.id}&latest=true&limit=10&count=true")
+        self.assertEqual(2, response.data["count"])
+
+    def test_item(self):
+        self.assertEqual(
+            sorted(stock.id for stock in self.bread_entries), sorted(self.get_ids(f"item={self.bread.id}&limit=10"))
+        )
+        self.assertEqual([self.bread_entries[1].id], self.get_ids(f"item={self.bread.id}&latest=true&limit=10"))
+        self.assertEqual(
+            [self.milk_entries[1].id], self.get_ids(f"item={self.milk.id}&latest=true&limit=10&cursor=")
+        )
+
+
+@override_settings(USER_TIME_ZONE="Africa/Kampala")
+class ExpenditureSummaryTest(APITest):
+    def setUp(self):
+        super().setUp()
+        # Kampala is 3 hours ahead of UTC, so the first is on Monday the 2nd there and the last on April 1st
+        for spent_at, amount, category in (
+            ("2026-03-01T22:00:00", "5.00", "Premises"),
+            ("2026-03-02T08:00:00", "2.50", "Staff"),
+            ("2026-03-02T09:00:00", "1.25", "Premises"),
+            ("2026-03-09T10:00:00", "3.00", "Premises"),
+            ("2026-03-31T21:30:00", "10.00", "Supplies"),
+        ):
+            expenditure = self.create_expenditure(amount, category)
+            Expenditure.objects.filter(id=expenditure.id).update(
+                spent_at=datetime.fromisoformat(spent_at).replace(tzinfo=dt_timezone.utc)
+            )
+
+        # nor are those of other businesses
+        other = Business.objects.create(name="Other Shop", created_by=self.user, modified_by=self.user)
+        self.create_expenditure("99.00", business=other)
+
+    def get_summary(self, params=""):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f"/api/v1/expenditure/summary.json?business={self.business.id}&{params}")
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len([query for query in queries if '"anacreon_expenditure"' in query["sql"]]))
+        return response.data["results"]
+
+    def test_periods(self):
+        day = self.get_summary("period=day")
+        self.assertEqual(
+            {
+                "period": "2026-03-02",
+                "amount": "8.75",
+                "count": 3,
+                "categories": {"Premises": {"amount": "6.25", "count": 2}, "Staff": {"amount": "2.50", "count": 1}},
+            },
+            day[0],
+        )
+        self.assertEqual(
+            [("2026-03-02", "8.75"), ("2026-03-09", "3.00"), ("2026-04-01", "10.00")],
+            [(totals["period"], totals["amount"]) for totals in day],
+        )
+
+        week = self.get_summary("period=week")
+        self.assertEqual(
+            [("2026-03-02", "8.75"), ("2026-03-09", "3.00"), ("2026-03-30", "10.00")],
+            [(totals["period"], totals["amount"]) for totals in week],
+        )
+
+        month = self.get_summary()
+        self.assertEqual(
+            [("2026-03-01", "11.75", 4), ("2026-04-01", "10.00", 1)],
+            [(totals["period"], totals["amount"], totals["count"]) for totals in month],
+        )
+        self.assertEqual(
+            {"Premises": {"amount": "9.25", "count": 3}, "Staff": {"amount": "2.50", "count": 1}},
+            month[0]["categories"],
+        )
+
+    def test_filtered(self):
+        summary = self.get_summary("period=day&after=2026-03-02T05:00:00Z&before=2026-03-09T23:00:00Z")
+        self.assertEqual(
+            [("2026-03-02", "3.75", 2), ("2026-03-09", "3.00", 1)],
+            [(totals["period"], totals["amount"], totals["count"]) for totals in summary],
+        )
+
+        summary = self.get_summary("category=Premises")
+        self.assertEqual([("2026-03-01", "9.25", 3)], [(t["period"], t["amount"], t["count"]) for t in summary])
+
+    def test_invalid(self):
+        self.assertEqual(400, self.client.get("/api/v1/expenditure/summary.json").status_code)
+        response = self.client.get(f"/api/v1/expenditure/summary.json?business={self.business.id}&period=year")
+        self.assertEqual(400, response.status_code)
+
+
+class TopSellersTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.bread = self.create_item("Bread", "BRD-1", quantity=100)
+        self.eggs = self.create_item("Eggs", "EGG-1", quantity=100)
+        self.milk = self.create_item("Milk", "MLK-1", quantity=100)
+
+        for item, quantity, price, days_ago in (
+            (self.bread, 10, "1.00", 2),
+            (self.milk, 2, "8.00", 2),
+            (self.eggs, 20, "0.50", 20),
+            (self.eggs, 1, "0.50", 100),
+        ):
+            order = Order.place_order(
+                self.business, [{"item": item, "quantity": quantity, "selling_price": Decimal(price)}], user=self.user
+            )
+            order.process_order()
+            Order.objects.filter(id=order.id).update(completed_at=timezone.now() - timedelta(days=days_ago))
+
+        # pending orders haven't sold anything
+        Order.place_order(
+            self.business, [{"item": self.milk, "quantity": 50, "selling_price": Decimal("8.00")}], user=self.user
+        )
+        refresh_item_sales()
+
+    def get_top_sellers(self, params):
+        response = self.client.get(f"/api/v1/item/topsellers.json?business={self.business.id}&{params}")
+        self.assertEqual(200, response.status_code)
+        return response.data["results"]
+
+    def test_windows(self):
+        self.assertEqual(
+            [(self.milk.id, "16.00", 2), (self.bread.id, "10.00", 10)],
+            [(row["item"], row["revenue"], row["units_sold"]) for row in self.get_top_sellers("window=7")],
+        )
+
+        # revenue is the default, and ties go to the lowest item id
+        self.assertEqual(
+            [self.milk.id, self.bread.id, self.eggs.id], [row["item"] for row in self.get_top_sellers("")]
+        )
+
+        # sales from before the window are left out
+        self.assertEqual(
+            [(self.eggs.id, 20), (self.bread.id, 10), (self.milk.id, 2)],
+            [(row["item"], row["units_sold"]) for row in self.get_top_sellers("window=90&by=units")],
+        )
+
+    def test_by(self):
+        units = self.get_top_sellers("window=30&by=units")
+        self.assertEqual([self.eggs.id, self.bread.id, self.milk.id], [row["item"] for row in units])
+
+        velocity = self.get_top_sellers("window=30&by=velocity")
+        self.assertEqual([self.eggs.id, self.bread.id, self.milk.id], [row["item"] for row in velocity])
+        self.assertAlmostEqual(20 / 30, velocity[0]["velocity"])
+
+        self.assertEqual(["Eggs"], [row["name"] for row in self.get_top_sellers("window=30&by=units&limit=1")])
+
+    def test_invalid(self):
+        url = f"/api/v1/item/topsellers.json?business={self.business.id}"
+        self.assertEqual(400, self.client.get("/api/v1/item/topsellers.json").status_code)
+        self.assertEqual(400, self.client.get(url + "&window=14").status_code)
+        self.assertEqual(400, self.client.get(url + "&by=profit").status_code)
+
+    def test_refresh_command(self):
+        Order.place_order(
+            self.business, [{"item": self.bread, "quantity": 90, "selling_price": Decimal("1.00")}], user=self.user
+        ).process_order()
+
+        out = io.StringIO()
+        call_command("refresh_item_sales", stdout=out)
+
+        self.assertEqual("Refreshed sales of 8 item window(s)\n", out.getvalue())
+        self.assertEqual(100, ItemSales.objects.get(item=self.bread, window_days=7).units_sold)
+
+
+class AuditLogEndPointTest(APITest):
+    def setUp(self):
+        super().setUp()
+        other = Business.objects.create(name="Other Shop", created_by=self.user, modified_by=self.user)
+
+        start = timezone.now() - timedelta(days=1)
+        self.logs = []
+        for hour, (action, model, object_id) in enumerate(
+            [("create", "Item", 1), ("create", "Order", 1), ("update", "Order", 1), ("update", "Item", 1),
+             ("update", "Order", 2), ("delete", "Order", 1)]
+        ):
+            log = AuditLog.objects.create(
+                business=self.business, user=self.user, action=action, model=model, object_id=object_id
+            )
+            # timestamp is auto_now_add, so space the entries out afterwards
+            AuditLog.objects.filter(id=log.id).update(timestamp=start + timedelta(hours=hour))
+            self.logs.append(log)
+        AuditLog.objects.create(business=other, user=self.user, action="create", model="Order", object_id=1)
+
+    def get_ids(self, query):
+        response = self.client.get(f"/api/v1/auditlog.json?business={self.business.id}&{query}")
+        self.assertEqual(200, response.status_code)
+        return [result["id"] for result in response.data["results"]]
+
+    def test_business_required(self):
+        response = self.client.get("/api/v1/auditlog.json")
+        self.assertEqual(400, response.status_code)
+
+        # newest first, and only of the business asked for
+        self.assertEqual([log.id for log in reversed(self.logs)], self.get_ids(""))
+
+    def test_filters(self):
+        logs = list(reversed(self.logs))
+        self.assertEqual([log.id for log in logs if log.model == "Order"], self.get_ids("model=Order"))
+        self.assertEqual([log.id for log in logs if log.action == "update"], self.get_ids("action=update"))
+        self.assertEqual(
+            [log.id for log in logs if log.model == "Order" and log.object_id == 1],
+            self.get_ids("model=Order&object=1"),
+        )
+        self.assertEqual([], self.get_ids("model=Expenditure"))
+
+        url = f"/api/v1/auditlog.json?business={self.business.id}"
+        self.assertEqual(400, self.client.get(url + "&action=archive").status_code)
+        self.assertEqual(400, self.client.get(url + "&object=first").status_code)
+
+    def test_cursor(self):
+        url = f"/api/v1/auditlog.json?business={self.business.id}&model=Order&limit=2"
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+            self.assertNotIn("count", response.data)
+            self.assertLessEqual(len(response.data["results"]), 2)
+
+            seen += [result["id"] for result in response.data["results"]]
+            url = response.data["next"]
+
+        # newest first, each exactly once
+        self.assertEqual([log.id for log in reversed(self.logs) if log.model == "Order"], seen)
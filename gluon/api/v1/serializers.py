@@ -1,12 +1,23 @@
+import base64
+import binascii
+import decimal
 import logging
+from decimal import Decimal
 
-from rest_framework import serializers
+from rest_framework import ISO_8601, serializers
 from rest_framework.fields import SerializerMethodField
+from rest_framework.settings import api_settings
 
 from gluon.anacreon.models import Business, BusinessUser, Category, SubCategory, Item, ItemImage, Stock, Expenditure, \
-    Order, OrderItem
+    Order, OrderItem, OrderStatus, Job, AuditLog, InvalidImageError
+from gluon.utils.exports import EXPORT_CHUNK_ROWS, StreamingExport
 from gluon.utils import json
 from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldDoesNotExist
+from django.core.files.base import ContentFile
+from django.db import DatabaseError, router, transaction
+from django.db.models import F
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
@@ -25,10 +36,117 @@ class ReadSerializer(serializers.ModelSerializer):
     Serializer that serializes Read objects. separation of logic, DFR uses the same serializer class for both read and write
     """
 
+    def get_fields(self):
+        fields = super().get_fields()
+
+        # ?fields= and ?exclude= narrow the objects being listed, not the ones nested inside them
+        if self.root is self or self.parent is self.root:
+            only, exclude = self.context.get("fields"), self.context.get("exclude")
+            if only:
+                fields = {name: field for name, field in fields.items() if name in only}
+            if exclude:
+                fields = {name: field for name, field in fields.items() if name not in exclude}
+
+        return fields
+
     def save(self, **kwargs):
         raise ValueError("Can't call save on a read serializer")
 
 
+class ValuesListSerializer(serializers.ListSerializer):
+    """
+    List serializer for flat read serializers which can also serialize rows fetched with .values(get_values_lookups()),
+    converting each field with a converter compiled once per list rather than building model instances. The output is
+    the same as serializing the instances. Read serializers opt in with Meta.list_serializer_class.
+    """
+
+    @classmethod
+    def get_values_lookups(cls, child) -> dict | None:
+        """
+        Gets the .values() lookup of each field, or None if any field isn't a plain model field
+        """
+        opts = child.Meta.model._meta
+        lookups = {}
+        for field in child._readable_fields:
+            try:
+                model_field = opts.get_field(field.source)
+            except FieldDoesNotExist:
+                return None
+
+            if not model_field.concrete or model_field.many_to_many:
+                return None
+
+            lookups[field.field_name] = field.source
+
+        return lookups
+
+    @staticmethod
+    def get_converter(field):
+        """
+        Compiles a function converting a non-null value the same way as field.to_representation, or None if values can be
+        used as they are
+        """
+        if isinstance(field, serializers.PrimaryKeyRelatedField):
+            # .values() gives us the id of the related object
+            return None if field.pk_field is None else field.pk_field.to_representation
+
+        if isinstance(field, serializers.JSONField):
+            return field.to_representation if field.binary else None
+
+        if isinstance(field, (serializers.IntegerField, serializers.CharField, serializers.BooleanField)) and \
+                not isinstance(field, serializers.ChoiceField):
+            return None
+
+        if isinstance(field, serializers.DecimalField):
+            coerce_to_string = getattr(field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING)
+            if field.decimal_places is None or not coerce_to_string or field.localize or field.normalize_output:
+                return field.to_representation
+
+            exponent = Decimal(".1") ** field.decimal_places
+            context = decimal.getcontext().copy()
+            if field.max_digits is not None:
+                context.prec = field.max_digits
+            rounding = field.rounding
+
+            return lambda value: f"{value.quantize(exponent, rounding=rounding, context=context):f}"
+
+        if isinstance(field, serializers.DateTimeField):
+            output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+            field_timezone = field.timezone if hasattr(field, "timezone") else field.default_timezone()
+            if output_format is None or output_format.lower() != ISO_8601 or field_timezone is None:
+                return field.to_representation
+
+            def convert_datetime(value):
+                if value.tzinfo is None:
+                    return field.to_representation(value)
+
+                value = value.astimezone(field_timezone).isoformat()
+                return value[:-6] + "Z" if value.endswith("+00:00") else value
+
+            return convert_datetime
+
+        return field.to_representation
+
+    def to_representation(self, data):
+        if not (isinstance(data, list) and data and isinstance(data[0], dict)):
+            return super().to_representation(data)
+
+        lookups = self.get_values_lookups(self.child)
+        converters = [
+            (name, lookup, self.get_converter(self.child.fields[name])) for name, lookup in lookups.items()
+        ]
+
+        results = []
+        for row in data:
+            result = {}
+            for name, lookup, convert in converters:
+                value = row[lookup]
+                result[name] = value if value is None or convert is None else convert(value)
+            results.append(result)
+
+        return results
+
+
 class WriteSerializer(serializers.Serializer):
     """
         DRF uses the view to decide if it's an update or new instance. Let's have the serializer do it.
@@ -53,8 +171,8 @@ class BusinessReadSerializer(ReadSerializer):
             "id",
             "name",
             "description",
-            "created_at",
-            "updated_at",
+            "created_on",
+            "modified_on",
         )
 
 
@@ -125,6 +243,16 @@ class ItemReadSerializer(ReadSerializer):
         model = Item
         fields = ("id", "business", "category", "subcategory", "name", "description", "sku", "properties", "cost_price",
                   "last_selling_price", "quantity", "weight")
+        list_serializer_class = ValuesListSerializer
+
+
+
+class ItemSearchReadSerializer(ItemReadSerializer):
+    score = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = Item
+        fields = ItemReadSerializer.Meta.fields + ("score",)
 
 
 class ItemWriteSerializer(WriteSerializer):
@@ -146,25 +274,64 @@ class ItemWriteSerializer(WriteSerializer):
 
 
 class ItemImageReadSerializer(ReadSerializer):
+    url = SerializerMethodField()
+    thumbnail_url = SerializerMethodField()
+
     class Meta:
         model = ItemImage
-        fields = ("id", "item", "image", "mimetype", "color")
+        fields = ("id", "item", "url", "thumbnail_url", "mimetype", "color")
+        # the columns read by fields which aren't model fields, so ?fields= can still narrow the query
+        field_dependencies = {"url": ("file",), "thumbnail_url": ("thumbnail",)}
+
+    def get_absolute_url(self, url):
+        request = self.context.get("request")
+        return request.build_absolute_uri(url) if request and url else url
+
+    def get_url(self, obj):
+        return self.get_absolute_url(obj.get_url())
+
+    def get_thumbnail_url(self, obj):
+        return self.get_absolute_url(obj.get_thumbnail_url())
 
 
 class ItemImageWriteSerializer(WriteSerializer):
+    """
+    Takes an image either as a base64 string or as a multipart file upload. The mimetype is read from the image itself.
+    """
+
     item = serializers.PrimaryKeyRelatedField(queryset=Item.objects.all())
-    image = serializers.CharField()  # base64 string
-    mimetype = serializers.CharField()
+    image = serializers.CharField(required=False)  # base64 string
+    file = serializers.FileField(required=False)
+    mimetype = serializers.CharField(required=False)
     color = serializers.CharField(required=False, allow_blank=True)
 
+    def validate(self, data):
+        if bool(data.get("image")) == bool(data.get("file")):
+            raise serializers.ValidationError({"non_field_errors": ["Provide one of image or file"]})
+
+        if data.get("image"):
+            try:
+                data["file"] = ContentFile(base64.b64decode(data.pop("image"), validate=True))
+            except (binascii.Error, ValueError):
+                raise serializers.ValidationError({"image": ["Must be base64 encoded."]})
+
+        return data
+
     def save(self, **kwargs):
-        return ItemImage.objects.create(**self.validated_data)
+        data = self.validated_data
+        try:
+            fields = ItemImage.process_files(data["file"], color=data.get("color"))[0]
+        except InvalidImageError as e:
+            raise serializers.ValidationError({"file": [str(e)]})
+
+        return ItemImage.objects.create(item=data["item"], **fields)
 
 
 class StockReadSerializer(ReadSerializer):
     class Meta:
         model = Stock
         fields = ("id", "item", "quantity", "cost_price", "selling_price", "recorded_by", "recorded_at")
+        list_serializer_class = ValuesListSerializer
 
 
 class StockWriteSerializer(WriteSerializer):
@@ -186,6 +353,7 @@ class ExpenditureReadSerializer(ReadSerializer):
     class Meta:
         model = Expenditure
         fields = ("id", "business", "amount", "description", "category", "spent_by", "spent_at")
+        list_serializer_class = ValuesListSerializer
 
 
 class ExpenditureWriteSerializer(WriteSerializer):
@@ -207,6 +375,7 @@ class OrderItemReadSerializer(ReadSerializer):
     class Meta:
         model = OrderItem
         fields = ("id", "order", "item", "quantity", "selling_price")
+        list_serializer_class = ValuesListSerializer
 
 
 class OrderItemWriteSerializer(WriteSerializer):
@@ -216,7 +385,11 @@ class OrderItemWriteSerializer(WriteSerializer):
     selling_price = serializers.DecimalField(max_digits=12, decimal_places=2)
 
     def save(self, **kwargs):
-        return OrderItem.objects.create(**self.validated_data)
+        line = OrderItem.objects.create(**self.validated_data)
+
+        # an order's lines are part of its representation, so this changes the order's ETag too
+        Order.objects.filter(id=line.order_id).update(modified_on=timezone.now())
+        return line
 
 
 class OrderReadSerializer(ReadSerializer):
@@ -229,27 +402,200 @@ class OrderReadSerializer(ReadSerializer):
         "total", "items")
 
 
+class OrderLineWriteSerializer(serializers.Serializer):
+    item = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+    selling_price = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Looks the instance up in the dict of instances by id that a batch has preloaded into the context under
+    context_key, and only queries for it when there isn't one.
+    """
+
+    def __init__(self, context_key, **kwargs):
+        self.context_key = context_key
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        preloaded = self.context.get(self.context_key)
+        if preloaded is None:
+            return super().to_internal_value(data)
+
+        try:
+            if isinstance(data, bool):
+                raise TypeError
+            return preloaded[int(data)]
+        except KeyError:
+            self.fail("does_not_exist", pk_value=data)
+        except (TypeError, ValueError):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+
+
 class OrderWriteSerializer(WriteSerializer):
-    business = serializers.PrimaryKeyRelatedField(queryset=Business.objects.all())
-    customer = serializers.PrimaryKeyRelatedField(queryset=get_user_model().objects.all(), required=False,
-                                                  allow_null=True)
+    business = PreloadedPrimaryKeyRelatedField("businesses", queryset=Business.objects.all())
+    customer = PreloadedPrimaryKeyRelatedField("customers", queryset=get_user_model().objects.all(), required=False,
+                                               allow_null=True)
     notes = serializers.CharField(required=False, allow_blank=True)
-    items = serializers.ListField(child=serializers.DictField(), required=True)
+    items = OrderLineWriteSerializer(many=True, allow_empty=False)
+
+    def validate(self, data):
+        # resolve every item the order refers to in one query, unless a batch has already done it for us
+        item_ids = {line["item"] for line in data["items"]}
+        preloaded = self.context.get("items")
+        if preloaded is None:
+            items = Item.objects.filter(business=data["business"]).in_bulk(item_ids)
+        else:
+            items = {
+                i: preloaded[i] for i in item_ids if i in preloaded and preloaded[i].business_id == data["business"].id
+            }
+
+        missing = sorted(item_ids - items.keys())
+        if missing:
+            raise serializers.ValidationError(
+                {"items": [f"No such item for this business: {', '.join(str(i) for i in missing)}"]}
+            )
+
+        for line in data["items"]:
+            line["item"] = items[line["item"]]
+        return data
 
     def save(self, **kwargs):
-        # Create order
-        order = Order.objects.create(
+        return Order.place_order(
             business=self.validated_data["business"],
+            lines=self.validated_data["items"],
             customer=self.validated_data.get("customer"),
-            notes=self.validated_data.get("notes", "")
+            notes=self.validated_data.get("notes", ""),
+            user=self.context["user"],
         )
-        # Create order items
-        for item_data in self.validated_data["items"]:
-            OrderItem.objects.create(
-                order=order,
-                item=item_data["item"],
-                quantity=item_data["quantity"],
-                selling_price=item_data["selling_price"]
+
+
+class OrderBatchWriteSerializer(WriteSerializer):
+    """
+    Creates many orders in one go, e.g. when an offline till replays its queue. Each order is validated and written
+    in its own atomic block so that a bad order is reported back without failing the rest of the batch.
+    """
+
+    orders = serializers.ListField(child=serializers.DictField(), allow_empty=False, max_length=500)
+    process = serializers.BooleanField(default=False)
+
+    @staticmethod
+    def get_ids(orders, field):
+        ids = set()
+        for order in orders:
+            try:
+                ids.add(int(order.get(field)))
+            except (TypeError, ValueError):
+                pass  # the order's own validation will report this
+        return ids
+
+    @staticmethod
+    def get_item_ids(orders):
+        item_ids = set()
+        for order in orders:
+            for line in order.get("items") or []:
+                try:
+                    item_ids.add(int(line.get("item")))
+                except (AttributeError, TypeError, ValueError):
+                    pass  # the order's own validation will report this
+        return item_ids
+
+    def save(self, **kwargs):
+        orders = self.validated_data["orders"]
+        process = self.validated_data["process"]
+
+        # resolve the businesses, customers and items of every order in the batch with a single query each
+        context = dict(
+            self.context,
+            businesses=Business.objects.in_bulk(self.get_ids(orders, "business")),
+            customers=get_user_model().objects.in_bulk(self.get_ids(orders, "customer")),
+            items=Item.objects.in_bulk(self.get_item_ids(orders)),
+        )
+
+        results = []
+        for index, data in enumerate(orders):
+            serializer = OrderWriteSerializer(data=data, context=context)
+            if not serializer.is_valid():
+                results.append({"index": index, "success": False, "errors": serializer.errors})
+                continue
+
+            # atomic rather than a bare savepoint so that rolling back also drops the on_commit work of the order
+            try:
+                with transaction.atomic():
+                    order = serializer.save()
+                    outcome = order.process_order() if process else {"success": True}
+                    if not outcome["success"]:
+                        transaction.set_rollback(True)
+            except DatabaseError as e:
+                logger.exception(e)
+                outcome = {"success": False, "error": "Unable to save order"}
+
+            if not outcome["success"]:
+                results.append({"index": index, "success": False, "errors": {"non_field_errors": [outcome["error"]]}})
+                continue
+
+            results.append(
+                {"index": index, "success": True, "id": order.id, "status": order.status, "total": str(order.total)}
             )
-        order.calculate_total()
-        return order
+        return results
+
+
+class OrderTransitionWriteSerializer(WriteSerializer):
+    ACTION_COMPLETE = "complete"
+    ACTION_CANCEL = "cancel"
+
+    orders = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=10000)
+    action = serializers.ChoiceField(choices=(ACTION_COMPLETE, ACTION_CANCEL))
+
+    def save(self, **kwargs):
+        order_ids = self.validated_data["orders"]
+        if self.validated_data["action"] == self.ACTION_COMPLETE:
+            changed = Order.bulk_complete(order_ids)
+        else:
+            changed = Order.bulk_cancel(order_ids)
+
+        return {"changed": changed, "unchanged": sorted(set(order_ids) - set(changed))}
+
+
+class SalesExportWriteSerializer(WriteSerializer):
+    """
+    Exports the lines of a business's completed orders, optionally those completed after and/or before the given times
+    """
+
+    COLUMNS = ("order", "completed_at", "item", "sku", "quantity", "selling_price", "total")
+
+    business = serializers.PrimaryKeyRelatedField(queryset=Business.objects.all())
+    after = serializers.DateTimeField(required=False)
+    before = serializers.DateTimeField(required=False)
+
+    def save(self, **kwargs):
+        business = self.validated_data["business"]
+        lines = OrderItem.objects.filter(order__business=business, order__status=OrderStatus.COMPLETED)
+        if "after" in self.validated_data:
+            lines = lines.filter(order__completed_at__gte=self.validated_data["after"])
+        if "before" in self.validated_data:
+            lines = lines.filter(order__completed_at__lte=self.validated_data["before"])
+
+        # rows are read as the file is sent, after this request has left the scope where reads can go to a replica
+        lines = lines.using(router.db_for_read(OrderItem)).order_by("order__completed_at", "order_id", "id")
+        rows = lines.values_list(
+            "order_id", "order__completed_at", "item__name", "item__sku", "quantity", "selling_price",
+            F("quantity") * F("selling_price"),
+        ).iterator(chunk_size=EXPORT_CHUNK_ROWS)
+
+        filename = f"sales-{business.id}-{timezone.now():%Y%m%d%H%M%S}"
+        return StreamingExport(filename=filename, columns=self.COLUMNS, rows=rows)
+
+
+class JobReadSerializer(ReadSerializer):
+    class Meta:
+        model = Job
+        fields = ("id", "task", "status", "attempts", "max_attempts", "run_at", "result", "last_error", "created_on",
+                  "finished_at")
+
+
+class AuditLogReadSerializer(ReadSerializer):
+    class Meta:
+        model = AuditLog
+        fields = ("id", "business", "user", "action", "model", "object_id", "details", "timestamp")
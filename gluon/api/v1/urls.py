@@ -1,5 +1,8 @@
 from .views import (
-    BusinessEndPoint, BusinessUserEndPoint, CategoryEndPoint, SubCategoryEndPoint, ItemEndPoint, ItemImageEndPoint, StockEndPoint, ExpenditureEndPoint, OrderEndPoint, OrderItemEndPoint
+    BusinessEndPoint, BusinessUserEndPoint, CategoryEndPoint, SubCategoryEndPoint, ItemEndPoint, ItemSearchEndPoint, ItemImageEndPoint, StockEndPoint, ExpenditureEndPoint, OrderEndPoint, OrderTransitionEndPoint,
+    OrderProcessEndPoint, OrderItemEndPoint, JobEndPoint,
+    AuditLogEndPoint, SalesSummaryEndPoint, InventoryValuationEndPoint, SalesExportEndPoint, ExpenditureSummaryEndPoint,
+    TopSellersEndPoint
 )
 from django.urls import re_path
 from rest_framework.urlpatterns import format_suffix_patterns
@@ -10,11 +13,21 @@ urlpatterns = [
     re_path(r'^category/$', CategoryEndPoint.as_view()),
     re_path(r'^subcategory/$', SubCategoryEndPoint.as_view()),
     re_path(r'^item/$', ItemEndPoint.as_view()),
+    re_path(r'^item/search/$', ItemSearchEndPoint.as_view()),
+    re_path(r'^item/topsellers/$', TopSellersEndPoint.as_view()),
     re_path(r'^itemimage/$', ItemImageEndPoint.as_view()),
     re_path(r'^stock/$', StockEndPoint.as_view()),
     re_path(r'^expenditure/$', ExpenditureEndPoint.as_view()),
+    re_path(r'^expenditure/summary/$', ExpenditureSummaryEndPoint.as_view()),
     re_path(r'^order/$', OrderEndPoint.as_view()),
+    re_path(r'^order/transition/$', OrderTransitionEndPoint.as_view()),
+    re_path(r'^order/process/$', OrderProcessEndPoint.as_view()),
     re_path(r'^orderitem/$', OrderItemEndPoint.as_view()),
+    re_path(r'^job/$', JobEndPoint.as_view(), name='api.v1.job'),
+    re_path(r'^auditlog/$', AuditLogEndPoint.as_view()),
+    re_path(r'^summary/$', SalesSummaryEndPoint.as_view()),
+    re_path(r'^valuation/$', InventoryValuationEndPoint.as_view()),
+    re_path(r'^export/sales/$', SalesExportEndPoint.as_view()),
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns, allowed=["json"])
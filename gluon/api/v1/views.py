@@ -1,22 +1,46 @@
-from rest_framework.pagination import LimitOffsetPagination
+from datetime import date
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db import transaction
+from django.db.models import Count, DateField, Prefetch, Q, Sum
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.exceptions import NotFound
 from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
+from rest_framework.response import Response
 from rest_framework.throttling import ScopedRateThrottle
 
-from gluon.anacreon.models import Business, BusinessUser, Category, SubCategory, Item, ItemImage, Stock, Expenditure, Order, OrderItem
-from gluon.api.helper import APISessionAuthentication, APIBasicAuthentication
+from gluon.anacreon.models import Business, BusinessUser, Category, SubCategory, Item, ItemImage, Stock, Expenditure, Order, OrderItem, \
+    OrderStatus, Job, AuditLog, DailySales, ItemSales, ITEM_SALES_WINDOWS, rollup_time_zone
+from gluon.anacreon.search import fuzzy_search_items, search_items
+from gluon.anacreon.valuation import to_results, value_inventory
+from gluon.api.helper import APISessionAuthentication, APIBasicAuthentication, InvalidQueryError, \
+    CreatedOnCursorPagination, IdCursorPagination, ListPagination, TimestampCursorPagination
 from gluon.api.v1.serializers import (
     BusinessReadSerializer, BusinessWriteSerializer,
     BusinessUserReadSerializer, BusinessUserWriteSerializer,
     CategoryReadSerializer, CategoryWriteSerializer,
     SubCategoryReadSerializer, SubCategoryWriteSerializer,
-    ItemReadSerializer, ItemWriteSerializer,
+    ItemReadSerializer, ItemWriteSerializer, ItemSearchReadSerializer,
     ItemImageReadSerializer, ItemImageWriteSerializer,
     StockReadSerializer, StockWriteSerializer,
     ExpenditureReadSerializer, ExpenditureWriteSerializer,
-    OrderReadSerializer, OrderWriteSerializer,
-    OrderItemReadSerializer, OrderItemWriteSerializer,
+    OrderReadSerializer, OrderWriteSerializer, OrderBatchWriteSerializer, OrderTransitionWriteSerializer,
+    OrderItemReadSerializer, OrderItemWriteSerializer, SalesExportWriteSerializer,
+    JobReadSerializer, AuditLogReadSerializer,
 )
-from gluon.api.views import BaseAPIView, ListAPIMixin, WriteAPIMixin
+from gluon.api.views import BaseAPIView, FileDownloadAPIMixin, ListAPIMixin, WriteAPIMixin
+from gluon.utils.utils import str_to_bool
+
+
+def format_money(value) -> str:
+    """
+    Formats a sum of money the way our serializers output money, to the cent whatever scale the database summed it to
+    """
+    return str(value.quantize(Decimal("0.01")))
 
 
 class BaseEndpoint(BaseAPIView):
@@ -29,13 +53,16 @@ class BaseEndpoint(BaseAPIView):
     renderer_classes = (JSONRenderer, BrowsableAPIRenderer)
     throttle_classes = (ScopedRateThrottle,)
     throttle_scope = "v1"
+    cursor_pagination_class = IdCursorPagination
 
 
 class BusinessEndPoint(ListAPIMixin, WriteAPIMixin, BaseEndpoint):
     model = Business
     write_serializer_class = BusinessWriteSerializer
     serializer_class = BusinessReadSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = ListPagination
+    cache_lists = True
+    cursor_pagination_class = CreatedOnCursorPagination
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -59,52 +86,418 @@ class BusinessUserEndPoint(ListAPIMixin, WriteAPIMixin, BaseEndpoint):
     model = BusinessUser
     write_serializer_class = BusinessUserWriteSerializer
     serializer_class = BusinessUserReadSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = ListPagination
+    business_lookup = "business"
 
 class CategoryEndPoint(ListAPIMixin, WriteAPIMixin, BaseEndpoint):
     model = Category
     write_serializer_class = CategoryWriteSerializer
     serializer_class = CategoryReadSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = ListPagination
+    cache_lists = True
+    business_lookup = "business"
 
 class SubCategoryEndPoint(ListAPIMixin, WriteAPIMixin, BaseEndpoint):
     model = SubCategory
     write_serializer_class = SubCategoryWriteSerializer
     serializer_class = SubCategoryReadSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = ListPagination
+    cache_lists = True
+    business_lookup = "category__business"
 
 class ItemEndPoint(ListAPIMixin, WriteAPIMixin, BaseEndpoint):
     model = Item
     write_serializer_class = ItemWriteSerializer
     serializer_class = ItemReadSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = ListPagination
+    cache_lists = True
+    cursor_pagination_class = CreatedOnCursorPagination
+    business_lookup = "business"
+
+
+class ItemSearchEndPoint(BaseEndpoint):
+    """
+    GET ?business=<id>&q=<text> for the business's active items best matching the text, with their match score. Matches
+    on name, sku and description through the database's search indexes, or with ?mode=fuzzy on names and skus in
+    memory, which tolerates more typos. Returns up to ?limit= items, 20 by default.
+    """
+
+    model = Item
+    serializer_class = ItemSearchReadSerializer
+    search_modes = ("index", "fuzzy")
+
+    def get(self, request, *args, **kwargs):
+        business = self.get_int_param("business")
+        query = request.query_params.get("q", "").strip()
+        if business is None or not query:
+            raise InvalidQueryError("URL must contain the business and q parameters")
+
+        mode = request.query_params.get("mode", "index")
+        if mode not in self.search_modes:
+            raise InvalidQueryError("Invalid value for mode: %s" % mode)
+
+        limit = self.get_int_param("limit") or 20
+        limit = max(1, min(limit, settings.ITEM_SEARCH_MAX_LIMIT))
+
+        search = search_items if mode == "index" else fuzzy_search_items
+        items = search(business, query, limit)
+
+        serializer = self.serializer_class(items, many=True, context=self.get_serializer_context())
+        return Response({"results": serializer.data}, status=status.HTTP_200_OK)
 
 class ItemImageEndPoint(ListAPIMixin, WriteAPIMixin, BaseEndpoint):
     model = ItemImage
     write_serializer_class = ItemImageWriteSerializer
     serializer_class = ItemImageReadSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = ListPagination
+    business_lookup = "item__business"
+
+    def derive_queryset(self):
+        # images still stored in the database are fetched from their URL rather than read with the list
+        return super().derive_queryset().defer("image")
+
+    def initial(self, request, *args, **kwargs):
+        # write uploads to disk as they arrive rather than holding the smaller ones in memory
+        request._request.upload_handlers = [TemporaryFileUploadHandler(request._request)]
+
+        super().initial(request, *args, **kwargs)
 
 class StockEndPoint(ListAPIMixin, WriteAPIMixin, BaseEndpoint):
     model = Stock
     write_serializer_class = StockWriteSerializer
     serializer_class = StockReadSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = ListPagination
+    cursor_pagination_class = CreatedOnCursorPagination
+    business_lookup = "item__business"
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+
+        items = self.get_int_list_param("item")
+        if items:
+            queryset = queryset.filter(item_id__in=items)
+
+        # ?latest=true for only the latest entry of each item, e.g. for all the items on a screen at once
+        if str_to_bool(self.request.query_params.get("latest")):
+            queryset = self.derive_queryset().filter(id__in=Stock.latest(queryset).values("id"))
+
+        return queryset
 
 class ExpenditureEndPoint(ListAPIMixin, WriteAPIMixin, BaseEndpoint):
     model = Expenditure
     write_serializer_class = ExpenditureWriteSerializer
     serializer_class = ExpenditureReadSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = ListPagination
+    cursor_pagination_class = CreatedOnCursorPagination
+    business_lookup = "business"
+
+
+class ExpenditureSummaryEndPoint(ListAPIMixin, BaseEndpoint):
+    """
+    GET ?business=<id> for the business's expenditures totalled per ?period=day|week|month (month by default) and per
+    category within it, optionally only those spent after and/or before the given times. Periods follow
+    USER_TIME_ZONE and are totalled by the database in a single query.
+    """
+
+    model = Expenditure
+    business_lookup = "business"
+    periods = {"day": TruncDay, "week": TruncWeek, "month": TruncMonth}
+
+    def get(self, request, *args, **kwargs):
+        if self.get_int_param("business") is None:
+            raise InvalidQueryError("URL must contain the business parameter")
+
+        period = request.query_params.get("period", "month")
+        if period not in self.periods:
+            raise InvalidQueryError("Invalid value for period: %s" % period)
+
+        queryset = self.filter_before_after(self.filter_queryset(self.get_queryset()), "spent_at")
+        category = request.query_params.get("category")
+        if category:
+            queryset = queryset.filter(category=category)
+
+        truncate = self.periods[period]("spent_at", output_field=DateField(), tzinfo=rollup_time_zone())
+        rows = (
+            queryset.annotate(period=truncate)
+            .values("period", "category")
+            .annotate(amount=Sum("amount"), count=Count("id"))
+            .order_by("period", "category")
+        )
+
+        results = {}
+        for row in rows:
+            totals = results.setdefault(row["period"], {
+                "period": row["period"].isoformat(), "amount": Decimal(0), "count": 0, "categories": {}
+            })
+            totals["amount"] += row["amount"]
+            totals["count"] += row["count"]
+            totals["categories"][row["category"]] = {"amount": format_money(row["amount"]), "count": row["count"]}
+
+        for totals in results.values():
+            totals["amount"] = format_money(totals["amount"])
+        return Response({"results": list(results.values())}, status=status.HTTP_200_OK)
 
 class OrderEndPoint(ListAPIMixin, WriteAPIMixin, BaseEndpoint):
+    """
+    POST with ?batch=true to submit many orders at once as {"orders": [...], "process": true|false}. The response has a
+    result for each order in the batch, so only the ones that failed need to be sent again.
+    """
+
     model = Order
     write_serializer_class = OrderWriteSerializer
+    batch_serializer_class = OrderBatchWriteSerializer
     serializer_class = OrderReadSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = ListPagination
+    cursor_pagination_class = CreatedOnCursorPagination
+    business_lookup = "business"
+    prefetch_related = (Prefetch("items", queryset=OrderItem.objects.order_by("id")),)
+
+    def post(self, request, *args, **kwargs):
+        if not str_to_bool(request.query_params.get("batch")):
+            return super().post(request, *args, **kwargs)
+
+        serializer = self.batch_serializer_class(data=request.data, context=self.get_serializer_context())
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            results = serializer.save()
+
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+class OrderTransitionEndPoint(BaseEndpoint):
+    """
+    POST {"orders": [...], "action": "complete"|"cancel"} to complete or cancel many orders at once, e.g. to close all
+    pending orders at the end of the day. Orders which are already in a state the action doesn't apply to are
+    returned as unchanged.
+    """
+
+    model = Order
+    write_serializer_class = OrderTransitionWriteSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.write_serializer_class(data=request.data, context=self.get_serializer_context())
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(serializer.save(), status=status.HTTP_200_OK)
+
+
+class OrderProcessEndPoint(BaseEndpoint):
+    """
+    POST ?id=<order> to have the order's stock reconciled in the background. Responds with 202 and the URL of the job
+    which can be polled for the outcome.
+    """
+
+    model = Order
+
+    def post(self, request, *args, **kwargs):
+        self.lookup_values = self.get_lookup_values()
+        if not self.lookup_values:
+            raise InvalidQueryError("URL must contain one of the following parameters: id")
+
+        order = self.get_object()
+        if order.status != OrderStatus.PENDING:
+            return Response(
+                {"detail": f"Order #{order.id} is {order.status} and can't be processed."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        job = Job.enqueue("process_order", {"order_id": order.id}, business=order.business, user=request.user)
+        status_url = request.build_absolute_uri(f"{reverse('api.v1.job')}?id={job.id}")
+
+        return Response(
+            {"job": job.id, "status": job.status, "status_url": status_url},
+            status=status.HTTP_202_ACCEPTED,
+            headers={"Location": status_url},
+        )
+
+
+class JobEndPoint(ListAPIMixin, BaseEndpoint):
+    """
+    Jobs queued by the user or working on one of their businesses, newest first. GET ?id=<job> for a single job, which
+    is a 404 if the user can't see it.
+    """
+
+    model = Job
+    serializer_class = JobReadSerializer
+    pagination_class = ListPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+
+        user = self.request.user
+        if not user.is_authenticated:
+            return queryset.none()
+        if user.is_superuser:
+            return queryset
+
+        businesses = BusinessUser.objects.filter(user=user).values("business_id")
+        return queryset.filter(Q(created_by=user) | Q(business__in=businesses))
+
+    def list(self, request, *args, **kwargs):
+        job_id = self.get_int_param("id")
+        if job_id is not None and not self.is_docs() and not self.get_queryset().filter(id=job_id).exists():
+            raise NotFound()
+
+        return super().list(request, *args, **kwargs)
+
+    def filter_queryset(self, queryset):
+        job_id = self.get_int_param("id")
+        if job_id is not None:
+            queryset = queryset.filter(id=job_id)
+
+        return queryset.order_by("-id")
+
 
 class OrderItemEndPoint(ListAPIMixin, WriteAPIMixin, BaseEndpoint):
     model = OrderItem
     write_serializer_class = OrderItemWriteSerializer
     serializer_class = OrderItemReadSerializer
-    pagination_class = LimitOffsetPagination
+    pagination_class = ListPagination
+    business_lookup = "order__business"
+
+
+class AuditLogEndPoint(ListAPIMixin, BaseEndpoint):
+    """
+    Read-only audit trail of a business, newest first and paged with a cursor. Can be filtered by model, object,
+    user, action and before/after on timestamp.
+    """
+
+    model = AuditLog
+    serializer_class = AuditLogReadSerializer
+    pagination_class = TimestampCursorPagination
+
+    def filter_queryset(self, queryset):
+        params = self.request.query_params
+
+        business = self.get_int_param("business")
+        if business is None:
+            raise InvalidQueryError("URL must contain the business parameter")
+        queryset = queryset.filter(business_id=business)
+
+        model = params.get("model")
+        if model:
+            queryset = queryset.filter(model=model)
+
+        object_id = self.get_int_param("object")
+        if object_id is not None:
+            queryset = queryset.filter(object_id=object_id)
+
+        user = self.get_int_param("user")
+        if user is not None:
+            queryset = queryset.filter(user_id=user)
+
+        action = params.get("action")
+        if action:
+            if action not in dict(AuditLog.ACTION_CHOICES):
+                raise InvalidQueryError("Invalid value for action: %s" % action)
+            queryset = queryset.filter(action=action)
+
+        return self.filter_before_after(queryset, "timestamp")
+
+
+class SalesSummaryEndPoint(BaseEndpoint):
+    """
+    GET ?business=<id> for the business's revenue, cost of goods, profit, order counts and expenditures by category
+    per ?period=day|month|year (month by default), optionally limited to the days from ?start= to ?end= as YYYY-MM-DD.
+    Read from the daily rollups so it doesn't get slower as history grows.
+    """
+
+    model = DailySales
+    periods = ("day", "month", "year")
+
+    def get_date_param(self, name):
+        param = self.request.query_params.get(name)
+        try:
+            return date.fromisoformat(param) if param else None
+        except ValueError:
+            raise InvalidQueryError("Value for %s must be a date as YYYY-MM-DD" % name)
+
+    def get(self, request, *args, **kwargs):
+        business = self.get_int_param("business")
+        if business is None:
+            raise InvalidQueryError("URL must contain the business parameter")
+
+        period = request.query_params.get("period", "month")
+        if period not in self.periods:
+            raise InvalidQueryError("Invalid value for period: %s" % period)
+
+        summary = DailySales.get_summary(business, period, self.get_date_param("start"), self.get_date_param("end"))
+
+        results = [
+            {
+                **{field: format_money(value) if isinstance(value, Decimal) else value for field, value in totals.items()},
+                "period": totals["period"].isoformat(),
+                "expenditures_by_category": {
+                    category: format_money(amount) for category, amount in totals["expenditures_by_category"].items()
+                },
+            } for totals in summary
+        ]
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+
+class InventoryValuationEndPoint(BaseEndpoint):
+    """
+    GET ?business=<id> for the value of each item's stock on hand, first-in first-out and at weighted average cost,
+    worked out from its stock intakes and completed orders, along with the totals. Can be limited to one ?item=.
+    """
+
+    model = Stock
+
+    def get(self, request, *args, **kwargs):
+        business = self.get_int_param("business")
+        if business is None:
+            raise InvalidQueryError("URL must contain the business parameter")
+
+        item = self.get_int_param("item")
+        results, totals = to_results(value_inventory(business, [item] if item is not None else None))
+        return Response({"results": results, "totals": totals}, status=status.HTTP_200_OK)
+
+
+class SalesExportEndPoint(FileDownloadAPIMixin, BaseEndpoint):
+    """
+    POST {"business": <id>, "after": .., "before": .., "file_type": "csv"|"xlsx"} to download the lines of the
+    business's completed orders, streamed as they're read however many there are
+    """
+
+    model = OrderItem
+    write_serializer_class = SalesExportWriteSerializer
+
+
+class TopSellersEndPoint(BaseEndpoint):
+    """
+    GET ?business=<id> for the business's best selling items over the last ?window=7|30|90 days (30 by default),
+    ordered ?by=revenue|units|velocity. Read from sales totals refreshed every ITEM_SALES_REFRESH_MINUTES, the time
+    of the last refresh is returned with each item.
+    """
+
+    model = ItemSales
+
+    def get(self, request, *args, **kwargs):
+        business = self.get_int_param("business")
+        if business is None:
+            raise InvalidQueryError("URL must contain the business parameter")
+
+        window = self.get_int_param("window") or 30
+        if window not in ITEM_SALES_WINDOWS:
+            raise InvalidQueryError("Invalid value for window: %s" % window)
+
+        by = request.query_params.get("by", "revenue")
+        if by not in ItemSales.ORDERINGS:
+            raise InvalidQueryError("Invalid value for by: %s" % by)
+
+        limit = max(1, min(self.get_int_param("limit") or 10, 100))
+
+        results = [
+            {
+                "item": row["item_id"],
+                "name": row["item__name"],
+                "units_sold": row["units_sold"],
+                "revenue": str(row["revenue"]),
+                "orders": row["orders"],
+                "velocity": row["velocity"],
+                "refreshed_at": row["refreshed_at"],
+            } for row in ItemSales.top_sellers(business, window, by, limit)
+        ]
+        return Response({"results": results}, status=status.HTTP_200_OK)
@@ -1,16 +1,29 @@
 import contextlib
 import copy
+import hashlib
 import logging
 import mimetypes
+import os
+from functools import cached_property
 
 import iso8601
-from django.http import FileResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Count, Max, prefetch_related_objects
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from rest_framework import generics, mixins, status
 from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 from django.db import transaction
-from gluon.api.helper import InvalidQueryError
+from gluon.anacreon.routers import is_pinned_to_primary, reads_from_primary, use_primary
+from gluon.api.helper import InvalidQueryError, ListPagination
+from gluon.utils.cache import business_scope, generation_age, get_generation
+from gluon.utils.exports import EXPORT_FILE_TYPES, StreamingExport
 from gluon.utils.mixins.mixins import NonAtomicMixin
+from gluon.utils.utils import str_to_bool
 
 logger = logging.getLogger(__name__)
 
@@ -24,17 +37,103 @@ class BaseAPIView(NonAtomicMixin, generics.GenericAPIView):
     model_manager = "objects"
     lookup_params = {"id": "id"}
 
+    # the relations the serializer reads, joined into the query or fetched in bulk for each page of results
+    select_related = ()
+    prefetch_related = ()
+
     def derive_queryset(self):
-        return getattr(self.model, self.model_manager).all()
+        queryset = getattr(self.model, self.model_manager).all()
+
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+
+        return queryset
 
     def get_queryset(self):
-        qs = self.derive_queryset()
+        # reads are routed to a replica by ReplicaRouter unless this client has written recently
+        return self.derive_queryset()
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        # clients which don't keep cookies are pinned to the primary by user, which we only know once authenticated
+        if is_pinned_to_primary(request.user):
+            use_primary()
+
+    @cached_property
+    def has_modified_on(self) -> bool:
+        try:
+            self.model._meta.get_field("modified_on")
+        except FieldDoesNotExist:
+            return False
+        return True
+
+    def get_validators(self, queryset):
+        """
+        Gets an ETag and last modified time for the given filtered queryset from the max modified_on and row count, which
+        the (business, modified_on) indexes let us read without touching the table. Returns None for models without
+        modified_on.
+        """
+        if not self.has_modified_on:
+            return None
+
+        state = queryset.order_by().aggregate(last_modified=Max("modified_on"), count=Count("pk"))
+        last_modified = state["last_modified"]
+
+        params = sorted(self.request.query_params.lists())
+        key = f"{type(self).__name__}|{self.request.accepted_renderer.format}|{params}|{last_modified}|{state['count']}"
+
+        return quote_etag(hashlib.md5(key.encode()).hexdigest()), last_modified
+
+    def get_page_validators(self, page, links):
+        """
+        Gets an ETag and last modified time for a page of results, objects or rows with their pk and modified_on, from
+        what identifies its rows and the links to the pages either side. Unlike get_validators this doesn't need to
+        count every matching row. Returns None for models without modified_on.
+        """
+        if not self.has_modified_on:
+            return None
+
+        pk_name = self.model._meta.pk.attname
+        state = [
+            (row[pk_name], row["modified_on"]) if isinstance(row, dict) else (row.pk, row.modified_on) for row in page
+        ]
+        last_modified = max((modified_on for _, modified_on in state), default=None)
+
+        params = sorted(self.request.query_params.lists())
+        key = f"{type(self).__name__}|{self.request.accepted_renderer.format}|{params}|{links}|{state}"
+
+        return quote_etag(hashlib.md5(key.encode()).hexdigest()), last_modified
+
+    def get_not_modified_response(self, validators):
+        """
+        Checks the request's If-None-Match and If-Modified-Since against the given validators, returning a 304 response
+        if the client already has the latest version. Otherwise remembers the validators to send with the response.
+        """
+        self.validators = validators
+        if not self.validators:
+            return None
+
+        # compared with sub-second precision so If-Modified-Since can't give a stale 304, clients should use If-None-Match
+        etag, last_modified = self.validators
+        return get_conditional_response(
+            self.request, etag=etag, last_modified=last_modified.timestamp() if last_modified else None
+        )
 
-        # if this is a get request, fetch from readonly database
-        if self.request.method == "GET":
-            qs = qs.using("readonly")
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
 
-        return qs
+        validators = getattr(self, "validators", None)
+        if validators and response.status_code in (200, 304):
+            etag, last_modified = validators
+            response["ETag"] = etag
+            if last_modified:
+                response["Last-Modified"] = http_date(last_modified.timestamp())
+
+            # make clients revalidate rather than guess how long the response is fresh for
+            patch_cache_control(response, private=True, no_cache=True)
+
+        return response
 
     def get_lookup_values(self):
         """
@@ -66,9 +165,19 @@ class BaseAPIView(NonAtomicMixin, generics.GenericAPIView):
         except ValueError:
             raise InvalidQueryError("Value for %s must be an integer" % name)
 
+    def get_int_list_param(self, name):
+        """
+        Gets a list of integers given as repeated or comma separated values of a param, e.g. ?item=1,2&item=3
+        """
+        values = [value for param in self.request.query_params.getlist(name) for value in param.split(",") if value]
+        try:
+            return [int(value) for value in values]
+        except ValueError:
+            raise InvalidQueryError("Values for %s must be integers" % name)
+
     def get_serializer_context(self):
         context = super().get_serializer_context()
-        context["workspace"] = self.request.workspace
+        context["workspace"] = getattr(self.request, "workspace", None)
         context["user"] = self.request.user
         return context
 
@@ -87,6 +196,12 @@ class ListAPIMixin(mixins.ListModelMixin):
 
     exclusive_params = ()
 
+    # whether GET responses are cached until something in the business they show changes, see signals.py
+    cache_lists = False
+
+    # lookup from the model to its business, used to filter by the business param
+    business_lookup = None
+
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
@@ -96,14 +211,111 @@ class ListAPIMixin(mixins.ListModelMixin):
         if self.is_docs():
             # if this is just a request to browse the endpoint docs, don't make a query
             return Response([])
-        else:
-            return super().list(request, *args, **kwargs)
+
+        cache_key, generation = self.get_list_cache_key() if self.cache_lists else (None, None)
+        cached = cache.get(cache_key) if cache_key else None
+
+        if cached:
+            not_modified = self.get_not_modified_response(cached["validators"])
+            return not_modified or Response(cached["data"])
+
+        # lists which aren't counted are validated once we have the page, see list_objects
+        if not self.validates_by_page():
+            not_modified = self.get_not_modified_response(self.get_validators(self.filter_queryset(self.get_queryset())))
+            if not_modified:
+                return not_modified
+
+        response = self.list_objects()
+
+        # a replica may not have caught up with the write which started this generation yet
+        if cache_key and response.status_code == 200 and (
+            reads_from_primary() or generation_age(generation) > settings.REPLICA_MAX_LAG_SECONDS
+        ):
+            cache.set(
+                cache_key,
+                {"data": response.data, "validators": self.validators},
+                timeout=settings.API_LIST_CACHE_SECONDS,
+            )
+
+        return response
+
+    def validates_by_page(self) -> bool:
+        """
+        Whether responses are validated by the page of results rather than by counting every matching row, which is the
+        case when the client asked for pages without a count or pages with a cursor
+        """
+        paginator, params = self.paginator, self.request.query_params
+        return isinstance(paginator, ListPagination) and (
+            paginator.cursor_query_param in params or not str_to_bool(params.get(paginator.count_query_param, "true"))
+        )
+
+    def get_list_cache_key(self):
+        """
+        Gets the key to cache this request's response under and the generation it belongs to. Lists filtered to a
+        business are invalidated by changes to that business, other lists by changes to any business.
+        """
+        business = self.get_int_param("business") if self.business_lookup else None
+        generation = get_generation(business_scope(business) if business is not None else business_scope())
+
+        params = sorted(self.request.query_params.lists())
+        key = f"{self.request.get_host()}|{self.request.accepted_renderer.format}|{params}"
+
+        return f"api:list:{type(self).__name__}:{generation}:{hashlib.md5(key.encode()).hexdigest()}", generation
 
     def check_query(self, params):
         # check user hasn't provided values for more than one of any exclusive params
         if sum([(1 if params.get(p) else 0) for p in self.exclusive_params]) > 1:
             raise InvalidQueryError("You may only specify one of the %s parameters" % ", ".join(self.exclusive_params))
 
+        fields, exclude = self.get_field_names_param("fields"), self.get_field_names_param("exclude")
+        if fields and exclude:
+            raise InvalidQueryError("You may only specify one of the fields, exclude parameters")
+
+        unknown = (fields | exclude) - set(self.get_serializer_class()().fields)
+        if unknown:
+            raise InvalidQueryError("Unknown fields: " + ", ".join(sorted(unknown)))
+
+    def get_field_names_param(self, name) -> set:
+        """
+        Gets the set of field names in a comma separated param such as ?fields=id,name
+        """
+        values = self.request.query_params.getlist(name)
+        return {n.strip() for value in values for n in value.split(",") if n.strip()}
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+
+        # read serializers only return these fields for the objects being listed, see ReadSerializer.get_fields
+        context["fields"] = self.get_field_names_param("fields")
+        context["exclude"] = self.get_field_names_param("exclude")
+        return context
+
+    @cached_property
+    def serializer_fields(self):
+        """
+        The fields the serializer will return, after applying ?fields= or ?exclude=
+        """
+        return self.get_serializer_class()(context=self.get_serializer_context()).fields
+
+    def get_cursor_ordering(self):
+        ordering = getattr(getattr(self, "cursor_pagination_class", None), "ordering", ())
+        return [f.lstrip("-") for f in ((ordering,) if isinstance(ordering, str) else ordering)]
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+
+        return self.filter_by_business(queryset)
+
+    def filter_by_business(self, queryset):
+        """
+        Filters the queryset by the business param if it is provided
+        """
+        business = self.get_int_param("business")
+        if business is not None and self.business_lookup:
+            queryset = queryset.filter(**{self.business_lookup: business})
+
+        return queryset
+
     def filter_before_after(self, queryset, field):
         """
         Filters the queryset by the before/after params if are provided
@@ -126,6 +338,97 @@ class ListAPIMixin(mixins.ListModelMixin):
 
         return queryset
 
+    def get_values_lookups(self):
+        """
+        Gets the .values() lookups to fetch list rows with, if the serializer can serialize rows without model instances
+        """
+        serializer_class = self.get_serializer_class()
+        list_serializer_class = getattr(getattr(serializer_class, "Meta", None), "list_serializer_class", None)
+        if self.prefetch_related or not hasattr(list_serializer_class, "get_values_lookups"):
+            return None
+
+        return list_serializer_class.get_values_lookups(serializer_class(context=self.get_serializer_context()))
+
+    def select_columns(self, queryset):
+        """
+        Limits the columns read for the listed objects to those needed by the fields picked with ?fields= or ?exclude=,
+        so heavy columns are never read unless the client asks for them
+        """
+        fields, exclude = self.get_field_names_param("fields"), self.get_field_names_param("exclude")
+        if not (fields or exclude):
+            return queryset
+
+        opts = self.model._meta
+        serializer_class = self.get_serializer_class()
+        dependencies = getattr(getattr(serializer_class, "Meta", None), "field_dependencies", {})
+
+        # cursor pagination reads its position from the ordering fields of the last object
+        needed = {opts.pk.name, *self.get_cursor_ordering(), *(r.split("__")[0] for r in self.select_related)}
+        if self.validates_by_page() and self.has_modified_on:
+            needed.add("modified_on")
+        for name, field in self.serializer_fields.items():
+            if name in dependencies:
+                needed.update(dependencies[name])
+                continue
+
+            try:
+                model_field = opts.get_field(field.source)
+            except FieldDoesNotExist:
+                return queryset  # we can't tell which columns a computed field reads
+
+            if model_field.concrete:
+                needed.add(model_field.name)
+
+        if fields:
+            return queryset.only(*needed)
+
+        deferred = set()
+        for name, field in serializer_class().fields.items():
+            try:
+                model_field = opts.get_field(field.source)
+            except FieldDoesNotExist:
+                continue
+
+            if name in exclude and model_field.concrete and not model_field.is_relation:
+                deferred.add(model_field.name)
+
+        return queryset.defer(*(deferred - needed)) if deferred - needed else queryset
+
+    def list_objects(self):
+        """
+        Same as ListModelMixin.list but reads only the columns the serializer needs, with or without pagination
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        by_page = self.validates_by_page()
+
+        lookups = self.get_values_lookups()
+        if lookups:
+            # cursor pagination reads its position from the ordering fields of the last row
+            columns = [*lookups.values(), *self.get_cursor_ordering()]
+            if by_page and self.has_modified_on:
+                columns += [self.model._meta.pk.attname, "modified_on"]
+            queryset = queryset.values(*dict.fromkeys(columns))
+        else:
+            queryset = self.select_columns(queryset)
+
+        page = self.paginate_queryset(queryset)
+        if by_page:
+            paginator = self.paginator.cursor_paginator or self.paginator
+            links = (paginator.get_previous_link(), paginator.get_next_link()) if page is not None else None
+
+            not_modified = self.get_not_modified_response(
+                self.get_page_validators(page if page is not None else queryset, links)
+            )
+            if not_modified:
+                return not_modified
+
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+        objects = list(queryset)
+        self.prepare_for_serialization(objects, using=queryset.db)
+        return Response(self.get_serializer(objects, many=True).data)
+
     def paginate_queryset(self, queryset):
         page = super().paginate_queryset(queryset)
 
@@ -138,7 +441,14 @@ class ListAPIMixin(mixins.ListModelMixin):
         """
         Views can override this to do things like bulk cache initialization of result objects
         """
-        pass
+        if page and self.prefetch_related:
+            # skip relations whose fields the client didn't ask for
+            lookups = [
+                lookup for lookup in self.prefetch_related
+                if getattr(lookup, "prefetch_to", lookup).split("__")[0] in self.serializer_fields
+            ]
+            if lookups:
+                prefetch_related_objects(page, *lookups)
 
 
 class WriteAPIMixin:
@@ -236,10 +546,13 @@ class FileDownloadAPIMixin:
     """
        When we need the actual file, we shall do a post as opposed to a GET.
        Logic will get complicated if we try to use GET for browser reports and then file extractions
+
+       Serializers either write a file and return its path and name, or return a StreamingExport of rows which is sent
+       as it is produced in the file_type (csv or xlsx) asked for.
     """
     special_params = (
         "report_type", "before", "after", "module", "limit", "offset",
-        "count")  # we shall not include these in filter_params to pass to Report
+        "count", "file_type")  # we shall not include these in filter_params to pass to Report
 
     def get_filter_params(self):
         if self.request.method == 'GET':
@@ -263,20 +576,34 @@ class FileDownloadAPIMixin:
             if isinstance(result, dict):
                 # this is an error for sure return as is
                 return Response(result, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            if isinstance(result, StreamingExport):
+                return self.stream_export(result)
             file_path, filename = result  # The result is our file path and name
             mimetype, _ = mimetypes.guess_type(file_path)
             try:
                 # open it with resources (hahaha)
                 file = open(file_path, 'rb')
-                response = FileResponse(file, content_type=mimetype)
-                response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-                response['Access-Control-Expose-Headers'] = "Content-Disposition"
-                return response
             except Exception as error:
                 logger.exception(error)
                 return Response(dict(success=False, message=str(error)), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            finally:
-                # os.remove(file_path)  # clear the written file off the disc
-                pass
+
+            # clear the written file off the disc, the open file can still be read until the response closes it
+            os.remove(file_path)
+            response = FileResponse(file, content_type=mimetype)
+            response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+            response['Access-Control-Expose-Headers'] = "Content-Disposition"
+            return response
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    def stream_export(self, export):
+        file_type = self.request.data.get("file_type", "csv")
+        if file_type not in EXPORT_FILE_TYPES:
+            raise InvalidQueryError("Invalid value for file_type: %s" % file_type)
+
+        mimetype, stream = EXPORT_FILE_TYPES[file_type]
+        response = StreamingHttpResponse(stream(export.columns, export.rows), content_type=mimetype)
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (export.filename, file_type)
+        response['Access-Control-Expose-Headers'] = "Content-Disposition"
+        response['X-Accel-Buffering'] = "no"  # or nginx holds back the start of the download until it has it all
+        return response
@@ -1,3 +1,5 @@
+import os
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
@@ -7,4 +9,19 @@ DATABASES = {
         "HOST": "localhost",
         "PORT": "5432",
     }
-}
\ No newline at end of file
+}
+
+# read replicas of the default database as comma separated host:port pairs, e.g. "replica1:5432,replica2:5432"
+DATABASE_REPLICAS = []
+
+for n, replica in enumerate(filter(None, os.environ.get("DATABASE_REPLICA_HOSTS", "").split(",")), start=1):
+    host, _, port = replica.strip().partition(":")
+    alias = f"replica{n}"
+    DATABASES[alias] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": port or DATABASES["default"]["PORT"],
+        "OPTIONS": {"connect_timeout": 2},
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_REPLICAS.append(alias)
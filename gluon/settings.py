@@ -50,6 +50,7 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'gluon.anacreon.middleware.CurrentUserMiddleware',
+    'gluon.anacreon.middleware.ReplicaReadsMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -172,4 +173,59 @@ LOGGING = {
             'propagate': False,
         },
     },
-}
\ No newline at end of file
+}
+
+# Background jobs, see the worker management command
+
+JOB_WORKER_CONCURRENCY = 4
+JOB_WORKER_POLL_INTERVAL = 1.0
+JOB_STALE_AFTER_SECONDS = 60 * 15
+JOB_RETRY_BASE_SECONDS = 5
+JOB_RETRY_MAX_SECONDS = 60 * 60
+
+# Audit log partitioning and retention, see the archive_audit_logs management command
+
+AUDIT_LOG_PARTITIONS_AHEAD = 3
+AUDIT_LOG_RETAIN_MONTHS = 12
+AUDIT_LOG_ARCHIVE_DIR = BASE_DIR / "archive" / "auditlog"
+
+# how often the refresh_item_sales job refreshes the top sellers
+ITEM_SALES_REFRESH_MINUTES = 15
+
+# Read replicas, see DATABASE_REPLICAS in datasource.py. Pins are kept in the default cache, which should be shared
+# between processes in production
+
+DATABASE_ROUTERS = ["gluon.anacreon.routers.ReplicaRouter"]
+REPLICA_MAX_LAG_SECONDS = 10
+REPLICA_CHECK_SECONDS = 5
+REPLICA_PIN_SECONDS = 15
+
+# Caches, local to each process unless CACHE_URL points at a shared redis. Use a shared cache when running more than one
+# process, otherwise replica pins and invalidations of cached lists are only seen by the process that made them
+
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+if os.environ.get("CACHE_URL"):
+    CACHES["default"] = {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": os.environ["CACHE_URL"]}
+
+API_LIST_CACHE_SECONDS = 60 * 5
+
+# Item images, stored as files under MEDIA_ROOT named by their content ("file") or as base64 in the database
+# ("database"), see the migrate_item_images management command
+
+ITEM_IMAGE_STORAGE = "file"
+ITEM_IMAGE_DIR = "items"
+ITEM_IMAGE_THUMBNAIL_SIZE = (320, 320)
+ITEM_IMAGE_CACHE_SECONDS = 60 * 60 * 24 * 365  # of files, which never change
+ITEM_IMAGE_DATABASE_CACHE_SECONDS = 60 * 5  # of images in the database, whose URL is by id, then revalidated by ETag
+ITEM_IMAGE_TYPES = ("image/jpeg", "image/png", "image/webp", "image/gif", "image/heic")
+ITEM_IMAGE_MAX_BYTES = 20 * 1024 * 1024
+ITEM_IMAGE_CHUNK_BYTES = 64 * 1024
+
+# Item search, where a match's score is multiplied by 1 + ln(1 + weight) * ITEM_SEARCH_WEIGHT_FACTOR
+
+ITEM_SEARCH_WEIGHT_FACTOR = 0.1
+ITEM_SEARCH_FUZZY_CUTOFF = 60
+ITEM_SEARCH_CACHED_BUSINESSES = 100
+ITEM_SEARCH_FUZZY_WORKERS = -1
+ITEM_SEARCH_MAX_LIMIT = 100
@@ -14,9 +14,15 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path
+from django.urls import include, path, re_path
+
+from gluon.anacreon.views import item_image, item_image_file
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('', include('gluon.api.urls')),
+    re_path(rf'^{settings.MEDIA_URL.strip("/")}/{settings.ITEM_IMAGE_DIR}/(?P<path>.+)$', item_image_file),
+    path('itemimage/<int:image_id>/', item_image, name='anacreon.item_image'),
 ]
@@ -0,0 +1,45 @@
+import time
+
+from django.core.cache import cache
+
+# scope of cached lists which aren't filtered to a single business
+ALL_BUSINESSES = "*"
+
+
+def _generation_key(scope) -> str:
+    return f"cache:gen:{scope}"
+
+
+def get_generation(scope) -> int:
+    """
+    Gets the current generation of the given cache scope, which is the time in nanoseconds it was last invalidated.
+    Cache keys which include it are abandoned rather than deleted when the scope is invalidated.
+    """
+    key = _generation_key(scope)
+    generation = cache.get(key)
+    if generation is None:
+        # a scope we haven't seen, or whose generation was evicted, starts a new generation rather than going back to
+        # an old one whose entries may still be cached
+        cache.add(key, time.time_ns(), timeout=None)
+        generation = cache.get(key)
+
+    return generation
+
+
+def bump_generation(*scopes):
+    """
+    Invalidates everything cached under the given scopes by starting a new generation for each
+    """
+    now = time.time_ns()
+    cache.set_many({_generation_key(scope): now for scope in scopes}, timeout=None)
+
+
+def generation_age(generation) -> float:
+    """
+    Gets the number of seconds since the given generation started
+    """
+    return (time.time_ns() - generation) / 1e9
+
+
+def business_scope(business_id=ALL_BUSINESSES) -> str:
+    return f"business:{business_id}"